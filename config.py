@@ -40,7 +40,7 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 
 # Выбор AI-провайдера
-AI_PROVIDER = os.getenv('AI_PROVIDER', 'openai')  # 'openai' или 'claude'
+AI_PROVIDER = os.getenv('AI_PROVIDER', 'openai')  # 'openai', 'claude' или 'router' (оба провайдера)
 
 # Настройки OpenAI
 OPENAI_MODEL = "gpt-4o"
@@ -66,12 +66,200 @@ CLAUDE_TEMPERATURE = 0.8
 # Минимальная длина ответа для проверки полноты
 MIN_RESPONSE_LENGTH = 100
 
+# === НАСТРОЙКИ ПОТОКОВОЙ ГЕНЕРАЦИИ ===
+# Письмо показывается пользователю по мере генерации через edit_message_text
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))  # Секунд между правками сообщения (Telegram: ~1 правка/сек на чат)
+STREAM_IDLE_TIMEOUT = int(os.getenv('STREAM_IDLE_TIMEOUT', '20'))  # Секунд ожидания следующего фрагмента от AI
+
+# === НАСТРОЙКИ КЭША ПИСЕМ ===
+# Повторный запрос с той же вакансией и резюме отдается из кэша без обращения к AI
+LETTER_CACHE_ENABLED = os.getenv('LETTER_CACHE_ENABLED', 'true').lower() == 'true'
+LETTER_CACHE_MAX_ENTRIES = int(os.getenv('LETTER_CACHE_MAX_ENTRIES', '500'))
+LETTER_CACHE_TTL_SECONDS = int(os.getenv('LETTER_CACHE_TTL_SECONDS', '86400'))  # 24 часа
+LETTER_CACHE_SQLITE_PATH = os.getenv('LETTER_CACHE_SQLITE_PATH', '')  # Пусто - только кэш в памяти
+
+# === ДВУХЭТАПНАЯ ГЕНЕРАЦИЯ: АНАЛИЗ ВАКАНСИИ → ПИСЬМО ===
+# Анализ вакансии выполняется отдельным запросом и кэшируется для всех пользователей
+VACANCY_ANALYSIS_STAGE_ENABLED = os.getenv('VACANCY_ANALYSIS_STAGE_ENABLED', 'true').lower() == 'true'
+VACANCY_ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('VACANCY_ANALYSIS_CACHE_MAX_ENTRIES', '1000'))
+VACANCY_ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv('VACANCY_ANALYSIS_CACHE_TTL_SECONDS', '604800'))  # 7 дней
+VACANCY_SIMHASH_MAX_DISTANCE = int(os.getenv('VACANCY_SIMHASH_MAX_DISTANCE', '0'))  # Почти-дубликаты (0 - только точные копии, максимум 3)
+# Спекулятивный анализ вакансии в фоне, пока пользователь вставляет резюме
+SPECULATIVE_ANALYSIS_ENABLED = os.getenv('SPECULATIVE_ANALYSIS_ENABLED', 'false').lower() == 'true'
+SPECULATIVE_ANALYSIS_TOKEN_BUDGET = int(os.getenv('SPECULATIVE_ANALYSIS_TOKEN_BUDGET', '200000'))  # Токенов в час на фоновые анализы
+
+# === ХЕДЖИРОВАНИЕ ЗАПРОСОВ К AI ===
+# Если основная модель не ответила за p90 своей задержки, параллельно запускается fallback модель
+AI_HEDGING_ENABLED = os.getenv('AI_HEDGING_ENABLED', 'true').lower() == 'true'
+AI_HEDGE_DEFAULT_DELAY = float(os.getenv('AI_HEDGE_DEFAULT_DELAY', '15'))  # Секунд, пока задержка модели еще не выучена
+AI_HEDGE_DELAYS = os.getenv('AI_HEDGE_DELAYS', '')  # Явные задержки по моделям: 'gpt-4o=12,claude-3-5-sonnet-20241022=15'
+AI_HEDGE_PERCENTILE = float(os.getenv('AI_HEDGE_PERCENTILE', '0.9'))
+AI_HEDGE_MAX_PERCENT = float(os.getenv('AI_HEDGE_MAX_PERCENT', '10'))  # Максимум хеджированных запросов, % от трафика
+
+# === CIRCUIT BREAKERS AI-МОДЕЛЕЙ ===
+# Деградировавшая модель пропускается сразу, пока фоновая проба не покажет, что она восстановилась
+CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+CIRCUIT_BREAKER_WINDOW_SECONDS = int(os.getenv('CIRCUIT_BREAKER_WINDOW_SECONDS', '120'))  # Окно подсчета ошибок
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv('CIRCUIT_BREAKER_MIN_REQUESTS', '5'))  # Минимум запросов в окне для решения
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv('CIRCUIT_BREAKER_ERROR_RATE', '0.5'))  # Доля ошибок для размыкания
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_SECONDS', '40'))  # Ответ медленнее - "медленный"
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_RATE', '0.8'))  # Доля медленных ответов для размыкания
+CIRCUIT_BREAKER_OPEN_SECONDS = int(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', '30'))  # Пауза перед пробным запросом
+CIRCUIT_BREAKER_PROBE_INTERVAL = int(os.getenv('CIRCUIT_BREAKER_PROBE_INTERVAL', '10'))  # Период фоновых проб
+CIRCUIT_BREAKER_PROBE_TIMEOUT = int(os.getenv('CIRCUIT_BREAKER_PROBE_TIMEOUT', '15'))
+
+# === МАРШРУТИЗАЦИЯ МЕЖДУ ПРОВАЙДЕРАМИ (AI_PROVIDER=router) ===
+# Провайдер выбирается взвешенно по EWMA задержки, доле ошибок и цене токенов
+AI_MODEL_PRICES = os.getenv(
+    'AI_MODEL_PRICES',
+    'gpt-4o=0.01,gpt-4=0.045,claude-3-5-sonnet-20241022=0.012,claude-3-haiku-20240307=0.0008'
+)  # Усредненная цена, $ за 1K токенов
+ROUTER_EWMA_ALPHA = float(os.getenv('ROUTER_EWMA_ALPHA', '0.2'))  # Вес нового замера в EWMA
+ROUTER_ERROR_PENALTY = float(os.getenv('ROUTER_ERROR_PENALTY', '5'))  # Во сколько раз ошибки "удлиняют" задержку
+ROUTER_COST_WEIGHT = float(os.getenv('ROUTER_COST_WEIGHT', '100'))  # Секунд задержки, эквивалентных $1 за 1K токенов
+ROUTER_INITIAL_LATENCY = float(os.getenv('ROUTER_INITIAL_LATENCY', '10'))  # Начальная оценка задержки, секунд
+ROUTER_STICKY_MAX_SESSIONS = int(os.getenv('ROUTER_STICKY_MAX_SESSIONS', '10000'))
+ROUTER_STICKY_TTL_SECONDS = int(os.getenv('ROUTER_STICKY_TTL_SECONDS', '86400'))  # Сессия закреплена за провайдером сутки
+
+# === ПЛАНИРОВЩИК ЗАПРОСОВ К AI ===
+# Ограничение одновременных запросов к каждой модели и честная очередь с приоритетом premium
+AI_SCHEDULER_ENABLED = os.getenv('AI_SCHEDULER_ENABLED', 'true').lower() == 'true'
+AI_MAX_IN_FLIGHT_PER_MODEL = int(os.getenv('AI_MAX_IN_FLIGHT_PER_MODEL', '10'))
+AI_MAX_QUEUE_PER_MODEL = int(os.getenv('AI_MAX_QUEUE_PER_MODEL', '100'))  # Сверх этого запрос уходит в fallback модель
+AI_MODEL_CONCURRENCY = os.getenv('AI_MODEL_CONCURRENCY', '')  # Лимиты по моделям: 'gpt-4o=20,gpt-4=5'
+AI_QUEUE_TIMEOUT = int(os.getenv('AI_QUEUE_TIMEOUT', '120'))  # Секунд ожидания в очереди
+
+# === КВОТЫ RPM/TPM ПРОВАЙДЕРОВ ===
+# Клиентский token bucket по (API-ключ, модель); значения - лимиты вашего тарифа у провайдера
+AI_GOVERNOR_ENABLED = os.getenv('AI_GOVERNOR_ENABLED', 'true').lower() == 'true'
+AI_DEFAULT_RPM = int(os.getenv('AI_DEFAULT_RPM', '500'))  # Запросов в минуту на модель
+AI_DEFAULT_TPM = int(os.getenv('AI_DEFAULT_TPM', '30000'))  # Токенов в минуту на модель
+AI_MODEL_RPM_LIMITS = os.getenv('AI_MODEL_RPM_LIMITS', '')  # По моделям: 'gpt-4o=5000,claude-3-5-sonnet-20241022=50'
+AI_MODEL_TPM_LIMITS = os.getenv('AI_MODEL_TPM_LIMITS', '')  # По моделям: 'gpt-4o=800000,claude-3-5-sonnet-20241022=40000'
+AI_GOVERNOR_MAX_WAIT = int(os.getenv('AI_GOVERNOR_MAX_WAIT', '60'))  # Дольше ждать квоту - запрос уходит в fallback
+
+# === ИНКРЕМЕНТАЛЬНОЕ УЛУЧШЕНИЕ ПИСЕМ ===
+# Итерации улучшения отправляют сжатый контекст сессии вместо полной вакансии и резюме
+INCREMENTAL_IMPROVEMENT_ENABLED = os.getenv('INCREMENTAL_IMPROVEMENT_ENABLED', 'true').lower() == 'true'
+IMPROVEMENT_CONTEXT_MAX_SESSIONS = int(os.getenv('IMPROVEMENT_CONTEXT_MAX_SESSIONS', '5000'))
+IMPROVEMENT_CONTEXT_TTL_SECONDS = int(os.getenv('IMPROVEMENT_CONTEXT_TTL_SECONDS', '86400'))  # 24 часа
+IMPROVEMENT_VACANCY_BRIEF_CHARS = int(os.getenv('IMPROVEMENT_VACANCY_BRIEF_CHARS', '1500'))  # Если анализа вакансии нет в кэше
+IMPROVEMENT_RESUME_HIGHLIGHTS_CHARS = int(os.getenv('IMPROVEMENT_RESUME_HIGHLIGHTS_CHARS', '1500'))
+
+# === ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ (SINGLE-FLIGHT) ===
+# Повторный одинаковый запрос пользователя ждет уже выполняющийся, а не идет к провайдеру
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+# === ФОНОВЫЕ ГЕНЕРАЦИИ ===
+GENERATION_DRAIN_TIMEOUT = float(os.getenv('GENERATION_DRAIN_TIMEOUT', '30'))  # Секунд ожидания незавершенных генераций при остановке
+# Надежная очередь генераций: задачи в локальном SQLite переживают редеплой
+GENERATION_QUEUE_ENABLED = os.getenv('GENERATION_QUEUE_ENABLED', 'true').lower() == 'true'
+GENERATION_QUEUE_PATH = os.getenv('GENERATION_QUEUE_PATH', 'data/generation_jobs.db')
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '8'))  # Одновременных генераций (не зависит от обработки апдейтов)
+GENERATION_MAX_ATTEMPTS = int(os.getenv('GENERATION_MAX_ATTEMPTS', '3'))
+GENERATION_RETRY_BASE_SECONDS = float(os.getenv('GENERATION_RETRY_BASE_SECONDS', '5'))
+GENERATION_RETRY_MAX_SECONDS = float(os.getenv('GENERATION_RETRY_MAX_SECONDS', '120'))
+
+# === ВАРИАНТЫ ПИСЬМА ПРИ ПОВТОРНОЙ ГЕНЕРАЦИИ ===
+# "Повторить" присылает несколько писем за один раунд: OpenAI - один запрос с n>1,
+# Claude - параллельные запросы с общим кэшированным промптом
+LETTER_VARIANTS_COUNT = int(os.getenv('LETTER_VARIANTS_COUNT', '3'))  # 1 - выключено (одно письмо, как раньше)
+LETTER_VARIANTS_TEMPERATURE = float(os.getenv('LETTER_VARIANTS_TEMPERATURE', '0.9'))  # Выше обычной, чтобы варианты различались
+CLAUDE_VARIANTS_STAGGER = float(os.getenv('CLAUDE_VARIANTS_STAGGER', '2'))  # Секунд до запуска остальных вариантов (успевает записаться кэш промпта)
+
+# === ПРОДОЛЖЕНИЕ ОБРЕЗАННЫХ ОТВЕТОВ ===
+# Ответ, упершийся в max_tokens (finish_reason=length / stop_reason=max_tokens), дописывается
+# отдельным запросом продолжения, а не генерируется заново
+AI_MAX_CONTINUATIONS = int(os.getenv('AI_MAX_CONTINUATIONS', '2'))  # 0 - выключено
+
+# === АДАПТИВНЫЕ MAX_TOKENS И ТАЙМАУТЫ ===
+# max_tokens и таймаут попытки берутся из перцентилей фактической длины ответа и задержки
+# по (тип запроса, модель); пока замеров мало - значения из кода (800/1500/2000 токенов, 60s)
+AI_ADAPTIVE_LIMITS_ENABLED = os.getenv('AI_ADAPTIVE_LIMITS_ENABLED', 'true').lower() == 'true'
+AI_ADAPTIVE_PERCENTILE = float(os.getenv('AI_ADAPTIVE_PERCENTILE', '0.99'))
+AI_ADAPTIVE_TOKENS_HEADROOM = float(os.getenv('AI_ADAPTIVE_TOKENS_HEADROOM', '1.2'))  # Запас над перцентилем длины ответа
+AI_ADAPTIVE_TIMEOUT_HEADROOM = float(os.getenv('AI_ADAPTIVE_TIMEOUT_HEADROOM', '1.5'))  # Запас над перцентилем задержки
+AI_ADAPTIVE_MIN_TOKENS = int(os.getenv('AI_ADAPTIVE_MIN_TOKENS', '300'))
+AI_ADAPTIVE_MAX_TOKENS = int(os.getenv('AI_ADAPTIVE_MAX_TOKENS', '4000'))
+AI_ADAPTIVE_MIN_TIMEOUT = float(os.getenv('AI_ADAPTIVE_MIN_TIMEOUT', '15'))
+AI_ADAPTIVE_MAX_TIMEOUT = float(os.getenv('AI_ADAPTIVE_MAX_TIMEOUT', '120'))
+
+# === СОКРАЩЕНИЕ РЕЗЮМЕ ДЛЯ ПРОМПТА ===
+# Длинное резюме делится на разделы, в промпт письма идут самые релевантные вакансии (BM25)
+RESUME_TRIMMING_ENABLED = os.getenv('RESUME_TRIMMING_ENABLED', 'true').lower() == 'true'
+RESUME_PROMPT_TOKEN_BUDGET = int(os.getenv('RESUME_PROMPT_TOKEN_BUDGET', '1500'))  # Резюме короче - передается целиком
+
+# === ВЫЖИМКА РЕЗЮМЕ ===
+RESUME_DIGEST_ENABLED = os.getenv('RESUME_DIGEST_ENABLED', 'true').lower() == 'true'
+RESUME_DIGEST_MAX_USERS = int(os.getenv('RESUME_DIGEST_MAX_USERS', '10000'))
+RESUME_DIGEST_TTL_SECONDS = int(os.getenv('RESUME_DIGEST_TTL_SECONDS', str(30 * 86400)))
+RESUME_DIGEST_SQLITE_PATH = os.getenv('RESUME_DIGEST_SQLITE_PATH', 'data/resume_digests.db')  # Пусто - только память
+
+# === ПАКЕТНАЯ ГЕНЕРАЦИЯ (/bulk) ===
+BULK_MAX_VACANCIES = int(os.getenv('BULK_MAX_VACANCIES', '10'))  # Вакансий в одном пакете
+
+# === УЧЕТ ТОКЕНОВ И СТОИМОСТИ ===
+# Каждый вызов API (включая fallback модели и продолжения) пишется в openai_requests с оценкой стоимости
+AI_MODEL_INPUT_PRICES = os.getenv(
+    'AI_MODEL_INPUT_PRICES',
+    'gpt-4o=0.0025,gpt-4=0.03,claude-3-5-sonnet-20241022=0.003,claude-3-haiku-20240307=0.00025'
+)  # $ за 1K входных токенов
+AI_MODEL_OUTPUT_PRICES = os.getenv(
+    'AI_MODEL_OUTPUT_PRICES',
+    'gpt-4o=0.01,gpt-4=0.06,claude-3-5-sonnet-20241022=0.015,claude-3-haiku-20240307=0.00125'
+)  # $ за 1K выходных токенов; модели без цены считаются по AI_MODEL_PRICES
+TOKEN_METERING_MAX_USERS = int(os.getenv('TOKEN_METERING_MAX_USERS', '10000'))  # Пользователей в статистике в памяти
+
+# === БУФЕР АНАЛИТИКИ ===
+# События, ошибки и запросы к AI пишутся в Supabase пакетами (один insert на таблицу)
+ANALYTICS_BUFFER_ENABLED = os.getenv('ANALYTICS_BUFFER_ENABLED', 'true').lower() == 'true'
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', '100'))  # Строк в одном пакете
+ANALYTICS_FLUSH_INTERVAL_MS = int(os.getenv('ANALYTICS_FLUSH_INTERVAL_MS', '2000'))  # Запись не реже раза в N мс
+ANALYTICS_QUEUE_MAX = int(os.getenv('ANALYTICS_QUEUE_MAX', '5000'))  # Максимум строк в очереди
+ANALYTICS_OVERFLOW_POLICY = os.getenv('ANALYTICS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest или drop_newest
+ANALYTICS_ENQUEUE_TIMEOUT_MS = int(os.getenv('ANALYTICS_ENQUEUE_TIMEOUT_MS', '50'))  # Ожидание места в полной очереди
+ANALYTICS_SHUTDOWN_FLUSH_TIMEOUT = float(os.getenv('ANALYTICS_SHUTDOWN_FLUSH_TIMEOUT', '10'))  # Секунд на запись очереди при остановке
+
+# === МОНИТОРИНГ EVENT LOOP ===
+# Задержка loop (p50/p95/p99) и стек кода, блокирующего бота дольше порога
+LOOP_MONITOR_ENABLED = os.getenv('LOOP_MONITOR_ENABLED', 'true').lower() == 'true'
+LOOP_MONITOR_INTERVAL_MS = int(os.getenv('LOOP_MONITOR_INTERVAL_MS', '250'))  # Период замера задержки
+LOOP_BLOCK_THRESHOLD_MS = int(os.getenv('LOOP_BLOCK_THRESHOLD_MS', '500'))  # Блокировка дольше - логируем стек
+LOOP_MONITOR_WINDOW = int(os.getenv('LOOP_MONITOR_WINDOW', '1200'))  # Замеров в окне перцентилей (~5 минут)
+LOOP_MONITOR_REPORT_SECONDS = int(os.getenv('LOOP_MONITOR_REPORT_SECONDS', '300'))  # Период записи перцентилей в лог
+
+# === ПУЛЫ ПОТОКОВ ===
+# Блокирующие операции разделены по пулам: фоновые записи не отнимают потоки у чтений
+EXECUTOR_CRITICAL_WORKERS = int(os.getenv('EXECUTOR_CRITICAL_WORKERS', '4'))  # SQLite кэшей и очереди генераций
+EXECUTOR_CRITICAL_QUEUE = int(os.getenv('EXECUTOR_CRITICAL_QUEUE', '100'))  # Задач в очереди сверх потоков
+EXECUTOR_PAYMENTS_WORKERS = int(os.getenv('EXECUTOR_PAYMENTS_WORKERS', '2'))  # SDK ЮKassa
+EXECUTOR_PAYMENTS_QUEUE = int(os.getenv('EXECUTOR_PAYMENTS_QUEUE', '20'))
+EXECUTOR_BACKGROUND_WORKERS = int(os.getenv('EXECUTOR_BACKGROUND_WORKERS', '2'))  # Необязательные записи в кэши
+EXECUTOR_BACKGROUND_QUEUE = int(os.getenv('EXECUTOR_BACKGROUND_QUEUE', '200'))  # Сверх лимита задачи отбрасываются
+
+# === ЗАПИСЬ СЕССИЙ ПИСЕМ ===
+# Частичные обновления letter_sessions сливаются в один PATCH на финальном статусе сессии
+SESSION_WRITE_BEHIND_ENABLED = os.getenv('SESSION_WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+SESSION_WRITE_DELAY_MS = int(os.getenv('SESSION_WRITE_DELAY_MS', '60000'))  # Запись без финального статуса (дольше генерации)
+SESSION_STATE_MAX_SESSIONS = int(os.getenv('SESSION_STATE_MAX_SESSIONS', '10000'))  # Сессий с итерациями в памяти
+
 # === НАСТРОЙКИ АНАЛИТИКИ ===
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY') 
 SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
 ANALYTICS_ENABLED = os.getenv('ANALYTICS_ENABLED', 'true').lower() == 'true'
 
+# Асинхронный клиент PostgREST (пул соединений httpx вместо синхронного supabase-py)
+SUPABASE_HTTP_TIMEOUT = float(os.getenv('SUPABASE_HTTP_TIMEOUT', '10'))  # Секунд на запрос к Supabase
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv('SUPABASE_CONNECT_TIMEOUT', '5'))  # Секунд на установку соединения
+SUPABASE_MAX_CONNECTIONS = int(os.getenv('SUPABASE_MAX_CONNECTIONS', '20'))  # Соединений в пуле
+SUPABASE_MAX_KEEPALIVE = int(os.getenv('SUPABASE_MAX_KEEPALIVE', '10'))  # Соединений, которые держим открытыми
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv('SUPABASE_KEEPALIVE_EXPIRY', '30'))  # Секунд жизни простаивающего соединения
+SUPABASE_HTTP2 = os.getenv('SUPABASE_HTTP2', 'true').lower() == 'true'  # Нужен пакет h2 (httpx[http2])
+SUPABASE_MAX_RETRIES = int(os.getenv('SUPABASE_MAX_RETRIES', '2'))  # Повторов временных ошибок
+SUPABASE_RETRY_BACKOFF = float(os.getenv('SUPABASE_RETRY_BACKOFF', '0.3'))  # Базовая пауза между повторами, сек
+
 logger.info("🔧 RAILWAY ANALYTICS DEBUG:")
 logger.info(f"   SUPABASE_URL: {SUPABASE_URL[:50] if SUPABASE_URL else 'NOT_FOUND'}...")
 logger.info(f"   SUPABASE_KEY: {SUPABASE_KEY[:30] if SUPABASE_KEY else 'NOT_FOUND'}...")
@@ -3,12 +3,20 @@ Simple Conversation Handler v7.2
 Упрощенная система обратной связи: только лайки/дизлайки БЕЗ комментариев
 Релизная версия с улучшенным UX
 """
+import html
 import logging
 import time
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
+from typing import Optional
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery, Chat
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes, ConversationHandler
-from services.smart_analyzer import generate_simple_letter, generate_improved_letter
+from services.smart_analyzer import generate_simple_letter, generate_improved_letter, generate_letter_variants, generate_letters_for_vacancies, stream_simple_letter
+from services.vacancy_analysis import start_speculative_analysis
+from services.improvement_context import improvement_contexts
+from services.generation_queue import GenerationJob, RetryJob, generation_queue
+from services.ai_factory import AIFactory
+from services.ai_scheduler import ai_request_context, PRIORITY_PREMIUM, PRIORITY_STANDARD
 from services.analytics_service import analytics
 from services.subscription_service import subscription_service
 from services.feedback_service import feedback_service
@@ -17,10 +25,10 @@ from services.payment_service import payment_service
 from models.analytics_models import UserData, LetterSessionData
 from models.feedback_models import LetterFeedbackData, LetterIterationImprovement
 from utils.validators import InputValidator, ValidationMiddleware
-from utils.keyboards import get_feedback_keyboard, get_iteration_keyboard, get_final_letter_keyboard, get_retry_keyboard, get_start_work_keyboard, get_premium_info_keyboard, get_post_generation_keyboard, get_limit_reached_keyboard, get_iteration_upsell_keyboard, get_payment_keyboard, get_payment_success_keyboard, get_payment_error_keyboard, get_payment_processing_keyboard
+from utils.keyboards import get_feedback_keyboard, get_iteration_keyboard, get_final_letter_keyboard, get_retry_keyboard, get_start_work_keyboard, get_premium_info_keyboard, get_post_generation_keyboard, get_limit_reached_keyboard, get_iteration_upsell_keyboard, get_payment_keyboard, get_payment_success_keyboard, get_payment_error_keyboard, get_payment_processing_keyboard, get_variant_choice_keyboard, get_bulk_vacancies_keyboard
 from utils.database import save_user_consent, get_user_consent_status
 from utils.rate_limiter import rate_limit, rate_limiter
-from config import RATE_LIMITING_ENABLED, ADMIN_TELEGRAM_IDS
+from config import RATE_LIMITING_ENABLED, ADMIN_TELEGRAM_IDS, STREAMING_ENABLED, STREAM_EDIT_INTERVAL, LETTER_VARIANTS_COUNT, BULK_MAX_VACANCIES
 import asyncio
 from telegram.ext import CommandHandler
 
@@ -35,6 +43,8 @@ else:
 
 # Состояния для v7.2 с упрощенной системой оценок
 WAITING_VACANCY, WAITING_RESUME, WAITING_IMPROVEMENT_REQUEST, WAITING_FEEDBACK = range(300, 304)
+# Пакетный режим /bulk
+WAITING_BULK_VACANCIES, WAITING_BULK_RESUME = range(304, 306)
 
 # ============================================================================
 # РЕЛИЗНАЯ ВЕРСИЯ 6.0 - ГОТОВА К ПРОДАКШЕНУ
@@ -63,6 +73,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 ✅ <b>Решение:</b> Персональные письма получают ответы.
 
 🎯 <b>/start</b> - Создать письмо-магнит для HR.
+📚 <b>/bulk</b> - Письма по одному резюме сразу на несколько вакансий.
 💎 <b>/premium</b> - Получить в 7 раз больше писем и лучшее качество.
 📞 <b>/support</b> - Связаться с создателями.
 
@@ -160,12 +171,17 @@ async def start_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Начало диалога v6.0"""
     logger.info("🚀 Начинаем диалог v6.0")
     
+    # Незавершенная генерация больше не нужна - не тратим на нее токены
+    if update.effective_user:
+        await generation_queue.cancel_user(update.effective_user.id, reason="start")
+    
     # Защита от двойных нажатий - сохраняем важные данные перед очисткой
     saved_improvement_session_id = None
     if context.user_data is not None:
         # Сохраняем ID сессии улучшения если есть
         saved_improvement_session_id = context.user_data.get('improvement_session_id')
         
+        _cancel_speculative_analysis(context)
         context.user_data.clear()
         # Устанавливаем флаги активной сессии и инициализации
         context.user_data['conversation_state'] = 'active'
@@ -330,6 +346,16 @@ async def handle_vacancy(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 logger.error(f"❌ RAILWAY DEBUG: No analytics_user_id found!")
             else:
                 logger.info(f"🔍 RAILWAY DEBUG: analytics_session_id already exists, skipping creation")
+        
+        # Спекулятивно анализируем вакансию, пока пользователь готовит резюме
+        _cancel_speculative_analysis(context)
+        analysis_task = start_speculative_analysis(
+            vacancy_text,
+            user_id=user_id,
+            session_id=context.user_data.get('analytics_session_id')
+        )
+        if analysis_task:
+            context.user_data['vacancy_analysis_task'] = analysis_task
     else:
         logger.error(f"❌ RAILWAY DEBUG: context.user_data is None!")
     
@@ -449,17 +475,29 @@ async def handle_resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     
     if context.user_data:
         vacancy_text = context.user_data.get('vacancy_text', '')
-        asyncio.create_task(
-            _process_and_respond(
-                update, 
-                context, 
-                processing_msg, 
-                analytics_user_id, 
-                vacancy_text, 
-                resume_text,
-                max_iterations=max_iterations
-            )
-        )
+        payload = {
+            'user_id': analytics_user_id,
+            'vacancy_text': vacancy_text,
+            'resume_text': resume_text,
+            'max_iterations': max_iterations,
+            'processing_message_id': processing_msg.message_id
+        }
+        # Письмо пишется в сессию, созданную на шаге вакансии (одна строка letter_sessions
+        # на письмо); следующая вакансия начнет новую сессию
+        session_id = context.user_data.pop('analytics_session_id', None)
+        if session_id:
+            # Буфер сессий допишет эти поля одним PATCH вместе с результатом генерации
+            await analytics.update_letter_session(session_id, {
+                'job_description': vacancy_text,
+                'job_description_length': len(vacancy_text),
+                'resume_text': resume_text,
+                'resume_length': len(resume_text),
+                'max_iterations': max_iterations
+            })
+            payload['session_id'] = session_id
+
+        # Письмо пишет воркер очереди; спекулятивный анализ вакансии он заберет из user_data
+        await generation_queue.enqueue('letter', telegram_user_id, update.message.chat_id, payload)
 
     return WAITING_FEEDBACK
 
@@ -505,43 +543,256 @@ def _is_error_response(generated_letter: str) -> bool:
     return False
 
 
+def _cancel_speculative_analysis(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменяет фоновый анализ вакансии, если пользователь начал заново или вышел"""
+    if context.user_data is None:
+        return
+    task = context.user_data.pop('vacancy_analysis_task', None)
+    if task and not task.done():
+        task.cancel()
+        logger.info("🔮 Спекулятивный анализ вакансии отменен")
+
+
+async def _await_speculative_analysis(task: Optional[asyncio.Task]) -> Optional[str]:
+    """Дожидается фонового анализа вакансии; при ошибке или отмене возвращает None"""
+    if task is None:
+        return None
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task.cancelled():
+            # Отменили только фоновый анализ - генерация продолжится без него
+            return None
+        raise
+    except Exception as e:
+        logger.warning(f"⚠️ Спекулятивный анализ вакансии завершился ошибкой: {e}")
+        return None
+
+
+# Лимит Telegram на длину сообщения - 4096 символов, оставляем запас под заголовок
+STREAM_PREVIEW_MAX_CHARS = 3800
+
+
+def _format_stream_preview(text: str) -> str:
+    """Форматирует промежуточный текст письма для показа во время генерации"""
+    if len(text) > STREAM_PREVIEW_MAX_CHARS:
+        text = "…" + text[-STREAM_PREVIEW_MAX_CHARS:]
+    return f"✍️ Пишу письмо...\n\n{text} ▌"
+
+
+def _queue_position_reporter(processing_msg: Message):
+    """Колбэк планировщика AI: показывает позицию в очереди в processing_msg"""
+    # У сообщения, восстановленного воркером очереди, текста нет - восстанавливать нечего
+    original_text = processing_msg.text_html if processing_msg.text else None
+    
+    async def report(position: int):
+        try:
+            if position > 0:
+                await processing_msg.edit_text(
+                    f"⏳ <b>Сейчас много запросов — вы #{position} в очереди</b>\n\n"
+                    "Генерация начнется автоматически, ничего отправлять не нужно.",
+                    parse_mode='HTML'
+                )
+            elif original_text:
+                await processing_msg.edit_text(original_text, parse_mode='HTML')
+        except (BadRequest, RetryAfter) as e:
+            logger.debug(f"Не удалось показать позицию в очереди: {e}")
+    
+    return report
+
+
+async def _generate_letter_with_preview(
+    processing_msg: Message,
+    vacancy_text: str,
+    resume_text: str,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    vacancy_analysis: Optional[str] = None
+) -> str:
+    """
+    Генерирует письмо, показывая текст в processing_msg по мере генерации
+    
+    Правки сообщения выполняются не чаще STREAM_EDIT_INTERVAL, чтобы не упираться
+    в лимиты Telegram. Если поток оборвался - письмо генерируется заново обычным способом.
+    """
+    if not STREAMING_ENABLED:
+        return await generate_simple_letter(
+            vacancy_text, resume_text, user_id=user_id, session_id=session_id, vacancy_analysis=vacancy_analysis
+        )
+    
+    parts = []
+    next_edit_at = 0.0
+    last_preview = ""
+    
+    try:
+        async for delta in stream_simple_letter(
+            vacancy_text, resume_text, user_id=user_id, session_id=session_id, vacancy_analysis=vacancy_analysis
+        ):
+            parts.append(delta)
+            
+            now = time.monotonic()
+            if now < next_edit_at:
+                continue
+            
+            preview = _format_stream_preview(''.join(parts))
+            if preview == last_preview:
+                continue
+            
+            try:
+                await processing_msg.edit_text(preview)
+                last_preview = preview
+                next_edit_at = now + STREAM_EDIT_INTERVAL
+            except RetryAfter as e:
+                logger.warning(f"⏱️ Telegram просит паузу в правках: {e.retry_after}s")
+                next_edit_at = now + float(e.retry_after)
+            except BadRequest as e:
+                logger.debug(f"Не удалось обновить превью письма: {e}")
+                next_edit_at = now + STREAM_EDIT_INTERVAL
+                
+    except Exception as e:
+        logger.warning(f"⚠️ Потоковая генерация не удалась, переключаюсь на обычную: {e}")
+        return await generate_simple_letter(
+            vacancy_text, resume_text, user_id=user_id, session_id=session_id, vacancy_analysis=vacancy_analysis
+        )
+    
+    letter = ''.join(parts).strip()
+    if not letter:
+        return "Не удалось сгенерировать письмо. Попробуйте еще раз."
+    return letter
+
+
+# ============================================================================
+# ЗАДАЧИ ОЧЕРЕДИ ГЕНЕРАЦИЙ
+# Обработчики ставят задачу в generation_queue, письмо пишет воркер - в том числе
+# после перезапуска бота, поэтому все нужное для доставки хранится в payload задачи
+# ============================================================================
+
+def _job_message(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob) -> Optional[Message]:
+    """Сообщение "пишу письмо..." задачи, восстановленное по chat_id и message_id"""
+    message_id = job.payload.get('processing_message_id')
+    if not message_id:
+        return None
+    message = Message(
+        message_id=message_id,
+        date=datetime.now(),
+        chat=Chat(id=job.chat_id, type=Chat.PRIVATE)
+    )
+    message.set_bot(context.bot)
+    return message
+
+
+async def _edit_job_message(processing_msg: Optional[Message], text: str, **kwargs) -> None:
+    """Правка сообщения задачи: после перезапуска его уже могли удалить или изменить"""
+    if processing_msg is None:
+        return
+    try:
+        await processing_msg.edit_text(text, **kwargs)
+    except BadRequest as e:
+        logger.debug(f"Не удалось изменить сообщение задачи: {e}")
+
+
+async def _delete_job_message(processing_msg: Optional[Message]) -> None:
+    """Удаление сообщения задачи, которого после перезапуска может уже не быть"""
+    if processing_msg is None:
+        return
+    try:
+        await processing_msg.delete()
+    except BadRequest as e:
+        logger.debug(f"Не удалось удалить сообщение задачи: {e}")
+
+
+async def _show_retry_pending(processing_msg: Optional[Message]) -> None:
+    """Сообщает пользователю, что генерация будет повторена автоматически"""
+    if processing_msg is None:
+        return
+    try:
+        await processing_msg.edit_text(
+            "⏳ <b>AI ответил с ошибкой — пробую еще раз</b>\n\n"
+            "Письмо придет автоматически, ничего отправлять не нужно.",
+            parse_mode='HTML'
+        )
+    except (BadRequest, RetryAfter) as e:
+        logger.debug(f"Не удалось показать статус повтора: {e}")
+
+
+async def _run_letter_job(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Задача 'letter': генерация письма по вакансии и резюме из handle_resume"""
+    processing_msg = _job_message(context, job)
+    # Спекулятивный анализ вакансии есть только в этом процессе (после перезапуска - None)
+    vacancy_analysis_task = context.user_data.pop('vacancy_analysis_task', None) if context.user_data else None
+    await _process_and_respond(context, job, processing_msg, vacancy_analysis_task=vacancy_analysis_task)
+
+
+async def _notify_job_failed(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Все попытки задачи исчерпаны - сообщаем пользователю, лимит не списывается"""
+    await _delete_job_message(_job_message(context, job))
+    session_id = job.payload.get('session_id')
+    await context.bot.send_message(
+        job.chat_id,
+        "😔 <b>Не удалось подготовить письмо</b>\n\n"
+        "AI-сервис сейчас работает нестабильно. Попытка не списана с вашего лимита — "
+        "повторите чуть позже.",
+        parse_mode='HTML',
+        reply_markup=get_retry_keyboard(session_id) if session_id else None
+    )
+
+
+def register_generation_jobs(application) -> None:
+    """Регистрирует обработчики задач очереди генераций (вызывается из post_init)"""
+    def bind(run):
+        async def handler(job: GenerationJob):
+            context = application.context_types.context(application, chat_id=job.chat_id, user_id=job.user_key)
+            await run(context, job)
+        return handler
+    
+    on_failure = bind(_notify_job_failed)
+    generation_queue.register('letter', bind(_run_letter_job), on_failure=on_failure)
+    generation_queue.register('retry', bind(_run_retry_job), on_failure=on_failure)
+    generation_queue.register('improvement', bind(_run_improvement_job), on_failure=on_failure)
+    # Пакет, удаленный из очереди по /start или /cancel, возвращает резерв писем
+    generation_queue.register('bulk', bind(_run_bulk_job), on_failure=bind(_notify_bulk_failed),
+                              on_cancel=_release_bulk_reservation)
+
+
 async def _process_and_respond(
-    update: Update, 
     context: ContextTypes.DEFAULT_TYPE, 
+    job: GenerationJob,
     processing_msg: Message, 
-    user_id: int, 
-    vacancy_text: str, 
-    resume_text: str,
-    max_iterations: int
+    vacancy_analysis_task: Optional[asyncio.Task] = None
 ):
-    """Приватная корутина для фоновой обработки"""
-    if not update.effective_user:
-        logger.error("Не удалось получить effective_user в _process_and_respond")
-        return
+    """Генерация письма воркером очереди (задача 'letter')"""
+    user_id = job.payload['user_id']
+    vacancy_text = job.payload['vacancy_text']
+    resume_text = job.payload['resume_text']
+    max_iterations = job.payload['max_iterations']
 
     is_generation_successful = False
     generated_letter = None
-    session_id = None
+    # Сессия создана на шаге вакансии или первой попыткой задачи
+    session_id = job.payload.get('session_id')
     iteration_status = None
     
     try:
         start_time = time.time()
-        # Создаем сессию аналитики
-        session_data = LetterSessionData(
-            user_id=user_id,
-            mode="v6.0",
-            job_description=vacancy_text,
-            job_description_length=len(vacancy_text),
-            resume_text=resume_text,
-            resume_length=len(resume_text),
-            max_iterations=max_iterations
-        )
-        session_id = await analytics.create_letter_session(session_data)
+        if not session_id:
+            # Создаем сессию аналитики
+            session_data = LetterSessionData(
+                user_id=user_id,
+                mode="v6.0",
+                job_description=vacancy_text,
+                job_description_length=len(vacancy_text),
+                resume_text=resume_text,
+                resume_length=len(resume_text),
+                max_iterations=max_iterations
+            )
+            session_id = await analytics.create_letter_session(session_data)
+            job.payload['session_id'] = session_id
 
         # Проверяем лимиты пользователя
         limits = await subscription_service.check_user_limits(user_id)
         if limits and not limits.get('can_generate'):
-            await processing_msg.edit_text(
+            await _edit_job_message(
+                processing_msg,
                 subscription_service.format_limit_message(limits),
                 reply_markup=get_premium_info_keyboard()
             )
@@ -550,19 +801,44 @@ async def _process_and_respond(
         # Проверяем что session_id не None
         if not session_id:
             logger.error("❌ session_id is None, cannot proceed")
-            await processing_msg.edit_text("❌ Ошибка создания сессии. Попробуйте /start")
+            await _edit_job_message(processing_msg, "❌ Ошибка создания сессии. Попробуйте /start")
+            return
+
+        # Все модели отключены circuit breaker'ом - сообщаем сразу, а не после минуты таймаутов
+        if not AIFactory.is_available():
+            logger.warning(f"🔴 Все AI-модели недоступны: {AIFactory.get_health()['models']}")
+            await analytics.update_letter_session(session_id, {'status': 'failed'})
+            await _edit_job_message(
+                processing_msg,
+                "😔 AI-сервис временно недоступен. Попробуйте через минуту — "
+                "попытка не будет списана с вашего лимита.",
+                reply_markup=get_retry_keyboard(session_id)
+            )
             return
 
-        generated_letter = await generate_simple_letter(vacancy_text, resume_text, user_id=user_id, session_id=session_id)
+        # Premium-пользователи идут в очереди к AI первыми
+        priority = PRIORITY_PREMIUM if limits and limits.get('plan_type') == 'premium' else PRIORITY_STANDARD
+        with ai_request_context(user_id, priority, on_position=_queue_position_reporter(processing_msg)):
+            # Анализ вакансии мог быть выполнен заранее, пока пользователь вставлял резюме
+            vacancy_analysis = await _await_speculative_analysis(vacancy_analysis_task)
+            
+            generated_letter = await _generate_letter_with_preview(
+                processing_msg, vacancy_text, resume_text,
+                user_id=user_id, session_id=session_id, vacancy_analysis=vacancy_analysis
+            )
         generation_time = int(time.time() - start_time)
-        
-        await processing_msg.delete()
 
         # Проверяем качество ответа - не только наличие текста, но и отсутствие ошибок
         is_generation_successful = bool(generated_letter) and not _is_error_response(generated_letter)
+        if not is_generation_successful and not job.is_last_attempt:
+            await _show_retry_pending(processing_msg)
+            raise RetryJob("letter generation failed")
+        
+        await _delete_job_message(processing_msg)
 
         if is_generation_successful:
-            await update.effective_user.send_message(
+            await context.bot.send_message(
+                job.chat_id,
                 f"✍️ <b>ПИСЬМО:</b>\n\n{generated_letter}",
                 parse_mode='HTML'
             )
@@ -574,10 +850,12 @@ async def _process_and_respond(
                 'generation_time_seconds': generation_time,
                 'status': 'completed'
             })
+            improvement_contexts.remember(session_id, vacancy_text, resume_text, generated_letter)
         else:
             # Для ошибочных ответов показываем сам ответ Claude (с объяснением проблемы)
             if generated_letter:
-                await update.effective_user.send_message(
+                await context.bot.send_message(
+                    job.chat_id,
                     f"⚠️ <b>ВНИМАНИЕ:</b>\n\n{generated_letter}",
                     parse_mode='HTML'
                 )
@@ -612,7 +890,8 @@ async def _process_and_respond(
 💡 <i>Попробуйте сделать описание вакансии и резюме более подробными</i>"""
             keyboard = get_retry_keyboard(session_id)
 
-        await update.effective_user.send_message(
+        await context.bot.send_message(
+            job.chat_id,
             feedback_message,
             parse_mode='HTML',
             reply_markup=keyboard
@@ -626,23 +905,363 @@ async def _process_and_respond(
                 context.user_data['improvement_session_id'] = session_id
                 logger.info(f"💾 Saved improvement_session_id: {session_id}")
 
+    except asyncio.CancelledError:
+        # /start, /cancel или новая генерация - запрос к AI уже прерван. При остановке
+        # бота (job.interrupted) задача выполнится после перезапуска: сессию и сообщение не трогаем
+        if session_id and not is_generation_successful and not job.interrupted:
+            try:
+                await analytics.update_letter_session(session_id, {'status': 'cancelled'})
+                await _delete_job_message(processing_msg)
+            except Exception as e_inner:
+                logger.debug(f"Не удалось убрать отмененную генерацию: {e_inner}")
+        raise
+    except RetryJob:
+        raise
     except Exception as e:
         logger.error(f"Ошибка в _process_and_respond: {e}", exc_info=True)
+        # Письмо еще не получено - очередь повторит задачу
+        if generated_letter is None and not job.is_last_attempt:
+            await _show_retry_pending(processing_msg)
+            raise RetryJob(str(e)) from e
         try:
-            await processing_msg.delete()
-            await update.effective_user.send_message(
+            await _delete_job_message(processing_msg)
+            await context.bot.send_message(
+                job.chat_id,
                 "❌ Произошла критическая ошибка. Попробуйте /start снова."
             )
         except Exception as e_inner:
             logger.error(f"Не удалось отправить сообщение об ошибке пользователю: {e_inner}")
 
     # Состояние ожидания обратной связи
-    # return WAITING_FEEDBACK # Это не работает в create_task, состояние устанавливается в родительской функции
+    # return WAITING_FEEDBACK # Это не работает в фоновой задаче, состояние устанавливается в handle_resume
+
+
+# ============================================================================
+# ПАКЕТНАЯ ГЕНЕРАЦИЯ /bulk: ОДНО РЕЗЮМЕ - МНОГО ВАКАНСИЙ
+# Вакансии присылаются текстом (разделитель - строка ---) или .txt файлом,
+# лимит подписки резервируется сразу на весь пакет, письма пишет одна задача
+# очереди и отправляет каждое по готовности
+# ============================================================================
+
+BULK_INSTRUCTIONS = (
+    "📚 <b>ПАКЕТНЫЙ РЕЖИМ: одно резюме — много вакансий</b>\n\n"
+    "<b>Шаг 1:</b> Отправьте вакансии — до {max_vacancies} штук:\n"
+    "• текстом, разделяя вакансии строкой <code>---</code>\n"
+    "• или .txt файлом в том же формате\n\n"
+    "Можно несколькими сообщениями. Когда закончите — нажмите «Готово».\n\n"
+    "{subscription_info}"
+)
+
+
+def _bulk_vacancy_title(vacancy_text: str) -> str:
+    """Первая строка вакансии для подписи письма в пакете"""
+    first_line = vacancy_text.strip().split('\n', 1)[0].strip()
+    if len(first_line) > 60:
+        first_line = first_line[:57] + "..."
+    return html.escape(first_line)
+
+
+async def _read_bulk_document(message: Message) -> Optional[str]:
+    """Текст .txt файла со списком вакансий или None, если файл не подходит"""
+    document = message.document
+    if document.file_size and document.file_size > InputValidator.MAX_BULK_FILE_SIZE:
+        return None
+    telegram_file = await document.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+@rate_limit('commands')
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Начало пакетной генерации: одно резюме на несколько вакансий"""
+    user = update.effective_user
+    if not update.message or not user:
+        return ConversationHandler.END
+    
+    await generation_queue.cancel_user(user.id, reason="bulk")
+    
+    user_id = await analytics.track_user(UserData(
+        telegram_user_id=user.id,
+        username=user.username,
+        first_name=user.first_name,
+        language_code=user.language_code
+    ))
+    if not user_id:
+        await update.message.reply_text("❌ Ошибка: не удалось определить пользователя. Попробуйте /start")
+        return ConversationHandler.END
+    
+    limits = await subscription_service.check_user_limits(user_id, force_refresh=True)
+    if limits and not limits.get('can_generate'):
+        await update.message.reply_text(
+            subscription_service.format_limit_message(limits),
+            reply_markup=get_premium_info_keyboard()
+        )
+        return ConversationHandler.END
+    
+    if context.user_data is not None:
+        _cancel_speculative_analysis(context)
+        shown_full_intro = context.user_data.get('shown_full_intro', False)
+        context.user_data.clear()
+        context.user_data['conversation_state'] = 'active'
+        context.user_data['initialized'] = True
+        context.user_data['shown_full_intro'] = shown_full_intro
+        context.user_data['analytics_user_id'] = user_id
+        context.user_data['bulk_vacancies'] = []
+    
+    await update.message.reply_text(
+        BULK_INSTRUCTIONS.format(
+            max_vacancies=BULK_MAX_VACANCIES,
+            subscription_info=subscription_service.format_subscription_info(limits) if limits else ""
+        ),
+        parse_mode='HTML'
+    )
+    return WAITING_BULK_VACANCIES
+
+
+async def _ask_bulk_resume(message: Message, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Вакансии собраны - просим резюме"""
+    count = len(context.user_data.get('bulk_vacancies', [])) if context.user_data else 0
+    await message.reply_text(
+        f"✅ <b>Вакансий в пакете: {count}</b>\n\n"
+        "<b>Шаг 2:</b> Теперь отправьте резюме — одно на все письма.",
+        parse_mode='HTML'
+    )
+    return WAITING_BULK_RESUME
+
+
+@rate_limit('commands')
+@ValidationMiddleware.require_initialization
+async def handle_bulk_vacancies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сбор вакансий пакета: текст с разделителями --- или .txt файл"""
+    message = update.message
+    if not message or context.user_data is None:
+        return WAITING_BULK_VACANCIES
+    
+    if message.document:
+        text = await _read_bulk_document(message)
+        if text is None:
+            await message.reply_text(
+                "⚠️ Не удалось прочитать файл. Нужен .txt в кодировке UTF-8 "
+                f"размером до {InputValidator.MAX_BULK_FILE_SIZE // 1024} КБ."
+            )
+            return WAITING_BULK_VACANCIES
+    elif message.text:
+        text = message.text
+    else:
+        await message.reply_text("📝 Отправьте вакансии текстом или .txt файлом.")
+        return WAITING_BULK_VACANCIES
+    
+    vacancies = context.user_data.setdefault('bulk_vacancies', [])
+    added = skipped = 0
+    for vacancy_text in InputValidator.split_vacancies(text):
+        is_valid, _ = InputValidator.validate_vacancy_text(vacancy_text)
+        if not is_valid or len(vacancies) >= BULK_MAX_VACANCIES:
+            skipped += 1
+            continue
+        vacancies.append(vacancy_text)
+        added += 1
+    
+    if len(vacancies) >= BULK_MAX_VACANCIES:
+        return await _ask_bulk_resume(message, context)
+    
+    reply = f"📥 Добавлено вакансий: {added}, всего в пакете: {len(vacancies)} из {BULK_MAX_VACANCIES}"
+    if skipped:
+        reply += (
+            f"\n⚠️ Пропущено: {skipped} — описание короче {InputValidator.MIN_VACANCY_LENGTH} "
+            f"или длиннее {InputValidator.MAX_VACANCY_LENGTH} символов, либо пакет заполнен"
+        )
+    reply += "\n\nОтправьте еще вакансии или нажмите «Готово»."
+    await message.reply_text(reply, reply_markup=get_bulk_vacancies_keyboard() if vacancies else None)
+    return WAITING_BULK_VACANCIES
+
+
+async def handle_bulk_vacancies_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Кнопка «Готово»: переходим к резюме"""
+    query = update.callback_query
+    if not query or not query.message:
+        return WAITING_BULK_VACANCIES
+    if not context.user_data or not context.user_data.get('bulk_vacancies'):
+        await query.answer("Сначала отправьте хотя бы одну вакансию", show_alert=True)
+        return WAITING_BULK_VACANCIES
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=None)
+    return await _ask_bulk_resume(query.message, context)
+
+
+@rate_limit('ai_requests', check_text_size=True)
+@ValidationMiddleware.require_initialization
+@ValidationMiddleware.require_text_message
+async def handle_bulk_resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Резюме пакета: резервируем лимит на все письма и ставим задачу в очередь"""
+    if not update.message or not update.message.text or not update.message.from_user:
+        return WAITING_BULK_RESUME
+    
+    resume_text = update.message.text
+    is_valid, error_msg = InputValidator.validate_resume_text(resume_text)
+    if not is_valid:
+        await update.message.reply_text(error_msg, parse_mode='HTML')
+        return WAITING_BULK_RESUME
+    
+    user_id = context.user_data.get('analytics_user_id') if context.user_data else None
+    vacancies = context.user_data.get('bulk_vacancies', []) if context.user_data else []
+    if not user_id or not vacancies:
+        await update.message.reply_text("❌ Пакет не найден. Начните заново: /bulk")
+        return ConversationHandler.END
+    
+    # Весь пакет - один резерв лимита; неиспользованное вернется после генерации
+    reserved = await subscription_service.reserve_letters(user_id, len(vacancies))
+    if reserved <= 0:
+        limits = await subscription_service.check_user_limits(user_id, force_refresh=True)
+        await update.message.reply_text(
+            subscription_service.format_limit_message(limits),
+            reply_markup=get_premium_info_keyboard()
+        )
+        return ConversationHandler.END
+    
+    text = f"🚀 <b>Пишу {reserved} писем одновременно</b>\n\nКаждое письмо придет, как только будет готово."
+    if reserved < len(vacancies):
+        text += f"\n\n⚠️ По лимиту подписки доступно {reserved} из {len(vacancies)} — беру первые {reserved}."
+    processing_msg = await update.message.reply_text(text, parse_mode='HTML')
+    
+    await generation_queue.enqueue('bulk', update.message.from_user.id, update.message.chat_id, {
+        'user_id': user_id,
+        'vacancies': vacancies[:reserved],
+        'resume_text': resume_text,
+        'reserved': reserved,
+        'done': [],
+        'session_ids': {},
+        'processing_message_id': processing_msg.message_id
+    })
+    context.user_data.pop('bulk_vacancies', None)
+    return WAITING_FEEDBACK
+
+
+async def _release_bulk_reservation(job: GenerationJob) -> None:
+    """Вернуть в лимит письма пакета, которые так и не были отправлены"""
+    reserved = job.payload.get('reserved', 0)
+    if reserved > 0:
+        await subscription_service.release_letters(job.payload['user_id'], reserved)
+        job.payload['reserved'] = 0
+
+
+async def _send_bulk_letter(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob,
+                            index: int, letter: str, session_id: Optional[str]) -> None:
+    """Отправить готовое письмо пакета с кнопками оценки"""
+    vacancies = job.payload['vacancies']
+    await context.bot.send_message(
+        job.chat_id,
+        f"✍️ <b>ПИСЬМО {index + 1}/{len(vacancies)}:</b> {_bulk_vacancy_title(vacancies[index])}\n\n{letter}",
+        parse_mode='HTML',
+        reply_markup=get_post_generation_keyboard(session_id, 1) if session_id else None
+    )
+    if session_id:
+        await analytics.update_letter_session(session_id, {
+            'generated_letter': letter[:2000],
+            'generated_letter_length': len(letter),
+            'status': 'completed'
+        })
+        improvement_contexts.remember(session_id, vacancies[index], job.payload['resume_text'], letter)
+
+
+async def _run_bulk_job(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Задача 'bulk': письма по одному резюме на все вакансии пакета"""
+    processing_msg = _job_message(context, job)
+    user_id = job.payload['user_id']
+    vacancies = job.payload['vacancies']
+    resume_text = job.payload['resume_text']
+    done = job.payload.setdefault('done', [])
+    session_ids = job.payload.setdefault('session_ids', {})
+    
+    pending = {index: text for index, text in enumerate(vacancies) if index not in done}
+    
+    try:
+        # После перезапуска резерв мог быть возвращен - резервируем недостающее
+        missing = len(pending) - job.payload.get('reserved', 0)
+        if missing > 0:
+            job.payload['reserved'] = job.payload.get('reserved', 0) + await subscription_service.reserve_letters(user_id, missing)
+        for index in sorted(pending)[job.payload['reserved']:]:
+            pending.pop(index)
+        if not pending:
+            await _edit_job_message(processing_msg, subscription_service.format_limit_message(
+                await subscription_service.check_user_limits(user_id, force_refresh=True)
+            ))
+            return
+        
+        limits = await subscription_service.check_user_limits(user_id)
+        is_premium = bool(limits and limits.get('plan_type') == 'premium')
+        for index, vacancy_text in pending.items():
+            if str(index) not in session_ids:
+                session_ids[str(index)] = await analytics.create_letter_session(LetterSessionData(
+                    user_id=user_id,
+                    mode="bulk",
+                    job_description=vacancy_text,
+                    job_description_length=len(vacancy_text),
+                    resume_text=resume_text,
+                    resume_length=len(resume_text),
+                    max_iterations=3 if is_premium else 2
+                ))
+        
+        priority = PRIORITY_PREMIUM if is_premium else PRIORITY_STANDARD
+        failed = []
+        on_position = _queue_position_reporter(processing_msg) if processing_msg is not None else None
+        with ai_request_context(user_id, priority, on_position=on_position):
+            async for index, letter in generate_letters_for_vacancies(
+                pending, resume_text, {index: session_ids.get(str(index)) for index in pending}, user_id=user_id
+            ):
+                if _is_error_response(letter):
+                    failed.append(index)
+                    continue
+                await _send_bulk_letter(context, job, index, letter, session_ids.get(str(index)))
+                done.append(index)
+                job.payload['reserved'] -= 1
+        
+        if failed and not job.is_last_attempt:
+            await _edit_job_message(
+                processing_msg,
+                f"⏳ Готово писем: {len(done)} из {len(vacancies)}. "
+                f"Оставшиеся {len(failed)} попробую написать еще раз — они придут автоматически."
+            )
+            raise RetryJob(f"bulk: {len(failed)} letters failed")
+        
+        await _release_bulk_reservation(job)
+        summary = f"📚 <b>Пакет готов: {len(done)} из {len(vacancies)} писем</b>"
+        if failed:
+            numbers = ', '.join(str(index + 1) for index in sorted(failed))
+            summary += f"\n\n😔 Не удалось написать письма для вакансий №{numbers} — они не списаны с вашего лимита."
+        await _edit_job_message(processing_msg, summary, parse_mode='HTML')
+        for index in failed:
+            if session_ids.get(str(index)):
+                await analytics.update_letter_session(session_ids[str(index)], {'status': 'failed'})
+    except asyncio.CancelledError:
+        # /start, /cancel или остановка бота: неотправленные письма возвращаются в лимит
+        await _release_bulk_reservation(job)
+        raise
+
+
+async def _notify_bulk_failed(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Пакет упал с ошибкой - возвращаем резерв и сообщаем пользователю"""
+    await _release_bulk_reservation(job)
+    await _delete_job_message(_job_message(context, job))
+    await context.bot.send_message(
+        job.chat_id,
+        f"😔 <b>Не удалось дописать пакет писем</b> (готово {len(job.payload.get('done', []))} "
+        f"из {len(job.payload.get('vacancies', []))})\n\n"
+        "Неотправленные письма не списаны с вашего лимита — повторите чуть позже: /bulk",
+        parse_mode='HTML'
+    )
 
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отмена диалога"""
+    if update.effective_user:
+        await generation_queue.cancel_user(update.effective_user.id, reason="cancel")
     if context.user_data is not None:
+        _cancel_speculative_analysis(context)
         context.user_data.clear()
     
     if update.message:
@@ -801,29 +1420,37 @@ async def handle_improve_letter(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Восстанавливаем данные из сессии если их нет в context
         if not context.user_data.get('vacancy_text') or not context.user_data.get('resume_text'):
-            logger.info("🔍 Восстанавливаем данные из сессии...")
-            try:
-                session_response = await analytics.get_letter_session_by_id(session_id)
-                if session_response:
-                    context.user_data['vacancy_text'] = session_response.get('job_description', '')
-                    context.user_data['resume_text'] = session_response.get('resume_text', '')
-                    logger.info("✅ Данные восстановлены из сессии")
-                else:
-                    logger.error("❌ Сессия не найдена в БД")
+            improvement_context = improvement_contexts.get(session_id)
+            if improvement_context:
+                # Компактный контекст сессии уже в памяти - строку сессии из БД не читаем
+                if not context.user_data.get('vacancy_text'):
+                    context.user_data['vacancy_text'] = improvement_context.vacancy_brief
+                if not context.user_data.get('resume_text'):
+                    context.user_data['resume_text'] = improvement_context.resume_highlights
+            else:
+                logger.info("🔍 Восстанавливаем данные из сессии...")
+                try:
+                    session_response = await analytics.get_letter_session_by_id(session_id)
+                    if session_response:
+                        context.user_data['vacancy_text'] = session_response.get('job_description', '')
+                        context.user_data['resume_text'] = session_response.get('resume_text', '')
+                        logger.info("✅ Данные восстановлены из сессии")
+                    else:
+                        logger.error("❌ Сессия не найдена в БД")
+                        await query.edit_message_text(
+                            "❌ <b>Сессия не найдена</b>\n\n"
+                            "Создайте новое письмо: /start",
+                            parse_mode='HTML'
+                        )
+                        return ConversationHandler.END
+                except Exception as e:
+                    logger.error(f"❌ Ошибка восстановления данных: {e}")
                     await query.edit_message_text(
-                        "❌ <b>Сессия не найдена</b>\n\n"
+                        "❌ <b>Ошибка восстановления данных</b>\n\n"
                         "Создайте новое письмо: /start",
                         parse_mode='HTML'
                     )
                     return ConversationHandler.END
-            except Exception as e:
-                logger.error(f"❌ Ошибка восстановления данных: {e}")
-                await query.edit_message_text(
-                    "❌ <b>Ошибка восстановления данных</b>\n\n"
-                    "Создайте новое письмо: /start",
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
     
     # НОВАЯ ЛОГИКА: показываем только текст БЕЗ кнопок
     prompt_text = feedback_service.get_improvement_prompt_text(iteration_status.remaining_iterations)
@@ -881,55 +1508,69 @@ async def handle_retry_generation(update: Update, context: ContextTypes.DEFAULT_
         parse_mode='HTML'
     )
     
-    # Повторяем генерацию напрямую с сохраненными данными
+    # Получаем user_id
+    user_id = context.user_data.get('analytics_user_id')
+    if not user_id or not update.effective_user or not update.effective_chat:
+        if query.message:
+            await query.message.reply_text("❌ Ошибка: пользователь не найден")
+        return ConversationHandler.END
+    
+    # Генерацию выполняет воркер очереди - обработчик сразу освобождается
+    await generation_queue.enqueue('retry', update.effective_user.id, update.effective_chat.id, {
+        'user_id': user_id,
+        'vacancy_text': vacancy_text,
+        'resume_text': resume_text
+    })
+    return WAITING_FEEDBACK
+
+
+async def _run_retry_job(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Повторная генерация письма воркером очереди (задача 'retry')"""
+    user_id = job.payload['user_id']
+    vacancy_text = job.payload['vacancy_text']
+    resume_text = job.payload['resume_text']
+    letter = None
+    
     try:
-        # Импортируем необходимые функции
-        from services.smart_analyzer import generate_simple_letter
-        from services.analytics_service import analytics
-        from services.subscription_service import subscription_service  
-        from services.feedback_service import feedback_service
-        from models.analytics_models import LetterSessionData
-        import time
-        
-        # Получаем user_id
-        user_id = context.user_data.get('analytics_user_id')
-        if not user_id:
-            if query.message:
-                await query.message.reply_text("❌ Ошибка: пользователь не найден")
-            return ConversationHandler.END
-        
-        # Создаем данные для новой сессии
-        session_data = LetterSessionData(
-            user_id=user_id,
-            job_description=vacancy_text,
-            job_description_length=len(vacancy_text),
-            resume_text=resume_text,
-            resume_length=len(resume_text)
-        )
-        
-        # Создаем новую сессию для повторной генерации
-        session_id = await analytics.create_letter_session(session_data)
+        # При повторе задачи сессия уже создана первой попыткой
+        session_id = job.payload.get('session_id')
         if not session_id:
-            if query.message:
-                await query.message.reply_text("❌ Ошибка создания сессии")
-            return ConversationHandler.END
+            # Создаем данные для новой сессии
+            session_data = LetterSessionData(
+                user_id=user_id,
+                job_description=vacancy_text,
+                job_description_length=len(vacancy_text),
+                resume_text=resume_text,
+                resume_length=len(resume_text)
+            )
+            
+            # Создаем новую сессию для повторной генерации
+            session_id = await analytics.create_letter_session(session_data)
+            if not session_id:
+                await context.bot.send_message(job.chat_id, "❌ Ошибка создания сессии")
+                return
+            job.payload['session_id'] = session_id
         
-        # Генерируем письмо
         start_time = time.time()
-        letter = await generate_simple_letter(
-            vacancy_text=vacancy_text,
-            resume_text=resume_text,
-            user_id=user_id,
-            session_id=session_id
-        )
-        generation_time = int(time.time() - start_time)
-        
-        # Отправляем результат
-        if query.message:
-            await query.message.reply_text(
-                f"✍️ <b>ПИСЬМО:</b>\n\n{letter}",
-                parse_mode='HTML'
+        if LETTER_VARIANTS_COUNT > 1:
+            # Несколько вариантов за один раунд - пользователь выбирает кнопкой
+            variants = await generate_letter_variants(
+                vacancy_text, resume_text, LETTER_VARIANTS_COUNT, user_id=user_id, session_id=session_id
+            )
+            if len(variants) > 1:
+                await _send_letter_variants(context, job, session_id, variants, int(time.time() - start_time))
+                return
+            letter = variants[0] if variants else "Не удалось сгенерировать письмо. Попробуйте еще раз."
+        else:
+            # Генерируем письмо
+            letter = await generate_simple_letter(
+                vacancy_text=vacancy_text,
+                resume_text=resume_text,
+                user_id=user_id,
+                session_id=session_id,
+                regenerate=True  # Пользователь просит новый вариант - кэш не используем
             )
+        generation_time = int(time.time() - start_time)
         
         # Проверяем успешность генерации и показываем соответствующие кнопки
         is_generation_successful = (
@@ -939,9 +1580,19 @@ async def handle_retry_generation(update: Update, context: ContextTypes.DEFAULT_
             letter != "Произошла ошибка при генерации письма. Попробуйте еще раз." and
             len(letter.strip()) > 50
         )
+        if not is_generation_successful and not job.is_last_attempt:
+            raise RetryJob("retry generation failed")
+        
+        # Отправляем результат
+        await context.bot.send_message(
+            job.chat_id,
+            f"✍️ <b>ПИСЬМО:</b>\n\n{letter}",
+            parse_mode='HTML'
+        )
         
         # Обновляем данные в context
-        context.user_data['current_session_id'] = session_id
+        if context.user_data is not None:
+            context.user_data['current_session_id'] = session_id
         
         # Получаем статус итераций
         iteration_status = await feedback_service.get_session_iteration_status(session_id)
@@ -984,12 +1635,12 @@ async def handle_retry_generation(update: Update, context: ContextTypes.DEFAULT_
             
             keyboard = get_retry_keyboard(session_id)
         
-        if query.message:
-            await query.message.reply_text(
-                feedback_message,
-                parse_mode='HTML',
-                reply_markup=keyboard
-            )
+        await context.bot.send_message(
+            job.chat_id,
+            feedback_message,
+            parse_mode='HTML',
+            reply_markup=keyboard
+        )
         
         # Обновляем аналитику
         if is_generation_successful:
@@ -1001,18 +1652,99 @@ async def handle_retry_generation(update: Update, context: ContextTypes.DEFAULT_
                 'status': 'completed'
             })
             await analytics.track_letter_generated(user_id, session_id, len(letter), generation_time)
+            improvement_contexts.remember(session_id, vacancy_text, resume_text, letter)
         
-        return WAITING_FEEDBACK
-        
+    except RetryJob:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка повторной генерации: {e}")
-        if query.message:
-            await query.message.reply_text(
-                "❌ <b>Ошибка при повторной генерации</b>\n\n"
-                "🔄 Попробуйте начать заново: /start",
-                parse_mode='HTML'
-            )
+        # Письмо еще не получено - очередь повторит задачу
+        if letter is None and not job.is_last_attempt:
+            raise RetryJob(str(e)) from e
+        await context.bot.send_message(
+            job.chat_id,
+            "❌ <b>Ошибка при повторной генерации</b>\n\n"
+            "🔄 Попробуйте начать заново: /start",
+            parse_mode='HTML'
+        )
+
+
+async def _send_letter_variants(
+    context: ContextTypes.DEFAULT_TYPE,
+    job: GenerationJob,
+    session_id: str,
+    variants: list,
+    generation_time: int
+):
+    """Отправляет варианты письма и кнопки выбора; выбранный вариант станет письмом сессии"""
+    for index, letter in enumerate(variants, 1):
+        await context.bot.send_message(
+            job.chat_id,
+            f"✍️ <b>ВАРИАНТ {index}:</b>\n\n{letter}",
+            parse_mode='HTML'
+        )
+    
+    if context.user_data is not None:
+        context.user_data['current_session_id'] = session_id
+        context.user_data['letter_variants'] = {'session_id': session_id, 'letters': variants}
+    
+    await context.bot.send_message(
+        job.chat_id,
+        f"🎲 <b>Готово вариантов: {len(variants)} (за {generation_time} сек)</b>\n\n"
+        "👇 Выберите письмо, которое нравится больше, — с ним можно будет работать дальше.",
+        parse_mode='HTML',
+        reply_markup=get_variant_choice_keyboard(session_id, len(variants))
+    )
+    
+    # НЕ увеличиваем счетчик - это повторная генерация, не новое письмо
+    await analytics.update_letter_session(session_id, {
+        'generation_time_seconds': generation_time,
+        'status': 'completed'
+    })
+    await analytics.track_letter_generated(job.payload['user_id'], session_id, len(variants[0]), generation_time)
+
+
+async def handle_pick_variant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Выбор одного из вариантов письма после повторной генерации"""
+    query = update.callback_query
+    if not query or not query.data:
         return ConversationHandler.END
+    
+    await query.answer()
+    
+    # Парсим callback_data: pick_variant_{session_id}_{index}
+    session_id, _, index = query.data[len('pick_variant_'):].rpartition('_')
+    stored = context.user_data.get('letter_variants') if context.user_data else None
+    if not stored or stored['session_id'] != session_id or not index.isdigit() or int(index) >= len(stored['letters']):
+        await query.edit_message_text(
+            "⌛ Эти варианты больше недоступны\n\n"
+            "🔄 Начните заново: /start"
+        )
+        return WAITING_FEEDBACK
+    
+    letter = stored['letters'][int(index)]
+    context.user_data.pop('letter_variants', None)
+    context.user_data['session_id_for_feedback'] = session_id
+    context.user_data['improvement_session_id'] = session_id
+    
+    await analytics.update_letter_session(session_id, {
+        'generated_letter': letter[:2000],
+        'generated_letter_length': len(letter)
+    })
+    improvement_contexts.remember(
+        session_id, context.user_data.get('vacancy_text', ''), context.user_data.get('resume_text', ''), letter
+    )
+    
+    iteration_status = await feedback_service.get_session_iteration_status(session_id)
+    await query.edit_message_text(
+        f"✅ <b>Выбран вариант {int(index) + 1}</b>\n\n"
+        "💡 <b>Оцените результат:</b>\n"
+        "• ❤️ Нравится - отлично!\n"
+        "• 👎 Не подходит - доработаем",
+        parse_mode='HTML',
+        reply_markup=get_post_generation_keyboard(session_id, iteration_status.current_iteration if iteration_status else 1)
+    )
+    return WAITING_FEEDBACK
 
 
 @rate_limit('ai_requests', check_text_size=True)
@@ -1045,6 +1777,13 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
         context.user_data.clear()
         return ConversationHandler.END
 
+    # Получаем vacancy_text из context
+    vacancy_text = context.user_data.get('vacancy_text', '')
+    if not vacancy_text:
+        logger.error("❌ vacancy_text not found in context")
+        await update.message.reply_text("❌ Данные вакансии потеряны. Начните заново: /start")
+        return WAITING_IMPROVEMENT_REQUEST
+
     processing_msg = await update.message.reply_text(
         "🔄 <b>Улучшаю письмо с учетом ваших пожеланий...</b>\n\n"
         "Это займет около 20-30 секунд.",
@@ -1052,9 +1791,40 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
     )
     
     try:
-        # Увеличиваем номер итерации
+        # Увеличиваем номер итерации (один раз, а не на каждую попытку воркера)
         await feedback_service.increment_session_iteration(session_id)
-        
+    except Exception as e:
+        logger.error(f"❌ Ошибка улучшения письма: {e}")
+        await processing_msg.edit_text(
+            "❌ <b>Ошибка при улучшении письма</b>\n\n"
+            "🔧 Попробуйте еще раз или создайте новое письмо: /start",
+            parse_mode='HTML'
+        )
+        return WAITING_FEEDBACK
+    
+    # Улучшение выполняет воркер очереди - обработчик сразу освобождается
+    await generation_queue.enqueue('improvement', update.message.from_user.id, update.message.chat_id, {
+        'user_id': user_id,
+        'session_id': session_id,
+        'improvement_request': improvement_request,
+        'vacancy_text': vacancy_text,
+        'resume_text': context.user_data.get('resume_text', ''),
+        'processing_message_id': processing_msg.message_id
+    })
+    return WAITING_FEEDBACK
+
+
+async def _run_improvement_job(context: ContextTypes.DEFAULT_TYPE, job: GenerationJob):
+    """Улучшение письма воркером очереди (задача 'improvement')"""
+    user_id = job.payload['user_id']
+    session_id = job.payload['session_id']
+    improvement_request = job.payload['improvement_request']
+    vacancy_text = job.payload['vacancy_text']
+    resume_text = job.payload['resume_text']
+    processing_msg = _job_message(context, job)
+    improved_letter = None
+    
+    try:
         # Получаем обновленный статус
         iteration_status = await feedback_service.get_session_iteration_status(session_id)
         if not iteration_status:
@@ -1063,43 +1833,57 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
         # Генерируем улучшенное письмо
         start_time = time.time()
         
-        # Получаем предыдущее письмо из сессии
-        session_response = await analytics.get_letter_session_by_id(session_id)
+        # Текущая версия письма - из компактного контекста сессии, без чтения строки сессии из БД
+        improvement_context = improvement_contexts.get(session_id)
         previous_letter = ""
-        if session_response:
-            previous_letter = session_response.get('generated_letter', '')
+        if improvement_context:
+            previous_letter = improvement_context.current_letter
+        else:
+            session_response = await analytics.get_letter_session_by_id(session_id)
+            if session_response:
+                previous_letter = session_response.get('generated_letter', '')
         
-        # Получаем vacancy_text из context
-        vacancy_text = context.user_data.get('vacancy_text', '')
-        if not vacancy_text:
-            logger.error("❌ vacancy_text not found in context")
-            await processing_msg.edit_text("❌ Данные вакансии потеряны. Начните заново: /start")
-            return WAITING_IMPROVEMENT_REQUEST
+        # Контекст потерян (рестарт бота) - собираем заново, следующие итерации пойдут из памяти
+        if not improvement_context and previous_letter:
+            improvement_context = improvement_contexts.remember(
+                session_id, vacancy_text, resume_text, previous_letter
+            )
 
         # Fallback если предыдущее письмо не найдено
         if not previous_letter:
             logger.warning(f"⚠️ Previous letter not found for session {session_id}, using simple generation")
             improved_letter = await generate_simple_letter(
                 vacancy_text=vacancy_text,
-                resume_text=context.user_data.get('resume_text', ''),
+                resume_text=resume_text,
                 user_id=user_id,
-                session_id=session_id
+                session_id=session_id,
+                regenerate=True
             )
         else:
             # Генерируем улучшенное письмо с учетом комментариев
             logger.info(f"🔄 Improving letter with previous version ({len(previous_letter)} chars)")
             improved_letter = await generate_improved_letter(
                 vacancy_text=vacancy_text,
-                resume_text=context.user_data.get('resume_text', ''),
+                resume_text=resume_text,
                 previous_letter=previous_letter,
                 user_feedback=improvement_request,
                 improvement_request=improvement_request,
                 user_id=user_id,
-                session_id=session_id
+                session_id=session_id,
+                improvement_context=improvement_context
             )
         
         generation_time = int(time.time() - start_time)
         
+        if _is_error_response(improved_letter):
+            if not job.is_last_attempt:
+                await _show_retry_pending(processing_msg)
+                raise RetryJob("letter improvement failed")
+        elif improvement_context:
+            improvement_contexts.update_letter(session_id, improved_letter)
+        else:
+            improvement_contexts.remember(session_id, vacancy_text, resume_text, improved_letter)
+        
         # Сохраняем итерацию
         iteration_data = LetterIterationImprovement(
             session_id=session_id,
@@ -1125,16 +1909,18 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
                 'iteration_number': iteration_status.current_iteration,
                 'improvement_length': len(improvement_request),
                 'generation_time_seconds': generation_time,
-                'has_previous_letter': bool(previous_letter)
+                'has_previous_letter': bool(previous_letter),
+                'compact_context': bool(improvement_context)
             }
         )
         await analytics.track_event(event_data)
         
         # Удаляем прогресс
-        await processing_msg.delete()
+        await _delete_job_message(processing_msg)
         
         # Показываем улучшенное письмо
-        await update.message.reply_text(
+        await context.bot.send_message(
+            job.chat_id,
             f"✍️ <b>УЛУЧШЕННОЕ ПИСЬМО:</b>\n\n{improved_letter}",
             parse_mode='HTML'
         )
@@ -1160,7 +1946,8 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
             feedback_message += "✅ Используйте это письмо или создайте новое"
             keyboard = get_final_letter_keyboard()
         
-        await update.message.reply_text(
+        await context.bot.send_message(
+            job.chat_id,
             feedback_message,
             parse_mode='HTML',
             reply_markup=keyboard
@@ -1171,21 +1958,23 @@ async def handle_improvement_request(update: Update, context: ContextTypes.DEFAU
             context.user_data.pop('in_improvement_mode', None)
             logger.info("🔄 Cleared in_improvement_mode flag after improvement completion")
         
+    except RetryJob:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка улучшения письма: {e}")
+        # Улучшенное письмо еще не получено - очередь повторит задачу
+        if improved_letter is None and not job.is_last_attempt:
+            await _show_retry_pending(processing_msg)
+            raise RetryJob(str(e)) from e
         
-        try:
-            await processing_msg.delete()
-        except:
-            pass
+        await _delete_job_message(processing_msg)
         
-        await update.message.reply_text(
+        await context.bot.send_message(
+            job.chat_id,
             "❌ <b>Ошибка при улучшении письма</b>\n\n"
             "🔧 Попробуйте еще раз или создайте новое письмо: /start",
             parse_mode='HTML'
         )
-    
-    return WAITING_FEEDBACK
 
 
 async def handle_accept_letter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1255,6 +2044,7 @@ def get_conversation_handler():
     return ConversationHandler(
         entry_points=[
             CommandHandler("start", start_conversation),
+            CommandHandler("bulk", bulk_command),
             CallbackQueryHandler(handle_start_work_callback, pattern=r'^start_work$')
         ],
         states={
@@ -1267,11 +2057,19 @@ def get_conversation_handler():
             WAITING_IMPROVEMENT_REQUEST: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_improvement_request)
             ],
+            WAITING_BULK_VACANCIES: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.TXT, handle_bulk_vacancies),
+                CallbackQueryHandler(handle_bulk_vacancies_done, pattern=r'^bulk_vacancies_done$')
+            ],
+            WAITING_BULK_RESUME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_bulk_resume)
+            ],
             WAITING_FEEDBACK: [
                 # Callback handlers для кнопок обратной связи (только лайки/дизлайки)
                 CallbackQueryHandler(handle_feedback_button, pattern=r'^feedback_(like|dislike)_'),
                 CallbackQueryHandler(handle_improve_letter, pattern=r'^improve_letter_'),
                 CallbackQueryHandler(handle_retry_generation, pattern=r'^retry_generation_'),
+                CallbackQueryHandler(handle_pick_variant, pattern=r'^pick_variant_'),
                 CallbackQueryHandler(start_conversation, pattern=r'^restart$'),
                 # Текстовые сообщения в этом состоянии
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_waiting_feedback_message)
@@ -1279,7 +2077,8 @@ def get_conversation_handler():
         },
         fallbacks=[
             CommandHandler('cancel', cancel_conversation),
-            CommandHandler('start', start_conversation)
+            CommandHandler('start', start_conversation),
+            CommandHandler('bulk', bulk_command)
         ],
         name="conversation_v7_2",
         persistent=False,
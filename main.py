@@ -36,9 +36,9 @@ print("=" * 50)
 print("🚨 RAILWAY FORCED DEBUG END 🚨")
 print("=" * 50)
 
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, GENERATION_DRAIN_TIMEOUT, ANALYTICS_SHUTDOWN_FLUSH_TIMEOUT
 
-from handlers.simple_conversation_v6 import get_conversation_handler, get_command_handlers
+from handlers.simple_conversation_v6 import get_conversation_handler, get_command_handlers, register_generation_jobs
 
 # Настройка логирования
 logging.basicConfig(
@@ -78,6 +78,18 @@ async def post_init(application):
     logger.info(f"Проверяю {provider_name} API...")
     await check_ai_api()
     
+    # Фоновые пробы моделей с разомкнутыми circuit breakers
+    AIFactory.start_health_probes()
+    
+    # Задержка event loop и стеки блокирующих вызовов
+    from services.loop_monitor import loop_monitor
+    loop_monitor.start()
+    
+    # Воркеры очереди генераций (доставят письма, не дописанные до перезапуска)
+    from services.generation_queue import generation_queue
+    register_generation_jobs(application)
+    await generation_queue.start()
+    
     # 🔍 ПРИНУДИТЕЛЬНАЯ ПРОВЕРКА SUPABASE АНАЛИТИКИ
     print("=" * 60)
     print("🔍 RAILWAY SUPABASE ANALYTICS CHECK")
@@ -90,10 +102,12 @@ async def post_init(application):
         print("📊 Проверяю подключение к Supabase...")
         logger.info("📊 Проверяю подключение к Supabase...")
         
-        client = SupabaseClient.get_client()
+        client = SupabaseClient.get_async_client()
         is_available = SupabaseClient.is_available()
         
         if client and is_available:
+            # Заодно прогреваем пул соединений
+            await client.table('users').select('id').limit(1).execute()
             print("✅ Supabase аналитика подключена и готова к работе!")
             logger.info("✅ Supabase аналитика подключена и готова к работе!")
         else:
@@ -106,6 +120,39 @@ async def post_init(application):
     
     print("=" * 60)
 
+async def post_stop(application):
+    """
+    Функция, вызываемая после остановки приема обновлений (бот еще может отправлять сообщения)
+    """
+    from services.generation_queue import generation_queue
+    from services.generation_tasks import generation_tasks
+    # Незавершенные задачи очереди останутся в SQLite и выполнятся после перезапуска
+    await generation_queue.stop(GENERATION_DRAIN_TIMEOUT)
+    await generation_tasks.drain(GENERATION_DRAIN_TIMEOUT)
+    logger.info(f"📊 Генерации за время работы: {generation_tasks.get_stats()}, "
+                f"очередь: {await generation_queue.get_stats()}")
+
+async def post_shutdown(application):
+    """
+    Функция, вызываемая при остановке приложения
+    """
+    from services.ai_factory import AIFactory
+    from services.analytics_buffer import analytics_buffer
+    from services.loop_monitor import loop_monitor
+    from services.session_writes import session_writes
+    await AIFactory.stop_health_probes()
+    logger.info(f"⏱️ Задержка event loop за время работы: {loop_monitor.get_percentiles()}, "
+                f"блокировок: {loop_monitor.stats['blocks']}")
+    await loop_monitor.stop()
+    # Дописываем отложенные изменения сессий писем
+    await session_writes.stop()
+    logger.info(f"💾 Буфер сессий: {session_writes.get_stats()}")
+    # Дописываем накопленные события аналитики (в том числе от завершившихся генераций)
+    await analytics_buffer.stop(ANALYTICS_SHUTDOWN_FLUSH_TIMEOUT)
+    logger.info(f"📦 Буфер аналитики: {analytics_buffer.get_stats()}")
+    from utils.database import SupabaseClient
+    await SupabaseClient.close_async_client()
+
 def start_webhook_server(bot):
     """Запускает webhook сервер в отдельном потоке"""
     try:
@@ -136,7 +183,7 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
     
     # Передаем bot instance в webhook_handler для отправки уведомлений
     try:
@@ -0,0 +1,51 @@
+-- Миграция v10: Атомарный резерв и возврат писем для пакетной генерации (/bulk)
+-- Цель: reserve_letters/release_letters читали letters_used и записывали новое значение,
+-- теряя параллельные increment_user_letters; резерв теперь меняет счетчик одним UPDATE
+
+-- Зарезервировать до count_param писем в пределах лимита; возвращает, сколько списано
+CREATE OR REPLACE FUNCTION reserve_user_letters(user_id_param BIGINT, count_param INTEGER)
+RETURNS TABLE(granted INTEGER, new_count INTEGER) AS $$
+DECLARE
+    subscription_row RECORD;
+    granted_count INTEGER;
+BEGIN
+    -- Блокируем строку подписки до конца транзакции
+    SELECT s.letters_used, s.letters_limit, s.status
+    FROM subscriptions s
+    WHERE s.user_id = user_id_param
+    FOR UPDATE
+    INTO subscription_row;
+
+    IF NOT FOUND OR subscription_row.status <> 'active' THEN
+        RETURN QUERY SELECT 0, COALESCE(subscription_row.letters_used, 0);
+        RETURN;
+    END IF;
+
+    granted_count := GREATEST(0, LEAST(count_param, subscription_row.letters_limit - subscription_row.letters_used));
+
+    IF granted_count > 0 THEN
+        UPDATE subscriptions
+        SET letters_used = letters_used + granted_count,
+            updated_at = NOW()
+        WHERE user_id = user_id_param;
+    END IF;
+
+    RETURN QUERY SELECT granted_count, subscription_row.letters_used + granted_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Вернуть count_param неиспользованных писем резерва; возвращает новый счетчик
+CREATE OR REPLACE FUNCTION release_user_letters(user_id_param BIGINT, count_param INTEGER)
+RETURNS TABLE(new_count INTEGER) AS $$
+BEGIN
+    RETURN QUERY
+    UPDATE subscriptions
+    SET letters_used = GREATEST(0, letters_used - count_param),
+        updated_at = NOW()
+    WHERE user_id = user_id_param
+    RETURNING letters_used;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Проверяем что функции созданы
+SELECT 'reserve_user_letters and release_user_letters created successfully' as status;
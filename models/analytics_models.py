@@ -77,6 +77,10 @@ class OpenAIRequestData:
     user_id: Optional[int] = None  # Соответствует BIGINT в БД
     session_id: Optional[str] = None  # UUID в БД, но передается как строка
     error_message: Optional[str] = None
+    provider: Optional[str] = None  # 'openai', 'anthropic'
+    attempt: int = 1  # Номер вызова API в рамках одного запроса (>1 - повтор или fallback)
+    cost_usd: Optional[float] = None  # Оценка по ценам AI_MODEL_INPUT/OUTPUT_PRICES
+    tokens_estimated: bool = False  # Токены оценены по тексту (поток OpenAI без usage)
     
     def to_dict(self) -> Dict[str, Any]:
         data = asdict(self)
@@ -12,7 +12,7 @@ logger = logging.getLogger(__name__)
 
 class AcquisitionService:
     def __init__(self):
-        self.supabase = SupabaseClient.get_client()
+        self.supabase = SupabaseClient.get_async_client()
         self.enabled = bool(self.supabase)
         
     async def track_user_acquisition(self, user_id: int, start_param: Optional[str] = None, 
@@ -55,7 +55,7 @@ class AcquisitionService:
             acquisition_data = {k: v for k, v in acquisition_data.items() if v is not None}
             
             # Сохраняем в БД
-            response = self.supabase.table('acquisition_channels').insert(acquisition_data).execute()
+            response = await self.supabase.table('acquisition_channels').insert(acquisition_data).execute()
             
             logger.info(f"✅ Tracked acquisition for user {user_id}: {utm_data}")
             return True
@@ -151,8 +151,9 @@ class AcquisitionService:
             
         try:
             # Обновляем счетчик и последнюю активность
-            response = self.supabase.table('acquisition_channels').update({
-                'session_count': self.supabase.table('acquisition_channels').select('session_count').eq('user_id', user_id).execute().data[0]['session_count'] + 1,
+            current = await self.supabase.table('acquisition_channels').select('session_count').eq('user_id', user_id).execute()
+            response = await self.supabase.table('acquisition_channels').update({
+                'session_count': current.data[0]['session_count'] + 1,
                 'last_session_at': datetime.now().isoformat()
             }).eq('user_id', user_id).execute()
             
@@ -168,7 +169,7 @@ class AcquisitionService:
             return None
             
         try:
-            response = self.supabase.table('acquisition_channels').select('*').eq('user_id', user_id).execute()
+            response = await self.supabase.table('acquisition_channels').select('*').eq('user_id', user_id).execute()
             
             if response.data:
                 return response.data[0]
@@ -185,7 +186,7 @@ class AcquisitionService:
             
         try:
             # Получаем статистику через VIEW
-            response = self.supabase.table('acquisition_stats').select('*').execute()
+            response = await self.supabase.table('acquisition_stats').select('*').execute()
             
             return {
                 'channels': response.data,
@@ -0,0 +1,122 @@
+"""
+Адаптивные max_tokens и таймауты запросов к AI
+
+Раньше лимиты были зашиты в код: 800 токенов на письмо, 1500 на персонализированный
+запрос, 2000 у Claude и 60 секунд на попытку. Теперь по каждой паре (тип запроса, модель)
+копится скользящее окно фактической длины ответа и задержки, и лимиты берутся из
+высокого перцентиля с запасом: письмо не обрезается раньше времени, "убежавшая"
+генерация не тратит лишние токены, а таймаут соответствует реальной скорости модели.
+
+Обрезанные по max_tokens ответы - цензурированные замеры (настоящее значение больше
+наблюдаемого), поэтому они записываются с множителем и сдвигают перцентиль вверх.
+Таймаут записывается как есть (нижняя граница задержки), а выученный таймаут не растет
+выше TIMEOUT_MAX_GROWTH x настроенного: иначе при замедлении провайдера каждый таймаут
+удлинял бы следующий, а пользователи ждали бы все дольше вместо перехода на fallback.
+"""
+import logging
+import math
+from typing import Optional, Set, Tuple
+
+from config import (
+    AI_ADAPTIVE_LIMITS_ENABLED,
+    AI_ADAPTIVE_PERCENTILE,
+    AI_ADAPTIVE_TOKENS_HEADROOM,
+    AI_ADAPTIVE_TIMEOUT_HEADROOM,
+    AI_ADAPTIVE_MIN_TOKENS,
+    AI_ADAPTIVE_MAX_TOKENS,
+    AI_ADAPTIVE_MIN_TIMEOUT,
+    AI_ADAPTIVE_MAX_TIMEOUT
+)
+from .ai_hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# Во сколько раз настоящее значение больше обрезанного ответа (оценка)
+CENSORED_SAMPLE_FACTOR = 1.5
+# Во сколько раз выученный таймаут может превышать настроенный для запроса
+TIMEOUT_MAX_GROWTH = 2.0
+
+
+class AdaptiveLimits:
+    """Перцентили длины ответа и задержки по (тип запроса, модель)"""
+
+    def __init__(self, enabled: bool = True, percentile: float = 0.99,
+                 tokens_headroom: float = 1.2, timeout_headroom: float = 1.5,
+                 min_tokens: int = 300, max_tokens: int = 4000,
+                 min_timeout: float = 15, max_timeout: float = 120):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.tokens_headroom = tokens_headroom
+        self.timeout_headroom = timeout_headroom
+        self.min_tokens = min_tokens
+        self.max_tokens_limit = max_tokens
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.output_tokens = LatencyTracker()
+        self.latency = LatencyTracker()
+        self._keys: Set[Tuple[str, str]] = set()
+        self.stats = {'recorded': 0, 'truncated': 0, 'timeouts': 0}
+
+    def record(self, request_type: str, model: str, output_tokens: int, seconds: float, truncated: bool = False):
+        """Учесть завершенный запрос"""
+        self.stats['recorded'] += 1
+        self._keys.add((request_type, model))
+        if truncated:
+            self.stats['truncated'] += 1
+            output_tokens = math.ceil(output_tokens * CENSORED_SAMPLE_FACTOR)
+            # Задержка обрезанного ответа тоже меньше настоящей
+            seconds *= CENSORED_SAMPLE_FACTOR
+        self.output_tokens.record(model, request_type, output_tokens)
+        self.latency.record(model, request_type, seconds)
+
+    def record_timeout(self, request_type: str, model: str, timeout: float):
+        """Учесть таймаут: модель отвечает дольше, чем мы ждали"""
+        self.stats['timeouts'] += 1
+        self._keys.add((request_type, model))
+        # Нижняя граница: настоящая задержка неизвестна, домножение раскручивало таймауты
+        self.latency.record(model, request_type, timeout)
+
+    def max_tokens(self, request_type: str, model: str, default: int) -> int:
+        """max_tokens запроса: перцентиль длины ответа с запасом или default, пока замеров мало"""
+        if not self.enabled:
+            return default
+        learned = self.output_tokens.percentile(model, request_type, self.percentile)
+        if learned is None:
+            return default
+        return int(min(self.max_tokens_limit, max(self.min_tokens, learned * self.tokens_headroom)))
+
+    def timeout(self, request_type: str, model: str, default: Optional[float]) -> Optional[float]:
+        """Таймаут попытки: перцентиль задержки с запасом или default, пока замеров мало"""
+        if not self.enabled:
+            return default
+        learned = self.latency.percentile(model, request_type, self.percentile)
+        if learned is None:
+            return default
+        ceiling = self.max_timeout if default is None else min(self.max_timeout, default * TIMEOUT_MAX_GROWTH)
+        return min(ceiling, max(self.min_timeout, learned * self.timeout_headroom))
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            'enabled': self.enabled,
+            'limits': {
+                f"{model}:{request_type}": {
+                    'max_tokens': self.max_tokens(request_type, model, None),
+                    'timeout': self.timeout(request_type, model, None)
+                }
+                for request_type, model in sorted(self._keys)
+            }
+        }
+
+
+# Глобальные адаптивные лимиты (общие для всех провайдеров)
+adaptive_limits = AdaptiveLimits(
+    enabled=AI_ADAPTIVE_LIMITS_ENABLED,
+    percentile=AI_ADAPTIVE_PERCENTILE,
+    tokens_headroom=AI_ADAPTIVE_TOKENS_HEADROOM,
+    timeout_headroom=AI_ADAPTIVE_TIMEOUT_HEADROOM,
+    min_tokens=AI_ADAPTIVE_MIN_TOKENS,
+    max_tokens=AI_ADAPTIVE_MAX_TOKENS,
+    min_timeout=AI_ADAPTIVE_MIN_TIMEOUT,
+    max_timeout=AI_ADAPTIVE_MAX_TIMEOUT
+)
@@ -1,49 +1,180 @@
 """
 Фабрика для создания AI-сервисов
 """
+import asyncio
+import logging
 import os
-from typing import Optional
+from typing import Dict, List, Optional, Type
 from .ai_service import AIService
 from .openai_service import OpenAIService
 from .claude_service import ClaudeService
+from .ai_router import RouterAIService
+from .circuit_breaker import CircuitBreaker, circuit_breakers
+from .rate_governor import rate_governor
+from .single_flight import ai_single_flight
+from .generation_tasks import generation_tasks
+from .adaptive_limits import adaptive_limits
+from .token_metering import token_meter
+from .loop_monitor import loop_monitor
+from .executors import get_executors_stats
+from config import CIRCUIT_BREAKER_ENABLED, CIRCUIT_BREAKER_PROBE_INTERVAL
+
+logger = logging.getLogger(__name__)
 
 
 class AIFactory:
     """Фабрика для создания AI-сервисов"""
-    
+
     _instance: Optional[AIService] = None
-    
+    _providers: Dict[str, AIService] = {}
+    _provider_classes: Dict[str, Type[AIService]] = {
+        'openai': OpenAIService,
+        'claude': ClaudeService
+    }
+    _probe_task: Optional[asyncio.Task] = None
+
     @classmethod
     def get_service(cls) -> AIService:
         """
         Получить экземпляр AI-сервиса в зависимости от конфигурации
-        
+
         Returns:
-            Экземпляр AI-сервиса (OpenAI или Claude)
+            Экземпляр AI-сервиса (OpenAI, Claude или маршрутизатор между ними)
         """
         if cls._instance is None:
             # Читаем провайдера динамически из переменных окружения
             ai_provider = os.getenv('AI_PROVIDER', 'openai')
-            if ai_provider.lower() == 'claude':
-                cls._instance = ClaudeService()
+            if ai_provider.lower() == 'router':
+                cls._instance = RouterAIService({
+                    name: cls.get_provider_service(name) for name in cls._provider_classes
+                })
+            elif ai_provider.lower() == 'claude':
+                cls._instance = cls.get_provider_service('claude')
             else:
-                cls._instance = OpenAIService()
-        
+                cls._instance = cls.get_provider_service('openai')
+
         return cls._instance
-    
+
+    @classmethod
+    def get_provider_service(cls, provider: str) -> AIService:
+        """Общий экземпляр сервиса конкретного провайдера ('openai' или 'claude')"""
+        if provider not in cls._providers:
+            service = cls._provider_classes[provider]()
+            cls._providers[provider] = service
+            # Заводим breakers заранее, чтобы модели были видны в health
+            for model in service.models:
+                circuit_breakers.get(model)
+        return cls._providers[provider]
+
     @classmethod
     def reset(cls):
         """Сбросить singleton для тестирования"""
         cls._instance = None
-    
+        cls._providers = {}
+
     @classmethod
     def get_provider_name(cls) -> str:
         """Получить название текущего провайдера"""
         ai_provider = os.getenv('AI_PROVIDER', 'openai')
         return ai_provider.upper()
 
+    # === CIRCUIT BREAKERS ===
+
+    @classmethod
+    def get_breaker(cls, model: str) -> CircuitBreaker:
+        """Circuit breaker модели"""
+        return circuit_breakers.get(model)
+
+    @classmethod
+    def _candidate_models(cls) -> List[str]:
+        """Модели, которыми может быть обслужен запрос текущего сервиса (с учетом fallback)"""
+        service = cls.get_service()
+        models = list(service.models)
+        # Claude при недоступности обеих моделей переключается на OpenAI
+        if isinstance(service, ClaudeService):
+            models.extend(OpenAIService.models)
+        return models
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """Есть ли хотя бы одна модель с неразомкнутой цепью для генерации"""
+        return any(not circuit_breakers.get(model).is_open() for model in cls._candidate_models())
+
+    @classmethod
+    def get_health(cls) -> dict:
+        """Состояние моделей для обработчиков и метрик"""
+        health = {
+            'provider': cls.get_provider_name(),
+            'available': cls.is_available(),
+            'models': circuit_breakers.get_stats(),
+            'rate_limits': rate_governor.get_stats(),
+            'single_flight': ai_single_flight.get_stats(),
+            'generations': generation_tasks.get_stats(),
+            'adaptive_limits': adaptive_limits.get_stats(),
+            'token_usage': token_meter.get_stats(),
+            'event_loop': loop_monitor.get_stats(),
+            'executors': get_executors_stats()
+        }
+        if isinstance(cls._instance, RouterAIService):
+            health['router'] = cls._instance.get_stats()
+        return health
+
+    @classmethod
+    def _service_for_model(cls, model: str) -> Optional[AIService]:
+        for service in cls._providers.values():
+            if model in service.models:
+                return service
+        return None
+
+    @classmethod
+    async def probe_open_circuits(cls):
+        """Один проход фоновой проверки: пробует модели, у которых истекла пауза"""
+        for model, breaker in circuit_breakers.items():
+            service = cls._service_for_model(model)
+            if service is None or not breaker.begin_probe():
+                continue
+            logger.info(f"🩺 Пробный запрос к {model}...")
+            started = asyncio.get_event_loop().time()
+            try:
+                ok = await service.probe_model(model)
+            except asyncio.CancelledError:
+                breaker.record_cancelled()
+                raise
+            if ok:
+                breaker.record_success(asyncio.get_event_loop().time() - started)
+            else:
+                breaker.record_failure()
+
+    @classmethod
+    async def _probe_loop(cls):
+        while True:
+            try:
+                await asyncio.sleep(CIRCUIT_BREAKER_PROBE_INTERVAL)
+                await cls.probe_open_circuits()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка фоновой проверки моделей: {e}")
+
+    @classmethod
+    def start_health_probes(cls):
+        """Запустить фоновые пробы разомкнутых цепей (вызывается из post_init)"""
+        if not CIRCUIT_BREAKER_ENABLED or (cls._probe_task and not cls._probe_task.done()):
+            return
+        cls.get_service()
+        cls._probe_task = asyncio.get_event_loop().create_task(cls._probe_loop())
+        logger.info(f"🩺 Фоновые пробы circuit breakers запущены (каждые {CIRCUIT_BREAKER_PROBE_INTERVAL}s)")
+
+    @classmethod
+    async def stop_health_probes(cls):
+        """Остановить фоновые пробы"""
+        if cls._probe_task and not cls._probe_task.done():
+            cls._probe_task.cancel()
+            await asyncio.gather(cls._probe_task, return_exceptions=True)
+        cls._probe_task = None
+
 
 # Глобальная функция для получения сервиса
 def get_ai_service() -> AIService:
     """Получить AI-сервис для работы"""
-    return AIFactory.get_service() 
\ No newline at end of file
+    return AIFactory.get_service()
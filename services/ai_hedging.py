@@ -0,0 +1,407 @@
+"""
+Хеджирование запросов к AI-моделям
+
+Вместо последовательного fallback (основная модель упала или отработала весь
+таймаут → fallback модель) запрос к fallback модели запускается параллельно,
+если основная не ответила (или не выдала первый токен) за выученный p90
+своей задержки. Побеждает первый успешный ответ, проигравший запрос отменяется.
+Доля хеджированных запросов ограничена, чтобы расходы оставались предсказуемыми.
+
+Каждый запрос к модели проходит через ее circuit breaker: модели с разомкнутой
+цепью пропускаются сразу, и запрос уходит в fallback без ожидания таймаута.
+Затем запрос занимает слот модели в планировщике (ai_scheduler); если очередь
+модели переполнена, запрос так же уходит в fallback.
+
+Повторы ведут rate governor, circuit breaker и хеджирование, поэтому клиенты SDK
+создаются с max_retries=0: скрытые повторы SDK обходили бы квоту RPM и растягивали
+окна таймаутов.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import defaultdict, deque
+from typing import (
+    AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+)
+
+from config import (
+    AI_HEDGING_ENABLED,
+    AI_HEDGE_DEFAULT_DELAY,
+    AI_HEDGE_DELAYS,
+    AI_HEDGE_MAX_PERCENT,
+    AI_HEDGE_PERCENTILE
+)
+from .ai_service import parse_model_values
+from .circuit_breaker import CircuitOpenError, circuit_breakers
+from .ai_scheduler import SchedulerRejectedError, ai_scheduler
+from .rate_governor import quota_granted_at, reset_quota_granted_at
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Сколько последних замеров задержки хранить на модель и сколько нужно для "обучения"
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+# Окно, в котором считается доля хеджированных запросов
+HEDGE_RATIO_WINDOW_SECONDS = 600
+
+
+class LatencyTracker:
+    """Скользящее окно задержек по (модель, тип замера)"""
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: Dict[Tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, model: str, kind: str, seconds: float):
+        self._samples[(model, kind)].append(seconds)
+
+    def percentile(self, model: str, kind: str, q: float) -> Optional[float]:
+        """Перцентиль задержки или None, если замеров пока мало"""
+        samples = self._samples.get((model, kind))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
+
+    def get_stats(self) -> dict:
+        return {
+            f"{model}:{kind}": {'samples': len(samples), 'p50': self.percentile(model, kind, 0.5),
+                                'p90': self.percentile(model, kind, 0.9)}
+            for (model, kind), samples in self._samples.items()
+        }
+
+
+class HedgePolicy:
+    """Когда и как часто разрешено хеджировать запросы"""
+
+    def __init__(self, enabled: bool, default_delay: float, model_delays: Dict[str, float],
+                 max_percent: float, percentile: float, tracker: LatencyTracker):
+        self.enabled = enabled
+        self.default_delay = default_delay
+        self.model_delays = model_delays
+        self.max_ratio = max_percent / 100.0
+        self.percentile = percentile
+        self.tracker = tracker
+        # (timestamp, был ли запрос хеджирован)
+        self._requests: Deque[Tuple[float, bool]] = deque()
+
+    def hedge_delay(self, model: str, kind: str) -> float:
+        """Задержка до запуска хеджа: явная настройка модели → выученный перцентиль → значение по умолчанию"""
+        if model in self.model_delays:
+            return self.model_delays[model]
+        learned = self.tracker.percentile(model, kind, self.percentile)
+        return learned if learned is not None else self.default_delay
+
+    def _trim(self, now: float):
+        while self._requests and self._requests[0][0] <= now - HEDGE_RATIO_WINDOW_SECONDS:
+            self._requests.popleft()
+
+    def note_request(self):
+        """Учесть новый запрос в знаменателе доли хеджей"""
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append((now, False))
+
+    def try_acquire_hedge(self) -> bool:
+        """Разрешить хедж, если доля хеджированных запросов в окне не превышает лимит"""
+        now = time.monotonic()
+        self._trim(now)
+        total = len(self._requests)
+        hedged = sum(1 for _, was_hedged in self._requests if was_hedged)
+        if total == 0 or (hedged + 1) / total > self.max_ratio:
+            return False
+        # Помечаем последний нехеджированный запрос как хеджированный
+        for i in range(len(self._requests) - 1, -1, -1):
+            timestamp, was_hedged = self._requests[i]
+            if not was_hedged:
+                self._requests[i] = (timestamp, True)
+                break
+        return True
+
+    def get_stats(self) -> dict:
+        self._trim(time.monotonic())
+        hedged = sum(1 for _, was_hedged in self._requests if was_hedged)
+        return {
+            'enabled': self.enabled,
+            'requests_in_window': len(self._requests),
+            'hedged_in_window': hedged,
+            'max_percent': self.max_ratio * 100,
+            'latency': self.tracker.get_stats()
+        }
+
+
+latency_tracker = LatencyTracker()
+hedge_policy = HedgePolicy(
+    enabled=AI_HEDGING_ENABLED,
+    default_delay=AI_HEDGE_DEFAULT_DELAY,
+    model_delays=parse_model_values(AI_HEDGE_DELAYS),
+    max_percent=AI_HEDGE_MAX_PERCENT,
+    percentile=AI_HEDGE_PERCENTILE,
+    tracker=latency_tracker
+)
+
+
+async def _cancel_tasks(tasks):
+    """Отменяет незавершенные задачи и дожидается их (прерывает HTTP-запросы)"""
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _model_started(started: float) -> float:
+    """Начало работы модели: после выдачи квоты rate governor, а не до ожидания ее"""
+    return max(started, quota_granted_at() or started)
+
+
+async def _guarded_call(model: str, call: Callable[[str], Awaitable[T]]) -> T:
+    """Запрос к модели через ее circuit breaker и слот планировщика"""
+    breaker = circuit_breakers.get(model)
+    if not breaker.allow_request():
+        raise CircuitOpenError(model)
+    try:
+        async with ai_scheduler.slot(model):
+            reset_quota_granted_at()
+            started = time.monotonic()
+            try:
+                result = await call(model)
+            except SchedulerRejectedError:
+                # В том числе RateLimitWaitError: не дождались своей квоты RPM/TPM
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+    except (asyncio.CancelledError, SchedulerRejectedError):
+        # Отмена и отказ очереди ничего не говорят о здоровье модели
+        breaker.record_cancelled()
+        raise
+    breaker.record_success(time.monotonic() - _model_started(started))
+    return result
+
+
+async def _guarded_stream(model: str, open_stream: Callable[[str], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """
+    Поток модели через ее circuit breaker (результат учитывается по первому фрагменту)
+
+    Слот планировщика занят на все время чтения потока.
+    """
+    breaker = circuit_breakers.get(model)
+    if not breaker.allow_request():
+        raise CircuitOpenError(model)
+    recorded = False
+    try:
+        async with ai_scheduler.slot(model):
+            reset_quota_granted_at()
+            started = time.monotonic()
+            stream = open_stream(model)
+            try:
+                async for delta in stream:
+                    if not recorded:
+                        breaker.record_success(time.monotonic() - _model_started(started))
+                        recorded = True
+                    yield delta
+            except (asyncio.CancelledError, GeneratorExit, SchedulerRejectedError):
+                raise
+            except Exception:
+                if not recorded:
+                    breaker.record_failure()
+                    recorded = True
+                raise
+            finally:
+                await stream.aclose()
+    except (asyncio.CancelledError, GeneratorExit, SchedulerRejectedError):
+        if not recorded:
+            breaker.record_cancelled()
+        raise
+    if not recorded:
+        breaker.record_failure()
+
+
+def _can_hedge(fallback_model: str) -> bool:
+    """Хедж имеет смысл, только если цепь fallback модели не разомкнута"""
+    return not circuit_breakers.get(fallback_model).is_open() and hedge_policy.try_acquire_hedge()
+
+
+async def hedged_request(
+    call: Callable[[str], Awaitable[T]],
+    primary_model: str,
+    fallback_model: Optional[str],
+    is_valid: Callable[[T], bool] = lambda result: result is not None
+) -> Tuple[T, str]:
+    """
+    Выполняет запрос к основной модели с хеджированием fallback моделью
+
+    Args:
+        call: Фабрика запроса: принимает имя модели, возвращает awaitable с ответом
+        primary_model: Основная модель
+        fallback_model: Fallback модель (None - без fallback)
+        is_valid: Проверка, что ответ пригоден (например, не пустой)
+
+    Returns:
+        (ответ, модель, которая его дала). Если пригодного ответа нет, но какая-то
+        модель ответила - возвращается ее ответ, иначе пробрасывается последняя ошибка.
+    """
+    hedge_policy.note_request()
+    delay = hedge_policy.hedge_delay(primary_model, 'response') if hedge_policy.enabled and fallback_model else None
+
+    tasks: Dict[asyncio.Task, Tuple[str, float]] = {}
+
+    def launch(model: str) -> asyncio.Task:
+        task = asyncio.ensure_future(_guarded_call(model, call))
+        tasks[task] = (model, time.monotonic())
+        return task
+
+    started_at = time.monotonic()
+    pending = {launch(primary_model)}
+    fallback_launched = False
+    last_error: Optional[BaseException] = None
+    invalid_result: Optional[Tuple[T, str]] = None
+
+    try:
+        while pending:
+            timeout = None
+            if delay is not None and not fallback_launched:
+                timeout = max(0.0, delay - (time.monotonic() - started_at))
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Основная модель не успела за p90 - решаем, запускать ли хедж
+                delay = None
+                if _can_hedge(fallback_model):
+                    logger.info(f"🪝 {primary_model} не ответила за {time.monotonic() - started_at:.1f}s, "
+                                f"параллельно запускаю {fallback_model}")
+                    pending.add(launch(fallback_model))
+                    fallback_launched = True
+                continue
+
+            for task in done:
+                model, task_started = tasks[task]
+                elapsed = time.monotonic() - task_started
+                error = task.exception()
+                if error is not None:
+                    if isinstance(error, asyncio.TimeoutError):
+                        latency_tracker.record(model, 'response', elapsed)
+                    if isinstance(error, CircuitOpenError):
+                        logger.info(f"⏭️ {model} пропущена: цепь разомкнута")
+                        last_error = error
+                        continue
+                    logger.warning(f"⚠️ Ошибка модели {model}: {error or type(error).__name__}")
+                    last_error = error
+                    continue
+
+                result = task.result()
+                latency_tracker.record(model, 'response', elapsed)
+                if is_valid(result):
+                    return result, model
+                invalid_result = (result, model)
+
+            # Основная модель упала до хеджа - обычный последовательный fallback
+            if not pending and fallback_model and not fallback_launched:
+                logger.info(f"🔄 Пробую fallback модель {fallback_model}...")
+                pending.add(launch(fallback_model))
+                fallback_launched = True
+                delay = None
+    finally:
+        await _cancel_tasks(tasks)
+
+    if invalid_result is not None:
+        return invalid_result
+    raise last_error or RuntimeError(f"No response from {primary_model}/{fallback_model}")
+
+
+async def hedged_stream(
+    open_stream: Callable[[str], AsyncIterator[str]],
+    primary_model: str,
+    fallback_model: Optional[str]
+) -> AsyncIterator[str]:
+    """
+    Потоковый вариант hedged_request: гонка идет до первого фрагмента
+
+    Если основная модель не выдала первый фрагмент за p90 задержки первого токена,
+    параллельно открывается поток fallback модели. Дальше читается только поток
+    победителя; ошибки после первого фрагмента пробрасываются вызывающему коду.
+    """
+    hedge_policy.note_request()
+    delay = hedge_policy.hedge_delay(primary_model, 'first_token') if hedge_policy.enabled and fallback_model else None
+
+    streams: Dict[str, AsyncIterator[str]] = {}
+    first_tasks: Dict[asyncio.Task, Tuple[str, float]] = {}
+
+    def launch(model: str) -> asyncio.Task:
+        stream = _guarded_stream(model, open_stream)
+        streams[model] = stream
+        task = asyncio.ensure_future(stream.__anext__())
+        first_tasks[task] = (model, time.monotonic())
+        return task
+
+    started_at = time.monotonic()
+    pending = {launch(primary_model)}
+    fallback_launched = False
+    last_error: Optional[BaseException] = None
+    winner: Optional[str] = None
+    first_delta = ""
+
+    try:
+        while pending and winner is None:
+            timeout = None
+            if delay is not None and not fallback_launched:
+                timeout = max(0.0, delay - (time.monotonic() - started_at))
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                delay = None
+                if _can_hedge(fallback_model):
+                    logger.info(f"🪝 {primary_model} не выдала первый фрагмент за {time.monotonic() - started_at:.1f}s, "
+                                f"параллельно запускаю {fallback_model}")
+                    pending.add(launch(fallback_model))
+                    fallback_launched = True
+                continue
+
+            for task in done:
+                model, task_started = first_tasks[task]
+                error = task.exception()
+                if error is None:
+                    latency_tracker.record(model, 'first_token', time.monotonic() - task_started)
+                    winner = model
+                    first_delta = task.result()
+                    break
+                if isinstance(error, StopAsyncIteration):
+                    error = RuntimeError(f"Empty stream from {model}")
+                if isinstance(error, CircuitOpenError):
+                    logger.info(f"⏭️ {model} пропущена: цепь разомкнута")
+                    last_error = error
+                    continue
+                logger.warning(f"⚠️ Поток модели {model} не начался: {error}")
+                last_error = error
+
+            if winner is None and not pending and fallback_model and not fallback_launched:
+                logger.info(f"🔄 Пробую потоковый запрос к fallback модели {fallback_model}...")
+                pending.add(launch(fallback_model))
+                fallback_launched = True
+                delay = None
+    finally:
+        await _cancel_tasks(first_tasks)
+        for model, stream in streams.items():
+            if model != winner:
+                try:
+                    await stream.aclose()
+                except Exception:
+                    pass
+
+    if winner is None:
+        raise last_error or RuntimeError(f"No stream from {primary_model}/{fallback_model}")
+
+    winner_stream = streams[winner]
+    try:
+        yield first_delta
+        async for delta in winner_stream:
+            yield delta
+    finally:
+        await winner_stream.aclose()
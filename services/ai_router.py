@@ -0,0 +1,259 @@
+"""
+Маршрутизатор запросов между AI-провайдерами (AI_PROVIDER=router)
+
+Держит OpenAIService и ClaudeService одновременно и для каждого запроса выбирает
+провайдера взвешенно-случайно. Вес провайдера обратно пропорционален его "стоимости":
+EWMA задержки с штрафом за EWMA доли ошибок плюс цена токенов основной модели.
+Запросы одной сессии закрепляются за провайдером, чтобы итерации письма шли через
+ту же модель. Если выбранный провайдер не ответил, запрос повторяется у другого.
+"""
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from .ai_service import AIService, parse_model_values
+from .circuit_breaker import circuit_breakers
+from .token_metering import metering_context
+from config import (
+    AI_MODEL_PRICES,
+    ROUTER_EWMA_ALPHA,
+    ROUTER_ERROR_PENALTY,
+    ROUTER_COST_WEIGHT,
+    ROUTER_INITIAL_LATENCY,
+    ROUTER_STICKY_MAX_SESSIONS,
+    ROUTER_STICKY_TTL_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+MODEL_PRICES = parse_model_values(AI_MODEL_PRICES)
+
+
+class ProviderStats:
+    """Скользящие оценки (EWMA) задержки и доли ошибок провайдера"""
+
+    def __init__(self, model: str, alpha: float = ROUTER_EWMA_ALPHA):
+        self.model = model
+        self.alpha = alpha
+        self.latency = ROUTER_INITIAL_LATENCY
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def record(self, success: bool, latency: Optional[float] = None):
+        self.requests += 1
+        self.error_rate = self.alpha * (0.0 if success else 1.0) + (1 - self.alpha) * self.error_rate
+        if success and latency is not None:
+            self.latency = self.alpha * latency + (1 - self.alpha) * self.latency
+
+    @property
+    def price(self) -> float:
+        """Цена основной модели, $ за 1K токенов"""
+        return MODEL_PRICES.get(self.model, 0.0)
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше"""
+        return self.latency * (1 + ROUTER_ERROR_PENALTY * self.error_rate) + ROUTER_COST_WEIGHT * self.price
+
+    def get_stats(self) -> dict:
+        return {
+            'model': self.model,
+            'latency_ewma': round(self.latency, 2),
+            'error_rate_ewma': round(self.error_rate, 3),
+            'price_per_1k': self.price,
+            'score': round(self.score(), 2),
+            'requests': self.requests
+        }
+
+
+class RouterAIService(AIService):
+    """AI-сервис, распределяющий запросы между несколькими провайдерами"""
+
+    def __init__(self, providers: Dict[str, AIService]):
+        self.providers = providers
+        self.stats = {name: ProviderStats(service.model_name) for name, service in providers.items()}
+        self.model_name = "router:" + "+".join(service.model_name for service in providers.values())
+        self.models = tuple(model for service in providers.values() for model in service.models)
+        # session_id -> (провайдер, время закрепления)
+        self._sticky: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        logger.info(f"🔀 AI router initialized: {', '.join(providers)}")
+
+    # === ВЫБОР ПРОВАЙДЕРА ===
+
+    def _is_provider_available(self, name: str) -> bool:
+        return any(not circuit_breakers.get(model).is_open() for model in self.providers[name].models)
+
+    def _pick_weighted(self, candidates: List[str]) -> str:
+        weights = [1.0 / max(self.stats[name].score(), 0.001) for name in candidates]
+        return random.choices(candidates, weights=weights, k=1)[0]
+
+    def _choose_provider(self, session_id: Optional[str]) -> str:
+        """Закрепленный за сессией провайдер или взвешенный выбор"""
+        now = time.time()
+        if session_id:
+            entry = self._sticky.get(session_id)
+            if entry and now - entry[1] < ROUTER_STICKY_TTL_SECONDS and self._is_provider_available(entry[0]):
+                self._sticky.move_to_end(session_id)
+                return entry[0]
+
+        candidates = [name for name in self.providers if self._is_provider_available(name)] or list(self.providers)
+        name = self._pick_weighted(candidates)
+
+        if session_id:
+            self._sticky[session_id] = (name, now)
+            self._sticky.move_to_end(session_id)
+            while len(self._sticky) > ROUTER_STICKY_MAX_SESSIONS:
+                self._sticky.popitem(last=False)
+        return name
+
+    def _route_order(self, session_id: Optional[str]) -> List[str]:
+        """Порядок попыток: выбранный провайдер, затем остальные"""
+        first = self._choose_provider(session_id)
+        return [first] + [name for name in self.providers if name != first]
+
+    def _pin(self, session_id: Optional[str], name: str):
+        """Закрепить сессию за провайдером, который реально ответил"""
+        if session_id:
+            self._sticky[session_id] = (name, time.time())
+
+    # === AIService ===
+
+    async def test_api_connection(self) -> bool:
+        results = {name: await service.test_api_connection() for name, service in self.providers.items()}
+        logger.info(f"🔀 Проверка провайдеров: {results}")
+        return any(results.values())
+
+    async def get_completion(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> Optional[str]:
+        # Повтор у другого провайдера учитывается как попытка того же запроса
+        with metering_context(user_id, session_id, request_type):
+            return await self._get_completion(prompt, temperature, max_tokens, user_id, session_id, request_type)
+
+    async def _get_completion(
+        self,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> Optional[str]:
+        for name in self._route_order(session_id):
+            logger.info(f"🔀 Запрос {request_type} → {name}")
+            start_time = time.time()
+            result = await self.providers[name].get_completion(
+                prompt, temperature=temperature, max_tokens=max_tokens,
+                user_id=user_id, session_id=session_id, request_type=request_type
+            )
+            self.stats[name].record(bool(result), time.time() - start_time)
+            if result:
+                self._pin(session_id, name)
+                return result
+            logger.warning(f"⚠️ Провайдер {name} не ответил, пробую следующий")
+        return None
+
+    async def get_completions(
+        self,
+        prompt: str,
+        n: int = 2,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> List[str]:
+        with metering_context(user_id, session_id, request_type):
+            return await self._get_completions(prompt, n, temperature, max_tokens, user_id, session_id, request_type)
+
+    async def _get_completions(
+        self,
+        prompt: str,
+        n: int,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> List[str]:
+        for name in self._route_order(session_id):
+            logger.info(f"🔀 Запрос {n} вариантов {request_type} → {name}")
+            start_time = time.time()
+            variants = await self.providers[name].get_completions(
+                prompt, n=n, temperature=temperature, max_tokens=max_tokens,
+                user_id=user_id, session_id=session_id, request_type=request_type
+            )
+            self.stats[name].record(bool(variants), time.time() - start_time)
+            if variants:
+                self._pin(session_id, name)
+                return variants
+            logger.warning(f"⚠️ Провайдер {name} не вернул вариантов, пробую следующий")
+        return []
+
+    async def stream_completion(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> AsyncIterator[str]:
+        last_error: Optional[Exception] = None
+        for name in self._route_order(session_id):
+            logger.info(f"🔀 Потоковый запрос {request_type} → {name}")
+            start_time = time.time()
+            received = False
+            try:
+                async for delta in self.providers[name].stream_completion(
+                    prompt, temperature=temperature, max_tokens=max_tokens,
+                    user_id=user_id, session_id=session_id, request_type=request_type
+                ):
+                    received = True
+                    yield delta
+            except Exception as e:
+                self.stats[name].record(False)
+                # Часть текста уже показана - переключать провайдера поздно
+                if received:
+                    raise
+                logger.warning(f"⚠️ Поток провайдера {name} не начался: {e}")
+                last_error = e
+                continue
+            self.stats[name].record(True, time.time() - start_time)
+            self._pin(session_id, name)
+            return
+        raise last_error or RuntimeError("All providers failed to stream")
+
+    async def generate_personalized_letter(self, prompt: str, temperature: Optional[float] = None) -> Optional[str]:
+        with metering_context(None, None, "personalized_letter"):
+            for name in self._route_order(None):
+                start_time = time.time()
+                result = await self.providers[name].generate_personalized_letter(prompt, temperature)
+                self.stats[name].record(bool(result), time.time() - start_time)
+                if result:
+                    return result
+        return None
+
+    async def probe_model(self, model: str) -> bool:
+        for service in self.providers.values():
+            if model in service.models:
+                return await service.probe_model(model)
+        return False
+
+    def set_stats_callback(self, callback):
+        for service in self.providers.values():
+            service.set_stats_callback(callback)
+
+    def get_stats(self) -> dict:
+        """Оценки провайдеров для мониторинга"""
+        return {
+            'providers': {name: stats.get_stats() for name, stats in self.stats.items()},
+            'sticky_sessions': len(self._sticky)
+        }
@@ -0,0 +1,261 @@
+"""
+Планировщик запросов к AI-моделям: bulkhead на каждую модель и честная очередь
+
+У каждой модели свой лимит одновременных запросов и своя ограниченная очередь,
+так что всплеск пользователей не открывает сотни параллельных соединений и не
+упирается в 429. Очередь разбита на приоритетные полосы (premium → обычные),
+внутри полосы пользователи обслуживаются по кругу, чтобы один пользователь
+не занял очередь целиком.
+
+Кто делает запрос, планировщик узнает из контекста (ai_request_context), который
+обработчик устанавливает перед генерацией: contextvars автоматически доходят до
+задач хеджирования внутри AI-сервисов.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from config import (
+    AI_SCHEDULER_ENABLED,
+    AI_MAX_IN_FLIGHT_PER_MODEL,
+    AI_MAX_QUEUE_PER_MODEL,
+    AI_MODEL_CONCURRENCY,
+    AI_QUEUE_TIMEOUT
+)
+from .ai_service import parse_model_values
+
+logger = logging.getLogger(__name__)
+
+# Приоритетные полосы (меньше - раньше)
+PRIORITY_PREMIUM = 0
+PRIORITY_STANDARD = 1
+
+# Не чаще одного уведомления о позиции в очереди на запрос за этот интервал
+POSITION_NOTIFY_INTERVAL = 3.0
+
+
+class SchedulerRejectedError(Exception):
+    """Запрос не допущен к модели планировщиком"""
+
+
+class QueueFullError(SchedulerRejectedError):
+    """Очередь модели переполнена"""
+
+
+class QueueTimeoutError(SchedulerRejectedError):
+    """Запрос слишком долго ждал в очереди"""
+
+
+@dataclass
+class AIRequestContext:
+    """Кто и с каким приоритетом делает запрос к AI"""
+    user_id: Optional[int] = None
+    priority: int = PRIORITY_STANDARD
+    # Вызывается с позицией в очереди (1, 2, ...) и с 0, когда запрос дождался слота
+    on_position: Optional[Callable[[int], Awaitable[None]]] = None
+
+
+_current_request: ContextVar[Optional[AIRequestContext]] = ContextVar('ai_request_context', default=None)
+
+
+@contextmanager
+def ai_request_context(user_id: Optional[int], priority: int = PRIORITY_STANDARD,
+                       on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+    """Устанавливает контекст запроса для всех AI-вызовов внутри блока"""
+    token = _current_request.set(AIRequestContext(user_id, priority, on_position))
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
+
+
+class _Waiter:
+    __slots__ = ('future', 'user_key', 'context', 'position', 'notified_at')
+
+    def __init__(self, future: asyncio.Future, user_key, context: AIRequestContext):
+        self.future = future
+        self.user_key = user_key
+        self.context = context
+        self.position = 0
+        self.notified_at = 0.0
+
+
+class Bulkhead:
+    """Лимит одновременных запросов к одной модели с честной очередью"""
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        # приоритет -> {пользователь -> очередь его запросов}
+        self._lanes: Dict[int, "OrderedDict[object, Deque[_Waiter]]"] = {}
+        self._queued = 0
+        self._callbacks: Set[asyncio.Task] = set()
+        self.stats = {'admitted': 0, 'enqueued': 0, 'rejected': 0, 'timeouts': 0}
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    async def acquire(self, context: AIRequestContext):
+        """Занять слот модели, при необходимости дождавшись очереди"""
+        if self.in_flight < self.max_in_flight and not self._queued:
+            self.in_flight += 1
+            self.stats['admitted'] += 1
+            return
+
+        if self._queued >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise QueueFullError(f"Queue for {self.name} is full ({self._queued})")
+
+        user_key = context.user_id if context.user_id is not None else object()
+        waiter = _Waiter(asyncio.get_event_loop().create_future(), user_key, context)
+        lane = self._lanes.setdefault(context.priority, OrderedDict())
+        lane.setdefault(user_key, deque()).append(waiter)
+        self._queued += 1
+        self.stats['enqueued'] += 1
+        self._notify_positions()
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=AI_QUEUE_TIMEOUT)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдан одновременно с отменой - возвращаем его
+                self.release()
+            else:
+                self._remove(waiter)
+                self._notify_positions()
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats['timeouts'] += 1
+                raise QueueTimeoutError(f"Waited more than {AI_QUEUE_TIMEOUT}s for {self.name}") from None
+            raise
+
+        self.stats['admitted'] += 1
+        if waiter.position:
+            self._fire(waiter.context, 0)
+
+    def release(self):
+        """Освободить слот и передать его следующему в очереди"""
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _pop_next(self) -> Optional[_Waiter]:
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            if not lane:
+                continue
+            user_key, waiters = next(iter(lane.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                lane.move_to_end(user_key)  # Круговой обход пользователей
+            else:
+                del lane[user_key]
+            self._queued -= 1
+            return waiter
+        return None
+
+    def _remove(self, waiter: _Waiter):
+        lane = self._lanes.get(waiter.context.priority, {})
+        waiters = lane.get(waiter.user_key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del lane[waiter.user_key]
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self._queued:
+            waiter = self._pop_next()
+            if waiter is None or waiter.future.done():
+                continue
+            self.in_flight += 1
+            waiter.future.set_result(None)
+        self._notify_positions()
+
+    def _ordered_waiters(self) -> List[_Waiter]:
+        """Ожидающие в порядке, в котором им будут выданы слоты"""
+        ordered: List[_Waiter] = []
+        for priority in sorted(self._lanes):
+            queues = list(self._lanes[priority].values())
+            depth = max((len(waiters) for waiters in queues), default=0)
+            for round_index in range(depth):
+                ordered.extend(waiters[round_index] for waiters in queues if len(waiters) > round_index)
+        return ordered
+
+    def _notify_positions(self):
+        now = time.monotonic()
+        for index, waiter in enumerate(self._ordered_waiters(), start=1):
+            if waiter.context.on_position is None or waiter.position == index:
+                continue
+            if waiter.position and now - waiter.notified_at < POSITION_NOTIFY_INTERVAL:
+                continue
+            waiter.position = index
+            waiter.notified_at = now
+            self._fire(waiter.context, index)
+
+    def _fire(self, context: AIRequestContext, position: int):
+        if context.on_position is None:
+            return
+        task = asyncio.ensure_future(context.on_position(position))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    def get_stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queued': self._queued,
+            'max_queue': self.max_queue,
+            **self.stats
+        }
+
+
+class AIScheduler:
+    """Bulkhead'ы по моделям"""
+
+    def __init__(self, enabled: bool = True, max_in_flight: int = 10, max_queue: int = 100,
+                 model_limits: Optional[Dict[str, float]] = None):
+        self.enabled = enabled
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.model_limits = model_limits or {}
+        self._bulkheads: Dict[str, Bulkhead] = {}
+
+    def bulkhead(self, model: str) -> Bulkhead:
+        bulkhead = self._bulkheads.get(model)
+        if bulkhead is None:
+            limit = int(self.model_limits.get(model, self.max_in_flight))
+            bulkhead = Bulkhead(model, max_in_flight=limit, max_queue=self.max_queue)
+            self._bulkheads[model] = bulkhead
+        return bulkhead
+
+    @asynccontextmanager
+    async def slot(self, model: str):
+        """Слот модели на время запроса (контекст берется из ai_request_context)"""
+        if not self.enabled:
+            yield
+            return
+        bulkhead = self.bulkhead(model)
+        await bulkhead.acquire(_current_request.get() or AIRequestContext())
+        try:
+            yield
+        finally:
+            bulkhead.release()
+
+    def get_stats(self) -> dict:
+        return {model: bulkhead.get_stats() for model, bulkhead in self._bulkheads.items()}
+
+
+# Глобальный планировщик
+ai_scheduler = AIScheduler(
+    enabled=AI_SCHEDULER_ENABLED,
+    max_in_flight=AI_MAX_IN_FLIGHT_PER_MODEL,
+    max_queue=AI_MAX_QUEUE_PER_MODEL,
+    model_limits=parse_model_values(AI_MODEL_CONCURRENCY)
+)
@@ -1,13 +1,20 @@
 """
 Абстрактный интерфейс для AI-сервисов
 """
+import asyncio
+import logging
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 
 class AIService(ABC):
     """Абстрактный интерфейс для AI-сервисов"""
     
+    # Основная модель сервиса (используется в ключах кэшей)
+    model_name: str = ""
+    # Модели сервиса в порядке fallback (для circuit breakers и проб)
+    models: Tuple[str, ...] = ()
+    
     @abstractmethod
     async def test_api_connection(self) -> bool:
         """Проверяет работу API"""
@@ -26,6 +33,41 @@ class AIService(ABC):
         """Универсальный метод для получения ответа от AI"""
         pass
         
+    @abstractmethod
+    def stream_completion(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> AsyncIterator[str]:
+        """Потоковый вариант get_completion: асинхронный итератор фрагментов текста"""
+        pass
+        
+    async def get_completions(
+        self,
+        prompt: str,
+        n: int = 2,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> List[str]:
+        """
+        Несколько вариантов ответа на один промпт за один раунд
+
+        По умолчанию - один вариант через get_completion; провайдеры переопределяют
+        метод, чтобы получить n вариантов за время одной генерации.
+        """
+        result = await self.get_completion(
+            prompt, temperature=temperature, max_tokens=max_tokens,
+            user_id=user_id, session_id=session_id, request_type=request_type
+        )
+        return [result] if result else []
+        
     @abstractmethod
     async def generate_personalized_letter(
         self, 
@@ -35,7 +77,85 @@ class AIService(ABC):
         """Генерирует письмо по готовому персонализированному промпту"""
         pass
         
+    @abstractmethod
+    async def probe_model(self, model: str) -> bool:
+        """Короткий пробный запрос к конкретной модели (для circuit breaker)"""
+        pass
+        
     @abstractmethod
     def set_stats_callback(self, callback):
         """Установить callback для сбора статистики"""
-        pass 
\ No newline at end of file
+        pass
+
+
+async def iterate_with_idle_timeout(stream, idle_timeout: float,
+                                    first_timeout: Optional[float] = None) -> AsyncIterator:
+    """
+    Итерирует асинхронный поток, прерываясь если следующий фрагмент
+    не пришел за idle_timeout секунд (asyncio.TimeoutError)
+
+    first_timeout - отдельный предел ожидания первого фрагмента (по умолчанию idle_timeout)
+    """
+    iterator = stream.__aiter__()
+    timeout = idle_timeout if first_timeout is None else first_timeout
+    while True:
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+        except StopAsyncIteration:
+            return
+        timeout = idle_timeout
+        yield item
+
+
+# Просьба продолжить ответ, обрезанный по max_tokens (для API без префилла ответа ассистента)
+CONTINUATION_INSTRUCTION = (
+    "Ответ оборвался из-за ограничения длины. Продолжи его ровно с того места, где он прервался: "
+    "без повторов, вступлений и комментариев."
+)
+
+# Знаки, после которых продолжение начинается с пробела
+_SENTENCE_PUNCTUATION = '.,;:!?)»—'
+
+
+def continuation_suffix(head: str, tail: str) -> str:
+    """
+    Текст, который нужно дописать к обрезанному ответу head, чтобы склеить его с продолжением tail
+
+    Убирает повтор конца head в начале tail (модели иногда повторяют последние слова)
+    и при необходимости вставляет пробел на стыке. head - ровно то, что уже получил
+    клиент, включая пробелы в конце (префилл Claude их не содержит).
+    """
+    stripped = head.rstrip()
+    for size in range(min(len(stripped), len(tail), 200), 10, -1):
+        if stripped.endswith(tail[:size]):
+            tail = tail[size:]
+            break
+    if not tail or not head:
+        return tail
+    if head[-1].isspace():
+        # Пробел на стыке уже отправлен - второй не добавляем
+        return tail.lstrip(' ')
+    if tail[0].isspace():
+        return tail
+    if head[-1] in _SENTENCE_PUNCTUATION:
+        return ' ' + tail
+    return tail
+
+
+def parse_model_values(raw: str) -> Dict[str, float]:
+    """Разбирает строку вида 'gpt-4o=12,claude-3-5-sonnet-20241022=15' в словарь модель → число"""
+    values: Dict[str, float] = {}
+    for item in (raw or '').split(','):
+        if '=' not in item:
+            continue
+        model, _, value = item.partition('=')
+        try:
+            values[model.strip()] = float(value.strip())
+        except ValueError:
+            logging.getLogger(__name__).warning(f"⚠️ Некорректное значение для модели: '{item}'")
+    return values
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (~3 символа на токен с учетом кириллицы)"""
+    return max(1, len(text) // 3)
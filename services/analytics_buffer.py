@@ -0,0 +1,213 @@
+"""
+Буфер событий аналитики с пакетной записью в Supabase
+
+Каждое событие (track_*, log_error, log_openai_request) раньше было отдельным
+HTTP запросом в Supabase: одна генерация письма давала десяток
+вставок по одной строке. Теперь строки складываются в ограниченную очередь, а
+фоновая задача раз в ANALYTICS_FLUSH_INTERVAL_MS (или при накоплении
+ANALYTICS_BATCH_SIZE строк) пишет их одним insert на таблицу.
+
+Переполнение: добавление ждет место в очереди не дольше ANALYTICS_ENQUEUE_TIMEOUT_MS
+(backpressure), затем по ANALYTICS_OVERFLOW_POLICY отбрасывается самое старое
+(drop_oldest) или новое (drop_newest) событие. При остановке бота буфер дописывается.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import (
+    ANALYTICS_BUFFER_ENABLED,
+    ANALYTICS_BATCH_SIZE,
+    ANALYTICS_FLUSH_INTERVAL_MS,
+    ANALYTICS_QUEUE_MAX,
+    ANALYTICS_OVERFLOW_POLICY,
+    ANALYTICS_ENQUEUE_TIMEOUT_MS
+)
+
+logger = logging.getLogger(__name__)
+
+# (таблица, строка)
+BufferedRow = Tuple[str, Dict[str, Any]]
+# Вставка нескольких строк в таблицу одним запросом
+BatchWriter = Callable[[str, List[Dict[str, Any]]], Awaitable[None]]
+
+
+class AnalyticsBuffer:
+    """Ограниченная очередь строк аналитики и фоновая пакетная запись"""
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 2.0, max_queued: int = 5000,
+                 overflow_policy: str = 'drop_oldest', enqueue_timeout: float = 0.05,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queued = max(self.batch_size, max_queued)
+        self.overflow_policy = overflow_policy
+        self.enqueue_timeout = enqueue_timeout
+
+        self._writer: Optional[BatchWriter] = None
+        # Очередь, событие и задача создаются в работающем event loop (лениво)
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped = False
+
+        self.stats = {
+            'enqueued': 0, 'dropped': 0, 'backpressure_waits': 0,
+            'batches': 0, 'written_rows': 0, 'failed_rows': 0
+        }
+
+        if overflow_policy not in ('drop_oldest', 'drop_newest'):
+            logger.warning(f"⚠️ Неизвестная ANALYTICS_OVERFLOW_POLICY={overflow_policy}, использую drop_oldest")
+            self.overflow_policy = 'drop_oldest'
+
+    def set_writer(self, writer: BatchWriter):
+        """Функция записи пакета (AnalyticsService._insert_rows)"""
+        self._writer = writer
+
+    def _ensure_started(self) -> bool:
+        if self._stopped:
+            return False
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self._flusher is not None:
+            # Очередь привязана к loop бота; из других loop (webhook сервер) - прямая запись
+            return loop is self._loop
+        if not self.enabled or self._writer is None:
+            return False
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = asyncio.ensure_future(self._flush_loop())
+        logger.info(f"📦 Буфер аналитики запущен: пакет {self.batch_size} строк, "
+                    f"интервал {self.flush_interval}с, очередь {self.max_queued}")
+        return True
+
+    async def put(self, table: str, row: Dict[str, Any]) -> bool:
+        """
+        Поставить строку в очередь записи
+
+        False - буфер недоступен (выключен, остановлен), строку нужно записать напрямую.
+        Отброшенная при переполнении строка считается принятой: аналитика не должна
+        задерживать ответ пользователю.
+        """
+        if not self._ensure_started():
+            return False
+
+        # Время события, а не момента записи пакета
+        row.setdefault('created_at', datetime.now(timezone.utc).isoformat())
+        item: BufferedRow = (table, row)
+        self.stats['enqueued'] += 1
+
+        if self._queue.qsize() + 1 >= self.batch_size:
+            self._batch_ready.set()
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return True
+
+        # Очередь полна: даем записи пакета освободить место
+        self.stats['backpressure_waits'] += 1
+        self._batch_ready.set()
+        try:
+            await asyncio.wait_for(self._queue.put(item), self.enqueue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            pass
+
+        self.stats['dropped'] += 1
+        if self.stats['dropped'] % 100 == 1:
+            logger.warning(f"⚠️ Очередь аналитики переполнена, отброшено событий: {self.stats['dropped']}")
+        if self.overflow_policy == 'drop_newest':
+            return True
+        try:
+            self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        self._queue.put_nowait(item)
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи пакета аналитики: {e}")
+            if self._stopped:
+                return
+
+    def _drain(self) -> List[BufferedRow]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def flush(self):
+        """Записать все накопленные строки: один insert на таблицу за пакет"""
+        if self._queue is None:
+            return
+        async with self._flush_lock:
+            while not self._queue.empty():
+                await self._write_batch(self._drain())
+
+    async def _write_batch(self, batch: List[BufferedRow]):
+        # PostgREST требует одинаковый набор колонок в одной вставке: строки
+        # с разными необязательными полями (to_dict убирает None) пишутся отдельно
+        groups: Dict[Tuple[str, Tuple[str, ...]], List[Dict[str, Any]]] = {}
+        for table, row in batch:
+            groups.setdefault((table, tuple(sorted(row))), []).append(row)
+
+        for (table, _), rows in groups.items():
+            try:
+                await self._writer(table, rows)
+                self.stats['batches'] += 1
+                self.stats['written_rows'] += len(rows)
+            except Exception as e:
+                self.stats['failed_rows'] += len(rows)
+                logger.error(f"❌ Не удалось записать {len(rows)} строк в {table}: {e}")
+
+    async def stop(self, timeout: float):
+        """Дописать очередь и остановить фоновую запись (не дольше timeout секунд)"""
+        self._stopped = True
+        if self._flusher is None:
+            return
+        # Новые события после остановки пишутся напрямую, очередь дописывает _flush_loop
+        self._batch_ready.set()
+        done, pending = await asyncio.wait([self._flusher], timeout=timeout)
+        if pending:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            logger.warning(f"⏸️ Не успели записать события аналитики при остановке: {self._queue.qsize()}")
+        self._flusher = None
+
+    def get_stats(self) -> dict:
+        """Статистика для мониторинга"""
+        return {
+            **self.stats,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'running': self._flusher is not None
+        }
+
+
+# Глобальный буфер аналитики
+analytics_buffer = AnalyticsBuffer(
+    batch_size=ANALYTICS_BATCH_SIZE,
+    flush_interval=ANALYTICS_FLUSH_INTERVAL_MS / 1000,
+    max_queued=ANALYTICS_QUEUE_MAX,
+    overflow_policy=ANALYTICS_OVERFLOW_POLICY,
+    enqueue_timeout=ANALYTICS_ENQUEUE_TIMEOUT_MS / 1000,
+    enabled=ANALYTICS_BUFFER_ENABLED
+)
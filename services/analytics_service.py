@@ -1,10 +1,11 @@
-import asyncio
 import logging
 from typing import Optional, Dict, Any, Union
 from datetime import datetime
 import traceback
 
 from utils.database import SupabaseClient
+from services.analytics_buffer import analytics_buffer
+from services.session_writes import session_writes
 from models.analytics_models import (
     UserData, LetterSessionData, EventData, ErrorData, OpenAIRequestData
 )
@@ -16,51 +17,80 @@ logger = logging.getLogger(__name__)
 
 class AnalyticsService:
     def __init__(self):
-        self.supabase = SupabaseClient.get_client()
+        self.supabase = SupabaseClient.get_async_client()
         self.enabled = SupabaseClient.is_available()
+        if self.enabled:
+            analytics_buffer.set_writer(self._insert_rows)
+            session_writes.set_writer(self._patch_session)
         
     def _has_supabase(self) -> bool:
         """Проверяет наличие Supabase клиента"""
         return self.supabase is not None and hasattr(self.supabase, 'table')
         
     async def _execute_async(self, func, *args, **kwargs):
-        """Выполнить операцию асинхронно, чтобы не блокировать бота"""
+        """Выполнить операцию с БД, не роняя бота при ошибке (асинхронный клиент не блокирует event loop)"""
         if not self.enabled:
             return None
             
         try:
-            # Запускаем в отдельном потоке, чтобы не блокировать
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, func, *args, **kwargs)
-            return result
+            return await func(*args, **kwargs)
         except Exception as e:
             logger.error(f"Analytics operation failed: {e}")
             return None
     
+    async def _insert_rows(self, table: str, rows: list):
+        """Вставить пакет строк одним запросом (вызывается буфером аналитики)"""
+        await self.supabase.table(table).insert(rows, returning='minimal').execute()
+    
+    async def _insert_buffered(self, table: str, row: Dict[str, Any], description: str) -> bool:
+        """
+        Записать строку через буфер аналитики (пакетная вставка в фоне)
+        
+        Если буфер недоступен (выключен, бот останавливается) - строка пишется сразу.
+        """
+        if not self.enabled:
+            return False
+        if await analytics_buffer.put(table, row):
+            return True
+        
+        async def _insert():
+            try:
+                if not self.supabase:
+                    logger.warning("Supabase client not available")
+                    return False
+                await self.supabase.table(table).insert(row).execute()
+                return True
+            except Exception as e:
+                logger.error(f"Failed to {description}: {e}")
+                return False
+        
+        result = await self._execute_async(_insert)
+        return result is True
+    
     # === УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ===
     
     async def track_user(self, user_data: UserData) -> Optional[int]:
         """Добавить или обновить пользователя"""
-        def _track_user():
+        async def _track_user():
             try:
                 if not self.supabase:
                     logger.warning("Supabase client not available")
                     return None
                     
                 # Проверяем, существует ли пользователь
-                existing = self.supabase.table('users').select('id').eq(
+                existing = await self.supabase.table('users').select('id').eq(
                     'telegram_user_id', user_data.telegram_user_id
                 ).execute()
                 
                 if existing.data:
                     # Обновляем существующего пользователя
-                    result = self.supabase.table('users').update(
+                    result = await self.supabase.table('users').update(
                         user_data.to_dict()
                     ).eq('telegram_user_id', user_data.telegram_user_id).execute()
                     return existing.data[0]['id']
                 else:
                     # Создаем нового пользователя
-                    result = self.supabase.table('users').insert(
+                    result = await self.supabase.table('users').insert(
                         user_data.to_dict()
                     ).execute()
                     return result.data[0]['id'] if result.data else None
@@ -73,12 +103,12 @@ class AnalyticsService:
     
     async def get_user_id(self, telegram_user_id: int) -> Optional[int]:
         """Получить внутренний ID пользователя"""
-        def _get_user_id():
+        async def _get_user_id():
             try:
                 if not self.supabase:
                     return None
                     
-                result = self.supabase.table('users').select('id').eq(
+                result = await self.supabase.table('users').select('id').eq(
                     'telegram_user_id', telegram_user_id
                 ).execute()
                 return result.data[0]['id'] if result.data else None
@@ -92,18 +122,20 @@ class AnalyticsService:
     
     async def create_letter_session(self, session_data: LetterSessionData) -> Optional[str]:
         """Создать новую сессию генерации письма"""
-        def _create_session():
+        async def _create_session():
             try:
                 if not self.supabase:
                     logger.warning("Supabase client not available")
                     return None
                     
                 logger.info(f"📊 Создаю letter_session с данными: {session_data.to_dict()}")
-                result = self.supabase.table('letter_sessions').insert(
+                result = await self.supabase.table('letter_sessions').insert(
                     session_data.to_dict()
                 ).execute()
                 session_id = result.data[0]['id'] if result.data else None
                 logger.info(f"✅ Letter session создана успешно: {session_id}")
+                if session_id:
+                    session_writes.remember(session_id, session_data.to_dict())
                 return session_id
             except Exception as e:
                 logger.error(f"❌ Failed to create letter session: {e}")
@@ -112,18 +144,32 @@ class AnalyticsService:
         
         return await self._execute_async(_create_session)
     
-    async def update_letter_session(self, session_id: str, updates: Dict[str, Any]) -> bool:
-        """Обновить сессию генерации письма"""
-        def _update_session():
+    async def update_letter_session(self, session_id: str, updates: Dict[str, Any],
+                                    flush: bool = False) -> bool:
+        """
+        Обновить сессию генерации письма
+        
+        Изменения копятся в буфере сессий и уходят одним PATCH на финальном статусе
+        сессии или через SESSION_WRITE_DELAY_MS; flush=True - записать сразу.
+        """
+        if not self.enabled:
+            return False
+        if await session_writes.update(session_id, updates, flush=flush):
+            return True
+        return await self._patch_session(session_id, updates)
+    
+    async def _patch_session(self, session_id: str, updates: Dict[str, Any]) -> bool:
+        """Записать изменения сессии одним PATCH (вызывается буфером сессий)"""
+        async def _update_session():
             try:
                 if not self.supabase:
                     logger.warning("Supabase client not available")
                     return False
                     
-                logger.info(f"📊 Обновляю сессию {session_id} с данными: {updates}")
-                result = self.supabase.table('letter_sessions').update(updates).eq(
-                    'id', session_id
-                ).execute()
+                logger.info(f"📊 Обновляю сессию {session_id}, поля: {sorted(updates)}")
+                await self.supabase.table('letter_sessions').update(
+                    updates, returning='minimal'
+                ).eq('id', session_id).execute()
                 logger.info(f"✅ Сессия {session_id} обновлена успешно")
                 return True
             except Exception as e:
@@ -136,17 +182,18 @@ class AnalyticsService:
     
     async def get_letter_session_by_id(self, session_id: str) -> Optional[Dict[str, Any]]:
         """Получить данные сессии по ID"""
-        def _get_session():
+        async def _get_session():
             try:
                 if not self.supabase:
                     return None
                     
-                response = self.supabase.table('letter_sessions').select('*').eq(
+                response = await self.supabase.table('letter_sessions').select('*').eq(
                     'id', session_id
                 ).execute()
                 
                 if response.data and len(response.data) > 0:
-                    return response.data[0]
+                    # Еще не записанные изменения из буфера сессий
+                    return session_writes.overlay(session_id, response.data[0])
                 return None
                 
             except Exception as e:
@@ -184,25 +231,8 @@ class AnalyticsService:
     
     async def track_event(self, event_data: EventData) -> bool:
         """Отследить событие пользователя"""
-        def _track_event():
-            try:
-                if not self.supabase:
-                    logger.warning("Supabase client not available")
-                    return False
-                    
-                logger.info(f"📊 Трекаю событие: {event_data.to_dict()}")
-                self.supabase.table('user_events').insert(
-                    event_data.to_dict()
-                ).execute()
-                logger.info(f"✅ Событие '{event_data.event_type}' записано успешно")
-                return True
-            except Exception as e:
-                logger.error(f"❌ Failed to track event: {e}")
-                logger.error(f"❌ Event data was: {event_data.to_dict()}")
-                return False
-        
-        result = await self._execute_async(_track_event)
-        return result is True
+        logger.info(f"📊 Трекаю событие: {event_data.to_dict()}")
+        return await self._insert_buffered('user_events', event_data.to_dict(), 'track event')
     
     # === УДОБНЫЕ МЕТОДЫ ДЛЯ LETTERGENIUS ===
     
@@ -266,42 +296,13 @@ class AnalyticsService:
     
     async def log_error(self, error_data: ErrorData) -> bool:
         """Логировать ошибку"""
-        def _log_error():
-            try:
-                if not self.supabase:
-                    return False
-                    
-                self.supabase.table('error_logs').insert(
-                    error_data.to_dict()
-                ).execute()
-                return True
-            except Exception as e:
-                logger.error(f"Failed to log error: {e}")
-                return False
-        
-        result = await self._execute_async(_log_error)
-        return result is True
+        return await self._insert_buffered('error_logs', error_data.to_dict(), 'log error')
     
     # === OPENAI ЗАПРОСЫ ===
     
     async def log_openai_request(self, request_data: OpenAIRequestData) -> bool:
         """Логировать запрос к OpenAI"""
-        def _log_request():
-            try:
-                if not self.supabase:
-                    logger.warning("Supabase client not available")
-                    return False
-                    
-                self.supabase.table('openai_requests').insert(
-                    request_data.to_dict()
-                ).execute()
-                return True
-            except Exception as e:
-                logger.error(f"Failed to log OpenAI request: {e}")
-                return False
-        
-        result = await self._execute_async(_log_request)
-        return result is True
+        return await self._insert_buffered('openai_requests', request_data.to_dict(), 'log OpenAI request')
     
     # ===================================================
     # НОВЫЕ МЕТОДЫ ДЛЯ V7.0 - ПОДПИСКИ И ИТЕРАЦИИ
@@ -309,14 +310,14 @@ class AnalyticsService:
     
     async def get_or_create_subscription(self, user_id: int) -> Optional[dict]:
         """Получить или создать подписку пользователя (исправлена для v9.10)"""
-        def _get_or_create():
+        async def _get_or_create():
             try:
                 if not self.supabase:
                     logger.error(f"❌ No Supabase client for user {user_id}")
                     return None
                     
                 # Пытаемся найти существующую подписку
-                response = self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
+                response = await self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
                 
                 if response.data:
                     logger.info(f"✅ Found existing subscription for user {user_id}")
@@ -325,7 +326,7 @@ class AnalyticsService:
                 # Создаем новую подписку
                 logger.info(f"🔄 Creating new subscription for user {user_id}")
                 subscription_data = SubscriptionData(user_id=user_id)
-                response = self.supabase.table('subscriptions').insert(subscription_data.to_dict()).execute()
+                response = await self.supabase.table('subscriptions').insert(subscription_data.to_dict()).execute()
                 
                 if response.data:
                     logger.info(f"✅ Successfully created subscription for user {user_id}")
@@ -346,12 +347,12 @@ class AnalyticsService:
     
     async def update_subscription(self, user_id: int, updates: dict) -> bool:
         """Обновить подписку пользователя"""
-        def _update():
+        async def _update():
             try:
                 if not self.supabase:
                     return False
                     
-                self.supabase.table('subscriptions').update(updates).eq('user_id', user_id).execute()
+                await self.supabase.table('subscriptions').update(updates).eq('user_id', user_id).execute()
                 return True
                 
             except Exception as e:
@@ -363,19 +364,19 @@ class AnalyticsService:
     
     async def increment_letters_used(self, user_id: int) -> bool:
         """Увеличить счетчик использованных писем"""
-        def _increment():
+        async def _increment():
             try:
                 if not self.supabase:
                     return False
                     
                 # Получаем текущее значение
-                response = self.supabase.table('subscriptions').select('letters_used').eq('user_id', user_id).execute()
+                response = await self.supabase.table('subscriptions').select('letters_used').eq('user_id', user_id).execute()
                 
                 if response.data:
                     current_used = response.data[0]['letters_used']
                     new_used = current_used + 1
                     
-                    self.supabase.table('subscriptions').update({'letters_used': new_used}).eq('user_id', user_id).execute()
+                    await self.supabase.table('subscriptions').update({'letters_used': new_used}).eq('user_id', user_id).execute()
                     return True
                     
                 return False
@@ -389,12 +390,12 @@ class AnalyticsService:
     
     async def log_payment(self, payment_data: PaymentData) -> bool:
         """Логировать платеж"""
-        def _log_payment():
+        async def _log_payment():
             try:
                 if not self.supabase:
                     return False
                     
-                self.supabase.table('payments').insert(payment_data.to_dict()).execute()
+                await self.supabase.table('payments').insert(payment_data.to_dict()).execute()
                 return True
                 
             except Exception as e:
@@ -406,7 +407,7 @@ class AnalyticsService:
     
     async def update_payment_status(self, payment_id: str, status: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
         """Обновить статус платежа"""
-        def _update_payment():
+        async def _update_payment():
             try:
                 if not self.supabase:
                     return False
@@ -415,7 +416,7 @@ class AnalyticsService:
                 if metadata:
                     updates['metadata'] = metadata
                     
-                self.supabase.table('payments').update(updates).eq('payment_id', payment_id).execute()
+                await self.supabase.table('payments').update(updates).eq('payment_id', payment_id).execute()
                 return True
                 
             except Exception as e:
@@ -427,29 +428,16 @@ class AnalyticsService:
     
     async def log_letter_iteration(self, iteration_data: LetterIterationData) -> bool:
         """Логировать итерацию письма"""
-        def _log_iteration():
-            try:
-                if not self.supabase:
-                    return False
-                    
-                self.supabase.table('letter_iterations').insert(iteration_data.to_dict()).execute()
-                return True
-                
-            except Exception as e:
-                logger.error(f"Failed to log letter iteration: {e}")
-                return False
-        
-        result = await self._execute_async(_log_iteration)
-        return result is True
+        return await self._insert_buffered('letter_iterations', iteration_data.to_dict(), 'log letter iteration')
     
     async def get_session_iterations_count(self, session_id: str) -> int:
         """Получить количество итераций для сессии"""
-        def _get_count():
+        async def _get_count():
             try:
                 if not self.supabase:
                     return 0
                     
-                response = self.supabase.table('letter_iterations').select('id').eq('session_id', session_id).execute()
+                response = await self.supabase.table('letter_iterations').select('id').eq('session_id', session_id).execute()
                 return len(response.data) if response.data else 0
                 
             except Exception as e:
@@ -0,0 +1,210 @@
+"""
+Circuit breaker для AI-моделей
+
+Для каждой модели ведется скользящее окно результатов запросов. Если доля ошибок
+или медленных ответов превышает порог, цепь размыкается (OPEN): запросы к модели
+сразу отклоняются и выполняются fallback моделью без ожидания таймаута. После паузы
+модель проверяется одним пробным запросом (HALF_OPEN) - фоновой пробой из AIFactory
+или первым пользовательским запросом, если фоновые пробы не запущены.
+"""
+import logging
+import time
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, Optional, Tuple
+
+from config import (
+    CIRCUIT_BREAKER_ENABLED,
+    CIRCUIT_BREAKER_WINDOW_SECONDS,
+    CIRCUIT_BREAKER_MIN_REQUESTS,
+    CIRCUIT_BREAKER_ERROR_RATE,
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+    CIRCUIT_BREAKER_SLOW_CALL_RATE,
+    CIRCUIT_BREAKER_OPEN_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    """Состояние цепи"""
+    CLOSED = "closed"        # Модель работает, запросы проходят
+    OPEN = "open"            # Модель деградировала, запросы отклоняются
+    HALF_OPEN = "half_open"  # Идет пробный запрос
+
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен: цепь модели разомкнута"""
+
+    def __init__(self, model: str):
+        super().__init__(f"Circuit breaker is open for {model}")
+        self.model = model
+
+
+class CircuitBreaker:
+    """Circuit breaker одной модели, управляемый долей ошибок и задержкой"""
+
+    def __init__(self, name: str, enabled: bool = True, window_seconds: float = 60,
+                 min_requests: int = 5, error_rate: float = 0.5, slow_call_seconds: float = 30,
+                 slow_call_rate: float = 0.8, open_seconds: float = 30):
+        self.name = name
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        # (timestamp, успех, медленный)
+        self._outcomes: Deque[Tuple[float, bool, bool]] = deque()
+        self.stats = {'rejected': 0, 'opened': 0, 'probes': 0}
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] <= now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def _transition(self, state: CircuitState, reason: str = ""):
+        if state == self._state:
+            return
+        icons = {CircuitState.OPEN: "🔴", CircuitState.HALF_OPEN: "🟡", CircuitState.CLOSED: "🟢"}
+        logger.warning(f"{icons[state]} Circuit breaker {self.name}: {self._state.value} → {state.value} {reason}".rstrip())
+        self._state = state
+        if state == CircuitState.OPEN:
+            self._opened_at = time.monotonic()
+            self.stats['opened'] += 1
+        if state == CircuitState.CLOSED:
+            self._outcomes.clear()
+
+    def is_open(self) -> bool:
+        """Цепь разомкнута и пробовать модель пока рано (без изменения состояния)"""
+        if not self.enabled:
+            return False
+        if self._state == CircuitState.OPEN:
+            return time.monotonic() - self._opened_at < self.open_seconds
+        return self._state == CircuitState.HALF_OPEN and self._trial_in_flight
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос к модели (после паузы пропускает один пробный запрос)"""
+        if not self.enabled or self._state == CircuitState.CLOSED:
+            return True
+        if self.begin_probe():
+            return True
+        self.stats['rejected'] += 1
+        return False
+
+    def ready_for_probe(self) -> bool:
+        """Пауза после размыкания истекла и можно проверять модель"""
+        return (self.enabled and self._state == CircuitState.OPEN
+                and time.monotonic() - self._opened_at >= self.open_seconds)
+
+    def begin_probe(self) -> bool:
+        """Занять единственный пробный запрос в состоянии HALF_OPEN"""
+        if self._state == CircuitState.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            self.stats['probes'] += 1
+            return True
+        if self.ready_for_probe():
+            self._transition(CircuitState.HALF_OPEN)
+            self._trial_in_flight = True
+            self.stats['probes'] += 1
+            return True
+        return False
+
+    def record_success(self, latency: float):
+        """Учесть успешный ответ модели"""
+        if not self.enabled:
+            return
+        slow = latency >= self.slow_call_seconds
+        if self._state == CircuitState.HALF_OPEN:
+            self._trial_in_flight = False
+            if slow:
+                self._transition(CircuitState.OPEN, f"(пробный запрос {latency:.1f}s)")
+            else:
+                self._transition(CircuitState.CLOSED)
+            return
+        self._record(True, slow)
+
+    def record_failure(self):
+        """Учесть ошибку или таймаут модели"""
+        if not self.enabled:
+            return
+        if self._state == CircuitState.HALF_OPEN:
+            self._trial_in_flight = False
+            self._transition(CircuitState.OPEN, "(пробный запрос неуспешен)")
+            return
+        self._record(False, False)
+
+    def record_cancelled(self):
+        """Запрос отменен (проиграл хедж) - результат не учитывается"""
+        if self._state == CircuitState.HALF_OPEN:
+            self._trial_in_flight = False
+
+    def _record(self, success: bool, slow: bool):
+        now = time.monotonic()
+        self._trim(now)
+        self._outcomes.append((now, success, slow))
+        if self._state != CircuitState.CLOSED or len(self._outcomes) < self.min_requests:
+            return
+
+        total = len(self._outcomes)
+        failures = sum(1 for _, ok, _ in self._outcomes if not ok)
+        slow_calls = sum(1 for _, _, is_slow in self._outcomes if is_slow)
+        if failures / total >= self.error_rate:
+            self._transition(CircuitState.OPEN, f"(ошибок {failures}/{total})")
+        elif slow_calls / total >= self.slow_call_rate:
+            self._transition(CircuitState.OPEN, f"(медленных ответов {slow_calls}/{total})")
+
+    def get_stats(self) -> dict:
+        self._trim(time.monotonic())
+        total = len(self._outcomes)
+        failures = sum(1 for _, ok, _ in self._outcomes if not ok)
+        return {
+            'state': self._state.value,
+            'requests_in_window': total,
+            'error_rate': round(failures / total, 3) if total else 0.0,
+            **self.stats
+        }
+
+
+class CircuitBreakerRegistry:
+    """Circuit breakers по именам моделей"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                model,
+                enabled=CIRCUIT_BREAKER_ENABLED,
+                window_seconds=CIRCUIT_BREAKER_WINDOW_SECONDS,
+                min_requests=CIRCUIT_BREAKER_MIN_REQUESTS,
+                error_rate=CIRCUIT_BREAKER_ERROR_RATE,
+                slow_call_seconds=CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+                slow_call_rate=CIRCUIT_BREAKER_SLOW_CALL_RATE,
+                open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS
+            )
+            self._breakers[model] = breaker
+        return breaker
+
+    def find(self, model: str) -> Optional[CircuitBreaker]:
+        return self._breakers.get(model)
+
+    def items(self):
+        return list(self._breakers.items())
+
+    def get_stats(self) -> dict:
+        return {model: breaker.get_stats() for model, breaker in self._breakers.items()}
+
+
+# Глобальный реестр (используется ai_hedging и AIFactory)
+circuit_breakers = CircuitBreakerRegistry()
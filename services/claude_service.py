@@ -4,9 +4,15 @@
 import asyncio
 import logging
 import time
-from typing import Optional
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, List, Optional
 import anthropic
-from .ai_service import AIService
+from .ai_service import AIService, continuation_suffix, estimate_tokens, iterate_with_idle_timeout
+from .adaptive_limits import adaptive_limits
+from .ai_hedging import hedged_request, hedged_stream
+from .rate_governor import rate_governor
+from .single_flight import ai_single_flight, request_fingerprint
+from .token_metering import metering_context, token_meter
 from config import (
     ANTHROPIC_API_KEY,
     CLAUDE_MODEL,
@@ -14,8 +20,12 @@ from config import (
     CLAUDE_TIMEOUT,
     CLAUDE_MAX_TOKENS,
     CLAUDE_TEMPERATURE,
+    CLAUDE_VARIANTS_STAGGER,
     MAX_GENERATION_ATTEMPTS,
-    MIN_RESPONSE_LENGTH
+    AI_MAX_CONTINUATIONS,
+    MIN_RESPONSE_LENGTH,
+    STREAM_IDLE_TIMEOUT,
+    CIRCUIT_BREAKER_PROBE_TIMEOUT
 )
 
 # Настройка логирования
@@ -36,11 +46,20 @@ def _extract_text_from_response(response) -> Optional[str]:
     return None
 
 
+def _is_truncated(response) -> bool:
+    """Ответ Claude обрезан по max_tokens"""
+    return bool(response and response.stop_reason == 'max_tokens')
+
+
 class ClaudeService(AIService):
     """Сервис для работы с Anthropic Claude API"""
     
+    model_name = CLAUDE_MODEL
+    models = (CLAUDE_MODEL, CLAUDE_FALLBACK_MODEL)
+    
     def __init__(self):
-        self.client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+        # Без повторов SDK (см. ai_hedging)
+        self.client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
         self._stats_callback = None
     
     def set_stats_callback(self, callback):
@@ -124,6 +143,156 @@ class ClaudeService(AIService):
         # Если дошли до сюда, значит все попытки неуспешны
         return False
 
+    async def _create_message(
+        self,
+        model: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        timeout: Optional[float] = None,
+        cache_prompt: bool = False,
+        continuation: Optional[str] = None,
+        request_type: Optional[str] = None
+    ):
+        """
+        messages.create через rate governor: ждет квоту RPM/TPM модели
+        и корректирует ее по фактическому usage ответа
+
+        cache_prompt=True помечает промпт для prompt caching Anthropic: повторные
+        запросы с тем же промптом в течение ~5 минут читают его из кэша.
+        continuation - обрезанная часть ответа, передается префиллом ассистента:
+        модель продолжает текст с места обрыва.
+        С request_type max_tokens и timeout служат значениями по умолчанию:
+        реальные берутся из перцентилей прошлых ответов (см. adaptive_limits).
+        """
+        if request_type:
+            max_tokens = adaptive_limits.max_tokens(request_type, model, max_tokens)
+            timeout = adaptive_limits.timeout(request_type, model, timeout)
+        content = prompt
+        if cache_prompt:
+            content = [{"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}]
+        messages = [
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+        if continuation:
+            # API не принимает префилл, оканчивающийся пробелами
+            messages.append({"role": "assistant", "content": continuation.rstrip()})
+        expected_tokens = estimate_tokens(prompt + (continuation or '')) + max_tokens
+        async with rate_governor.reserve(ANTHROPIC_API_KEY, model, expected_tokens) as reservation:
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    self.client.messages.create(
+                        model=model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        messages=messages
+                    ),
+                    timeout=timeout
+                )
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and request_type and timeout:
+                    adaptive_limits.record_timeout(request_type, model, timeout)
+                token_meter.record(
+                    'anthropic', model, request_type, 0, 0, time.monotonic() - started, success=False,
+                    error_message="Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)[:500],
+                    continuation=bool(continuation)
+                )
+                raise
+            self._record_usage(
+                model, request_type, response, time.monotonic() - started, continuation=bool(continuation)
+            )
+            if response.usage:
+                reservation.used_tokens = response.usage.input_tokens + response.usage.output_tokens
+                if request_type:
+                    adaptive_limits.record(
+                        request_type, model, response.usage.output_tokens,
+                        time.monotonic() - started, truncated=_is_truncated(response)
+                    )
+            return response
+
+    @staticmethod
+    def _record_usage(model: str, request_type: Optional[str], response, latency: float,
+                      continuation: bool = False, user_id: Optional[int] = None,
+                      session_id: Optional[str] = None):
+        """Учет токенов ответа Claude, включая запись и чтение кэша промпта"""
+        usage = response.usage if response else None
+        text = _extract_text_from_response(response)
+        token_meter.record(
+            'anthropic', model, request_type,
+            usage.input_tokens if usage else 0,
+            usage.output_tokens if usage else 0,
+            latency,
+            success=bool(text),
+            error_message=None if text else "Empty response",
+            continuation=continuation,
+            cache_write_tokens=(getattr(usage, 'cache_creation_input_tokens', 0) or 0) if usage else 0,
+            cache_read_tokens=(getattr(usage, 'cache_read_input_tokens', 0) or 0) if usage else 0,
+            user_id=user_id,
+            session_id=session_id
+        )
+
+    async def probe_model(self, model: str) -> bool:
+        """Короткий пробный запрос к модели в обход хеджирования и circuit breaker"""
+        try:
+            response = await asyncio.wait_for(
+                self.client.messages.create(
+                    model=model,
+                    max_tokens=5,
+                    temperature=0.1,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": "Тест"
+                        }
+                    ]
+                ),
+                timeout=CIRCUIT_BREAKER_PROBE_TIMEOUT
+            )
+            return bool(_extract_text_from_response(response))
+        except Exception as e:
+            logger.warning(f"⚠️ Проба модели {model} неуспешна: {e}")
+            return False
+
+    async def _continue_truncated(
+        self,
+        model: str,
+        prompt: str,
+        text: str,
+        max_tokens: int,
+        temperature: float,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> str:
+        """
+        Дописывает ответ, обрезанный по max_tokens, запросами продолжения
+
+        Почти готовое письмо не выбрасывается: обрезанный текст передается
+        префиллом ассистента, и модель пишет только недостающий конец.
+        """
+        for attempt in range(AI_MAX_CONTINUATIONS):
+            logger.info(f"✂️ Ответ Claude обрезан по max_tokens ({len(text)} символов), запрашиваю продолжение #{attempt + 1}")
+            try:
+                response = await self._create_message(
+                    model, prompt, max_tokens=max_tokens, temperature=temperature,
+                    timeout=CLAUDE_TIMEOUT, continuation=text, request_type=f"{request_type}_continuation"
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось получить продолжение ответа Claude: {e}")
+                break
+            
+            tail = _extract_text_from_response(response)
+            if not tail:
+                break
+            text += continuation_suffix(text, tail)
+            if not _is_truncated(response):
+                break
+        return text
+
     async def get_completion(
         self, 
         prompt: str, 
@@ -146,7 +315,30 @@ class ClaudeService(AIService):
             
         Returns:
             Ответ от Claude или None в случае ошибки
+
+        Одинаковый запрос того же пользователя, который уже выполняется,
+        не отправляется повторно - ждет общий результат (см. single_flight).
         """
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens
+        )
+        with metering_context(user_id, session_id, request_type):
+            return await ai_single_flight.do(
+                key,
+                lambda: self._get_completion(prompt, temperature, max_tokens, user_id, session_id, request_type)
+            )
+
+    async def _get_completion(
+        self, 
+        prompt: str, 
+        temperature: float = 0.7, 
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> Optional[str]:
+        """Запрос к Claude с хеджированием (без объединения одинаковых вызовов)"""
         start_time = time.time()
         used_model = CLAUDE_MODEL
         
@@ -158,19 +350,15 @@ class ClaudeService(AIService):
             request_start = time.time()
             logger.info(f"⏱️ Начинаю запрос к Claude API в {request_start:.2f}s")
             
-            response = await asyncio.wait_for(
-                self.client.messages.create(
-                    model=CLAUDE_MODEL,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ]
+            # Fallback модель запускается параллельно, если основная не ответила за p90
+            response, used_model = await hedged_request(
+                lambda model: self._create_message(
+                    model, prompt, max_tokens=max_tokens, temperature=temperature,
+                    timeout=CLAUDE_TIMEOUT, request_type=request_type
                 ),
-                timeout=CLAUDE_TIMEOUT
+                CLAUDE_MODEL,
+                CLAUDE_FALLBACK_MODEL,
+                is_valid=lambda response: bool(_extract_text_from_response(response))
             )
             
             # Логируем время получения ответа
@@ -190,18 +378,10 @@ class ClaudeService(AIService):
                 content = text_content
                 total_time = time.time() - start_time
                 logger.info(f"✅ Получен ответ от Claude: {len(content)} символов за {total_time:.2f}s")
-                
-                # 📊 АНАЛИТИКА: Логируем успешный запрос
-                await self._log_claude_request(
-                    model=used_model,
-                    request_type=request_type,
-                    input_tokens=response.usage.input_tokens if response.usage else 0,
-                    output_tokens=response.usage.output_tokens if response.usage else 0,
-                    response_time_ms=response_time_ms,
-                    success=True,
-                    user_id=user_id,
-                    session_id=session_id
-                )
+                if _is_truncated(response):
+                    content = await self._continue_truncated(
+                        used_model, prompt, content, max_tokens, temperature, user_id, session_id, request_type
+                    )
                 
                 # Сохраняем статистику для анализатора (если есть callback)
                 if hasattr(self, '_stats_callback') and self._stats_callback:
@@ -213,35 +393,11 @@ class ClaudeService(AIService):
                 
                 return content
             else:
-                logger.error("❌ Claude вернул пустой ответ")
-                # 📊 АНАЛИТИКА: Логируем пустой ответ
-                await self._log_claude_request(
-                    model=used_model,
-                    request_type=request_type,
-                    input_tokens=0,
-                    output_tokens=0,
-                    response_time_ms=response_time_ms,
-                    success=False,
-                    user_id=user_id,
-                    session_id=session_id,
-                    error_message="Empty response"
-                )
+                logger.error(f"❌ Claude вернул пустой ответ за {response_time_ms}ms")
                 return None
                 
         except asyncio.TimeoutError:
             logger.error("❌ Таймаут запроса к Claude")
-            # 📊 АНАЛИТИКА: Логируем таймаут
-            await self._log_claude_request(
-                model=used_model,
-                request_type=request_type,
-                input_tokens=0,
-                output_tokens=0,
-                response_time_ms=response_time_ms,
-                success=False,
-                user_id=user_id,
-                session_id=session_id,
-                error_message="Timeout"
-            )
             return None
         except Exception as e:
             logger.error(f"❌ Ошибка запроса к Claude: {e}")
@@ -264,12 +420,198 @@ class ClaudeService(AIService):
             except Exception as log_error:
                 logger.error(f"Failed to log Claude error to database: {log_error}")
             
-            # Пробуем fallback модель
+            # Обе модели Claude недоступны - последняя попытка через OpenAI
+            logger.warning("🔄 Claude недоступен, переключаюсь на OpenAI...")
             try:
-                logger.info(f"🔄 Пробую fallback модель {CLAUDE_FALLBACK_MODEL}...")
-                response = await asyncio.wait_for(
-                    self.client.messages.create(
-                        model=CLAUDE_FALLBACK_MODEL,
+                # Берем общий экземпляр из фабрики (импорт здесь - во избежание циклического импорта)
+                from .ai_factory import AIFactory
+                fallback_service = AIFactory.get_provider_service('openai')
+                openai_result = await fallback_service.generate_personalized_letter(prompt, temperature)
+                if openai_result:
+                    logger.info("✅ OpenAI сработал как fallback для Claude")
+                    return openai_result
+            except Exception as openai_e:
+                logger.error(f"❌ OpenAI fallback тоже не работает: {openai_e}")
+
+            return None
+
+    async def get_completions(
+        self,
+        prompt: str,
+        n: int = 2,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> List[str]:
+        """
+        n вариантов параллельными запросами с общим кэшированным промптом
+
+        У Messages API нет параметра n. Первый запрос записывает промпт в кэш,
+        остальные стартуют через CLAUDE_VARIANTS_STAGGER секунд (или сразу после
+        первого ответа) и читают промпт из кэша - дешевле и почти без добавочной задержки.
+        """
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens, n=n
+        )
+        with metering_context(user_id, session_id, request_type):
+            return await ai_single_flight.do(
+                key,
+                lambda: self._get_completions(prompt, n, temperature, max_tokens, user_id, session_id, request_type)
+            )
+
+    async def _get_variant(
+        self,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> Optional[str]:
+        """Один вариант для get_completions (с хеджированием и кэшем промпта)"""
+        start_time = time.time()
+        used_model = CLAUDE_MODEL
+        try:
+            response, used_model = await hedged_request(
+                lambda model: self._create_message(
+                    model, prompt, max_tokens=max_tokens, temperature=temperature,
+                    timeout=CLAUDE_TIMEOUT, cache_prompt=True, request_type=request_type
+                ),
+                CLAUDE_MODEL,
+                CLAUDE_FALLBACK_MODEL,
+                is_valid=lambda response: bool(_extract_text_from_response(response))
+            )
+        except Exception as e:
+            error_message = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"❌ Ошибка запроса варианта к Claude за {time.time() - start_time:.2f}s: {error_message}")
+            return None
+        
+        text_content = _extract_text_from_response(response)
+        usage = response.usage
+        if usage:
+            logger.info(
+                f"🧊 Кэш промпта Claude: записано {getattr(usage, 'cache_creation_input_tokens', 0) or 0}, "
+                f"прочитано {getattr(usage, 'cache_read_input_tokens', 0) or 0} токенов"
+            )
+        if text_content and self._stats_callback:
+            self._stats_callback(
+                model=used_model,
+                tokens=(usage.input_tokens + usage.output_tokens) if usage else 0
+            )
+        if text_content and _is_truncated(response):
+            text_content = await self._continue_truncated(
+                used_model, prompt, text_content, max_tokens, temperature, user_id, session_id, request_type
+            )
+        return text_content
+
+    async def _get_completions(
+        self,
+        prompt: str,
+        n: int,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> List[str]:
+        def start_variant() -> asyncio.Task:
+            return asyncio.ensure_future(
+                self._get_variant(prompt, temperature, max_tokens, user_id, session_id, request_type)
+            )
+        
+        logger.info(f"🤖 Запрашиваю у Claude {n} вариантов (temp={temperature}, max_tokens={max_tokens})")
+        tasks = [start_variant()]
+        try:
+            await asyncio.wait(tasks, timeout=CLAUDE_VARIANTS_STAGGER)
+            tasks.extend(start_variant() for _ in range(n - 1))
+            results = await asyncio.gather(*tasks)
+        finally:
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            # Дожидаемся отмены: слоты планировщика и резервы квоты освобождаются сразу
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+        
+        variants = [text for text in results if text]
+        logger.info(f"✅ Получено вариантов от Claude: {len(variants)} из {n}")
+        return variants
+
+    async def stream_completion(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый запрос к Claude: отдает фрагменты текста по мере генерации
+
+        Если основная модель не выдала первый фрагмент за p90, параллельно
+        запускается fallback модель (см. ai_hedging.hedged_stream). После первого
+        фрагмента ошибка пробрасывается вызывающему коду (часть письма уже показана).
+        Повторный одинаковый поток получает готовый текст ведущего одним фрагментом.
+
+        Args:
+            prompt: Промпт для Claude
+            temperature: Температура для генерации
+            max_tokens: Максимальное количество токенов
+            user_id: ID пользователя для аналитики
+            session_id: ID сессии для аналитики
+            request_type: Тип запроса для аналитики
+
+        Yields:
+            Фрагменты (дельты) текста ответа
+        """
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens, stream=True
+        )
+        stream = ai_single_flight.stream(
+            key,
+            lambda: hedged_stream(
+                lambda model: self._stream_model(
+                    model, prompt, temperature, max_tokens, user_id, session_id, request_type
+                ),
+                CLAUDE_MODEL,
+                CLAUDE_FALLBACK_MODEL
+            )
+        )
+        async for delta in stream:
+            yield delta
+
+    async def _stream_model(
+        self,
+        model: str,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> AsyncIterator[str]:
+        """Потоковый запрос к одной модели Claude с логированием в аналитику"""
+        start_time = time.time()
+        received_chars = 0
+        parts = []
+        try:
+            max_tokens = adaptive_limits.max_tokens(request_type, model, max_tokens)
+            logger.info(f"🌊 Потоковый запрос к Claude {model} (temp={temperature}, max_tokens={max_tokens})")
+
+            estimated_tokens = estimate_tokens(prompt) + max_tokens
+            # Открытие потока и первый фрагмент - в пределах таймаута попытки,
+            # дальше STREAM_IDLE_TIMEOUT ограничивает только паузы между фрагментами
+            open_timeout = adaptive_limits.timeout(request_type, model, CLAUDE_TIMEOUT)
+            async with rate_governor.reserve(ANTHROPIC_API_KEY, model, estimated_tokens) as reservation:
+                async with AsyncExitStack() as stack:
+                    first_chunk_deadline = time.monotonic() + open_timeout
+                    stream = await asyncio.wait_for(stack.enter_async_context(self.client.messages.stream(
+                        model=model,
                         max_tokens=max_tokens,
                         temperature=temperature,
                         messages=[
@@ -278,35 +620,57 @@ class ClaudeService(AIService):
                                 "content": prompt
                             }
                         ]
-                    ),
-                    timeout=CLAUDE_TIMEOUT
+                    )), timeout=open_timeout)
+                    first_timeout = max(0.0, first_chunk_deadline - time.monotonic())
+                    async for delta in iterate_with_idle_timeout(stream.text_stream, STREAM_IDLE_TIMEOUT, first_timeout):
+                        if not delta:
+                            continue
+                        if not received_chars:
+                            logger.info(f"⚡ Первый фрагмент от Claude через {time.time() - start_time:.2f}s")
+                        received_chars += len(delta)
+                        parts.append(delta)
+                        yield delta
+
+                    final_message = await stream.get_final_message()
+
+                if final_message and final_message.usage:
+                    reservation.used_tokens = final_message.usage.input_tokens + final_message.usage.output_tokens
+
+            response_time_ms = int((time.time() - start_time) * 1000)
+            logger.info(f"✅ Поток Claude завершен: {received_chars} символов за {response_time_ms}ms")
+
+            # 📊 АНАЛИТИКА: Логируем потоковый запрос
+            usage = final_message.usage if final_message else None
+            if usage and received_chars:
+                adaptive_limits.record(
+                    request_type, model, usage.output_tokens, response_time_ms / 1000,
+                    truncated=_is_truncated(final_message)
                 )
-                
-                text_content = _extract_text_from_response(response)
-                if text_content:
-                    logger.info(f"✅ Fallback модель ответила: {len(text_content)} символов")
-                    return text_content
-                else:
-                    logger.error("❌ Fallback модель вернула пустой ответ")
-                    return None
-                    
-            except Exception as fallback_e:
-                logger.error(f"❌ Fallback модель тоже не работает: {fallback_e}")
-                
-                # Последняя попытка - переключиться на OpenAI
-                logger.warning("🔄 Claude недоступен, переключаюсь на OpenAI...")
-                try:
-                    # Избегаем циклического импорта, используя прямой импорт класса
-                    from .openai_service import OpenAIService
-                    fallback_service = OpenAIService()
-                    openai_result = await fallback_service.generate_personalized_letter(prompt, temperature)
-                    if openai_result:
-                        logger.info("✅ OpenAI сработал как fallback для Claude")
-                        return openai_result
-                except Exception as openai_e:
-                    logger.error(f"❌ OpenAI fallback тоже не работает: {openai_e}")
-                
-                return None
+            self._record_usage(
+                model, request_type, final_message, response_time_ms / 1000,
+                user_id=user_id, session_id=session_id
+            )
+
+            # Поток уперся в max_tokens - дописываем конец одним фрагментом
+            if _is_truncated(final_message) and parts:
+                text = ''.join(parts)
+                with metering_context(user_id, session_id, request_type):
+                    continued = await self._continue_truncated(
+                        model, prompt, text, max_tokens, temperature, user_id, session_id, request_type
+                    )
+                if len(continued) > len(text):
+                    yield continued[len(text):]
+
+        except Exception as e:
+            error_message = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"❌ Ошибка потокового запроса к Claude {model}: {error_message}")
+            token_meter.record(
+                'anthropic', model, request_type, estimate_tokens(prompt) if received_chars else 0,
+                estimate_tokens(''.join(parts)) if parts else 0, time.time() - start_time,
+                success=False, error_message=error_message[:500],
+                estimated=True, user_id=user_id, session_id=session_id
+            )
+            raise
 
     async def generate_personalized_letter(self, prompt: str, temperature: Optional[float] = None) -> Optional[str]:
         """
@@ -322,15 +686,17 @@ class ClaudeService(AIService):
         # Используем переданную температуру или берем из конфигурации
         temp = temperature if temperature is not None else CLAUDE_TEMPERATURE
         
-        # Пробуем сгенерировать письмо с несколькими попытками
+        with metering_context(None, None, "personalized_letter"):
+            return await self._generate_personalized_letter(prompt, temp)
+
+    async def _generate_personalized_letter(self, prompt: str, temp: float) -> Optional[str]:
+        """Попытки персонализированной генерации (все учитываются за один запрос)"""
         for attempt in range(MAX_GENERATION_ATTEMPTS):
             try:
                 logger.info(f"Персонализированная генерация #{attempt + 1} (temp={temp})")
                 
-                response = await asyncio.wait_for(
-                    self._make_claude_request(prompt, temp),
-                    timeout=CLAUDE_TIMEOUT
-                )
+                # Таймаут - у каждой попытки к модели (адаптивный, см. adaptive_limits)
+                response = await self._make_claude_request(prompt, temp)
                 
                 if response and self._is_response_complete(response):
                     logger.info("Успешно сгенерировано персонализированное письмо")
@@ -358,51 +724,28 @@ class ClaudeService(AIService):
             Ответ от Claude или None в случае ошибки
         """
         try:
-            # Сначала пробуем основную модель
-            response = await self.client.messages.create(
-                model=CLAUDE_MODEL,
-                max_tokens=CLAUDE_MAX_TOKENS,
-                temperature=temperature,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
+            # Основная модель с хеджированием fallback моделью
+            response, used_model = await hedged_request(
+                lambda model: self._create_message(
+                    model, prompt, max_tokens=CLAUDE_MAX_TOKENS, temperature=temperature,
+                    timeout=CLAUDE_TIMEOUT, request_type="personalized_letter"
+                ),
+                CLAUDE_MODEL,
+                CLAUDE_FALLBACK_MODEL,
+                is_valid=lambda response: bool(_extract_text_from_response(response))
             )
-            
+
             text_content = _extract_text_from_response(response)
-            if text_content:
-                return text_content
-            else:
-                return None
-            
-        except Exception as e:
-            logger.warning(f"Ошибка с моделью {CLAUDE_MODEL}: {e}")
-            
-            # Пробуем fallback модель
-            try:
-                response = await self.client.messages.create(
-                    model=CLAUDE_FALLBACK_MODEL,
-                    max_tokens=CLAUDE_MAX_TOKENS,
-                    temperature=temperature,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ]
+            if text_content and _is_truncated(response):
+                text_content = await self._continue_truncated(
+                    used_model, prompt, text_content, CLAUDE_MAX_TOKENS, temperature,
+                    request_type="personalized_letter"
                 )
-                
-                text_content = _extract_text_from_response(response)
-                if text_content:
-                    return text_content
-                else:
-                    return None
-                
-            except Exception as fallback_e:
-                logger.error(f"Ошибка с fallback моделью {CLAUDE_FALLBACK_MODEL}: {fallback_e}")
-                return None
+            return text_content
+
+        except Exception as e:
+            logger.error(f"Ошибка с моделями {CLAUDE_MODEL}/{CLAUDE_FALLBACK_MODEL}: {e}")
+            return None
 
     def _is_response_complete(self, response: str) -> bool:
         """
@@ -442,46 +785,6 @@ class ClaudeService(AIService):
         logger.warning(f"Ответ не заканчивается корректно: '{response[-50:]}'")
         return False
 
-    async def _log_claude_request(
-        self,
-        model: str,
-        request_type: str,
-        input_tokens: int,
-        output_tokens: int,
-        response_time_ms: int,
-        success: bool,
-        user_id: Optional[int] = None,
-        session_id: Optional[str] = None,
-        error_message: Optional[str] = None
-    ) -> None:
-        """
-        Логирует запрос к Claude в базу данных
-        """
-        try:
-            # Импортируем здесь чтобы избежать циклических импортов
-            from services.analytics_service import analytics  # Используем глобальный экземпляр
-            from models.analytics_models import OpenAIRequestData  # Используем ту же модель
-            
-            # Адаптируем под формат Claude
-            request_data = OpenAIRequestData(
-                model=model,
-                request_type=request_type,
-                prompt_tokens=input_tokens,
-                completion_tokens=output_tokens,
-                total_tokens=input_tokens + output_tokens,
-                response_time_ms=response_time_ms,
-                success=success,
-                user_id=user_id,
-                session_id=session_id,
-                error_message=error_message
-            )
-            
-            await analytics.log_openai_request(request_data)  # Используем тот же метод
-        except Exception as e:
-            # Логируем ошибку, но не прерываем основной процесс
-            logger.error(f"Ошибка при логировании Claude запроса: {e}")
-
-
 # УДАЛЕН: Глобальный экземпляр убран во избежание конфликтов с AI Factory
 # Используйте ai_factory.get_ai_service() для получения экземпляра
 
@@ -0,0 +1,154 @@
+"""
+Именованные ограниченные пулы потоков для блокирующих операций
+
+Раньше все блокирующие вызовы шли в общий пул asyncio по умолчанию
+(loop.run_in_executor(None, ...)): всплеск фоновых записей в кэш мог занять все
+потоки, и чтение, которого ждет пользователь, вставало в очередь за ними.
+Теперь у каждого класса операций свой пул со своим лимитом очереди:
+
+* critical - чтения и записи, от которых зависит ответ пользователю
+  (SQLite кэша писем и выжимок, очередь генераций);
+* payments - синхронный SDK ЮKassa;
+* background - необязательные фоновые записи (кэши). При переполнении новые
+  задачи отбрасываются (ExecutorOverloaded), а не ждут.
+
+Запросы к Supabase идут через асинхронный клиент и пулы потоков не занимают.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, TypeVar
+
+from config import (
+    EXECUTOR_CRITICAL_WORKERS,
+    EXECUTOR_CRITICAL_QUEUE,
+    EXECUTOR_PAYMENTS_WORKERS,
+    EXECUTOR_PAYMENTS_QUEUE,
+    EXECUTOR_BACKGROUND_WORKERS,
+    EXECUTOR_BACKGROUND_QUEUE
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class ExecutorOverloaded(Exception):
+    """Пул с политикой сброса переполнен - задача не принята"""
+    pass
+
+
+class BoundedExecutor:
+    """
+    Пул потоков с ограничением задач в работе и в очереди
+
+    В пул допускается не больше max_workers + max_queue задач одновременно.
+    Остальные ждут места в event loop (backpressure) или, при shed_on_overload,
+    сразу получают ExecutorOverloaded.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, shed_on_overload: bool = False):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.shed_on_overload = shed_on_overload
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'{name}-pool')
+        # asyncio.Semaphore привязан к event loop (бот и webhook сервер работают в разных)
+        self._admission: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+        self._in_flight = 0
+        # Счетчики, которые меняются в потоках пула
+        self._thread_lock = threading.Lock()
+        self._running = 0
+
+        self.stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'shed': 0, 'waited': 0,
+            'max_in_flight': 0, 'queue_wait_sum': 0.0, 'queue_wait_max': 0.0
+        }
+
+    def _semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        semaphore = self._admission.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_workers + self.max_queue)
+            self._admission[loop] = semaphore
+        return semaphore
+
+    def _call(self, submitted_at: float, func: Callable[..., T]) -> T:
+        waited = time.monotonic() - submitted_at
+        with self._thread_lock:
+            self.stats['queue_wait_sum'] += waited
+            self.stats['queue_wait_max'] = max(self.stats['queue_wait_max'], waited)
+            self._running += 1
+        try:
+            return func()
+        finally:
+            with self._thread_lock:
+                self._running -= 1
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Выполнить блокирующую функцию в пуле"""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphore(loop)
+
+        if semaphore.locked():
+            if self.shed_on_overload:
+                self.stats['shed'] += 1
+                if self.stats['shed'] % 100 == 1:
+                    logger.warning(f"⚠️ Пул {self.name} переполнен, отброшено задач: {self.stats['shed']}")
+                raise ExecutorOverloaded(self.name)
+            self.stats['waited'] += 1
+
+        async with semaphore:
+            self.stats['submitted'] += 1
+            self._in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self._in_flight)
+            try:
+                call = functools.partial(func, *args, **kwargs)
+                result = await loop.run_in_executor(self._executor, self._call, time.monotonic(), call)
+                self.stats['completed'] += 1
+                return result
+            except Exception:
+                self.stats['failed'] += 1
+                raise
+            finally:
+                self._in_flight -= 1
+
+    def get_stats(self) -> dict:
+        """Загрузка пула для мониторинга"""
+        started = self.stats['completed'] + self.stats['failed']
+        return {
+            'workers': self.max_workers,
+            'queue_limit': self.max_queue,
+            'running': self._running,
+            'in_flight': self._in_flight,
+            'saturation': round(self._in_flight / (self.max_workers + self.max_queue), 2),
+            'submitted': self.stats['submitted'],
+            'completed': self.stats['completed'],
+            'failed': self.stats['failed'],
+            'shed': self.stats['shed'],
+            'waited': self.stats['waited'],
+            'max_in_flight': self.stats['max_in_flight'],
+            'avg_queue_wait_ms': round(self.stats['queue_wait_sum'] / started * 1000, 1) if started else 0.0,
+            'max_queue_wait_ms': round(self.stats['queue_wait_max'] * 1000, 1)
+        }
+
+
+# Глобальные пулы
+critical_executor = BoundedExecutor('critical', EXECUTOR_CRITICAL_WORKERS, EXECUTOR_CRITICAL_QUEUE)
+payments_executor = BoundedExecutor('payments', EXECUTOR_PAYMENTS_WORKERS, EXECUTOR_PAYMENTS_QUEUE)
+background_executor = BoundedExecutor(
+    'background', EXECUTOR_BACKGROUND_WORKERS, EXECUTOR_BACKGROUND_QUEUE, shed_on_overload=True
+)
+
+EXECUTORS: Dict[str, BoundedExecutor] = {
+    executor.name: executor for executor in (critical_executor, payments_executor, background_executor)
+}
+
+
+def get_executors_stats() -> dict:
+    """Статистика всех пулов"""
+    return {name: executor.get_stats() for name, executor in EXECUTORS.items()}
@@ -7,6 +7,7 @@ from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 from utils.database import SupabaseClient
+from services.session_writes import session_writes
 from models.feedback_models import (
     LetterFeedbackData, LetterIterationImprovement, SessionIterationStatus
 )
@@ -15,19 +16,16 @@ logger = logging.getLogger(__name__)
 
 class FeedbackService:
     def __init__(self):
-        self.supabase = SupabaseClient.get_client()
+        self.supabase = SupabaseClient.get_async_client()
         self.enabled = SupabaseClient.is_available()
         
     async def _execute_async(self, func, *args, **kwargs):
-        """Выполнить операцию асинхронно"""
+        """Выполнить операцию с БД (асинхронный клиент не блокирует event loop)"""
         if not self.enabled:
             return None
             
         try:
-            import asyncio
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(None, func, *args, **kwargs)
-            return result
+            return await func(*args, **kwargs)
         except Exception as e:
             logger.error(f"Feedback operation failed: {e}")
             return None
@@ -36,20 +34,26 @@ class FeedbackService:
     
     async def get_session_iteration_status(self, session_id: str) -> Optional[SessionIterationStatus]:
         """Получить статус итераций для сессии"""
-        def _get_status():
+        async def _get_status():
             try:
                 if not self.supabase:
                     return None
                 
-                # Получаем данные сессии
-                response = self.supabase.table('letter_sessions').select(
-                    'current_iteration, max_iterations, has_feedback'
-                ).eq('id', session_id).execute()
+                # Сессии, созданные и обновленные этим процессом, известны без чтения БД
+                session = session_writes.get_state(session_id)
+                if session is None or not all(
+                    key in session for key in ('current_iteration', 'max_iterations', 'has_feedback')
+                ):
+                    response = await self.supabase.table('letter_sessions').select(
+                        'current_iteration, max_iterations, has_feedback'
+                    ).eq('id', session_id).execute()
+                    
+                    if not response.data:
+                        return None
+                    
+                    session_writes.remember(session_id, response.data[0], from_db=True)
+                    session = session_writes.overlay(session_id, response.data[0])
                 
-                if not response.data:
-                    return None
-                
-                session = response.data[0]
                 current = session['current_iteration'] or 1
                 max_iter = session['max_iterations'] or 3
                 has_feedback = session['has_feedback'] or False
@@ -73,27 +77,32 @@ class FeedbackService:
         return await self._execute_async(_get_status)
     
     async def increment_session_iteration(self, session_id: str) -> bool:
-        """Увеличить номер итерации сессии"""
-        def _increment():
+        """Увеличить номер итерации сессии (запись уходит через буфер сессий)"""
+        async def _increment():
             try:
                 if not self.supabase:
                     return False
                 
-                # Получаем текущую итерацию
-                response = self.supabase.table('letter_sessions').select(
-                    'current_iteration'
-                ).eq('id', session_id).execute()
-                
-                if not response.data:
-                    return False
-                
-                current = response.data[0]['current_iteration'] or 1
+                # Текущая итерация: из памяти или из БД
+                current = (session_writes.get_state(session_id) or {}).get('current_iteration')
+                if current is None:
+                    response = await self.supabase.table('letter_sessions').select(
+                        'current_iteration'
+                    ).eq('id', session_id).execute()
+                    
+                    if not response.data:
+                        return False
+                    current = response.data[0]['current_iteration']
+                
+                current = current or 1
                 new_iteration = current + 1
+                updates = {'current_iteration': new_iteration}
                 
                 # Обновляем
-                self.supabase.table('letter_sessions').update({
-                    'current_iteration': new_iteration
-                }).eq('id', session_id).execute()
+                if not await session_writes.update(session_id, updates):
+                    await self.supabase.table('letter_sessions').update(
+                        updates, returning='minimal'
+                    ).eq('id', session_id).execute()
                 
                 logger.info(f"Session {session_id} iteration incremented: {current} -> {new_iteration}")
                 return True
@@ -109,7 +118,7 @@ class FeedbackService:
     
     async def save_feedback(self, feedback_data: LetterFeedbackData) -> bool:
         """Сохранить оценку пользователя (только лайк/дизлайк)"""
-        def _save_feedback():
+        async def _save_feedback():
             try:
                 if not self.supabase:
                     logger.warning("Supabase not available for feedback saving")
@@ -118,7 +127,7 @@ class FeedbackService:
                 logger.info(f"💬 Сохраняю обратную связь: {feedback_data.feedback_type} для сессии {feedback_data.session_id}")
                 
                 # Проверяем, что сессия существует
-                session_check = self.supabase.table('letter_sessions').select('id').eq(
+                session_check = await self.supabase.table('letter_sessions').select('id').eq(
                     'id', feedback_data.session_id
                 ).execute()
                 
@@ -127,7 +136,7 @@ class FeedbackService:
                     return False
                 
                 # Сохраняем обратную связь
-                self.supabase.table('letter_feedback').insert(
+                await self.supabase.table('letter_feedback').insert(
                     feedback_data.to_dict()
                 ).execute()
                 
@@ -144,12 +153,12 @@ class FeedbackService:
     
     async def get_session_feedback(self, session_id: str) -> List[Dict[str, Any]]:
         """Получить всю обратную связь по сессии"""
-        def _get_feedback():
+        async def _get_feedback():
             try:
                 if not self.supabase:
                     return []
                 
-                response = self.supabase.table('letter_feedback').select('*').eq(
+                response = await self.supabase.table('letter_feedback').select('*').eq(
                     'session_id', session_id
                 ).order('iteration_number').execute()
                 
@@ -167,7 +176,7 @@ class FeedbackService:
     async def save_letter_iteration(self, iteration_data: LetterIterationImprovement, 
                                   generated_letter: str, generation_time: int) -> bool:
         """Сохранить итерацию улучшенного письма"""
-        def _save_iteration():
+        async def _save_iteration():
             try:
                 if not self.supabase:
                     return False
@@ -180,7 +189,7 @@ class FeedbackService:
                     'created_at': datetime.now().isoformat()
                 })
                 
-                self.supabase.table('letter_iterations').insert(data).execute()
+                await self.supabase.table('letter_iterations').insert(data).execute()
                 logger.info(f"Letter iteration saved for session {iteration_data.session_id}")
                 return True
                 
@@ -0,0 +1,403 @@
+"""
+Надежная очередь задач генерации (SQLite) с пулом воркеров
+
+Обработчики Telegram только ставят задачу в очередь и сразу возвращаются, а письма
+пишут воркеры: их число задается отдельно от обработки обновлений. Задачи хранятся
+в локальном SQLite, поэтому письмо, которое писалось во время редеплоя, будет
+сгенерировано и доставлено после перезапуска. Задача, запросившая повтор (RetryJob),
+повторяется с экспоненциальной паузой; если попытки исчерпаны или задача упала
+с неожиданной ошибкой, вызывается on_failure (сообщить, что попытка не списана).
+Для ожидающей задачи, удаленной по /start или /cancel, вызывается on_cancel
+(вернуть зарезервированное задачей, например лимит писем пакета).
+
+Задача выполняется через generation_tasks, поэтому /start и /cancel отменяют ее
+так же, как раньше отменяли фоновую генерацию. Задачу, не успевшую завершиться при
+остановке бота, тоже прерывает CancelledError, но с job.interrupted = True: обработчик
+не должен считать ее отмененной - она выполнится заново после перезапуска.
+
+Задачи одного пользователя выполняются по одной: воркер не берет задачу пользователя,
+у которого уже есть выполняющаяся, - иначе реестр отменил бы ее как замененную
+новой генерацией.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from config import (
+    GENERATION_QUEUE_ENABLED,
+    GENERATION_QUEUE_PATH,
+    GENERATION_WORKERS,
+    GENERATION_MAX_ATTEMPTS,
+    GENERATION_RETRY_BASE_SECONDS,
+    GENERATION_RETRY_MAX_SECONDS
+)
+from .executors import critical_executor
+from .generation_tasks import generation_tasks
+
+logger = logging.getLogger(__name__)
+
+# Как часто свободный воркер проверяет очередь (задачи с отложенным повтором)
+POLL_INTERVAL_SECONDS = 2.0
+RETRY_JITTER = 0.2  # До +20% к паузе перед повтором
+
+
+class RetryJob(Exception):
+    """Задачу нужно повторить позже (пользователю еще ничего не отправлено)"""
+
+
+@dataclass
+class GenerationJob:
+    """Задача генерации; payload можно менять - он сохраняется перед повтором"""
+    id: int
+    kind: str
+    user_key: int
+    chat_id: int
+    payload: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 1
+    max_attempts: int = GENERATION_MAX_ATTEMPTS
+    # Задачу прервала остановка бота: она выполнится после перезапуска, это не отмена
+    interrupted: bool = False
+
+    @property
+    def is_last_attempt(self) -> bool:
+        return self.attempts >= self.max_attempts
+
+
+JobHandler = Callable[[GenerationJob], Awaitable[None]]
+
+
+class GenerationQueue:
+    """Персистентная очередь задач генерации с пулом воркеров"""
+
+    def __init__(self, sqlite_path: str, workers: int = 4, max_attempts: int = 3,
+                 retry_base: float = 5.0, retry_max: float = 120.0, enabled: bool = True):
+        self.enabled = enabled
+        self.sqlite_path = sqlite_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+        self._handlers: Dict[str, JobHandler] = {}
+        self._failure_handlers: Dict[str, JobHandler] = {}
+        self._cancel_handlers: Dict[str, JobHandler] = {}
+        self._sqlite_lock = threading.Lock()
+        self._sqlite_ready = False
+        self._workers: List[asyncio.Task] = []
+        self._running_jobs: Set[int] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+        self.stats = {'enqueued': 0, 'completed': 0, 'retried': 0, 'failed': 0, 'cancelled': 0, 'recovered': 0}
+
+    def register(self, kind: str, handler: JobHandler, on_failure: Optional[JobHandler] = None,
+                 on_cancel: Optional[JobHandler] = None):
+        """Зарегистрировать обработчик задач вида kind"""
+        self._handlers[kind] = handler
+        if on_failure:
+            self._failure_handlers[kind] = on_failure
+        if on_cancel:
+            self._cancel_handlers[kind] = on_cancel
+
+    # === SQLITE ===
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.sqlite_path, timeout=5)
+
+    def _init_sqlite(self) -> int:
+        directory = os.path.dirname(self.sqlite_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS generation_jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, user_key INTEGER NOT NULL, "
+                "chat_id INTEGER NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_run_at REAL NOT NULL, "
+                "created_at REAL NOT NULL, last_error TEXT)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS generation_jobs_due ON generation_jobs (status, next_run_at)"
+            )
+            # Задачи, которые выполнялись в момент остановки процесса, - снова в очередь
+            recovered = conn.execute(
+                "UPDATE generation_jobs SET status = 'queued', next_run_at = ? WHERE status = 'running'",
+                (time.time(),)
+            ).rowcount
+        return recovered
+
+    def _sqlite_insert(self, kind: str, user_key: int, chat_id: int, payload: str) -> int:
+        now = time.time()
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT INTO generation_jobs (kind, user_key, chat_id, payload, status, next_run_at, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (kind, user_key, chat_id, payload, now, now)
+            )
+            return cursor.lastrowid
+
+    def _sqlite_claim(self) -> Optional[tuple]:
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT id, kind, user_key, chat_id, payload, attempts FROM generation_jobs "
+                "WHERE status = 'queued' AND next_run_at <= ? AND user_key NOT IN "
+                "(SELECT user_key FROM generation_jobs WHERE status = 'running') "
+                "ORDER BY next_run_at, id LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE generation_jobs SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+                    (row[0],)
+                )
+            return row
+
+    def _sqlite_reschedule(self, job_id: int, payload: str, delay: float, error: str, count_attempt: bool):
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE generation_jobs SET status = 'queued', payload = ?, next_run_at = ?, last_error = ?, "
+                "attempts = attempts - ? WHERE id = ?",
+                (payload, time.time() + delay, error, 0 if count_attempt else 1, job_id)
+            )
+
+    def _sqlite_delete(self, job_id: int):
+        # Завершенные задачи не храним: в payload тексты вакансии и резюме
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM generation_jobs WHERE id = ?", (job_id,))
+
+    def _sqlite_delete_queued(self, user_key: int) -> List[tuple]:
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT id, kind, user_key, chat_id, payload, attempts FROM generation_jobs "
+                "WHERE user_key = ? AND status = 'queued'", (user_key,)
+            ).fetchall()
+            conn.executemany("DELETE FROM generation_jobs WHERE id = ?", [(row[0],) for row in rows])
+            return rows
+
+    def _sqlite_count(self) -> Dict[str, int]:
+        with self._sqlite_lock, closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM generation_jobs GROUP BY status").fetchall())
+
+    async def _run_sqlite(self, func, *args):
+        return await critical_executor.run(func, *args)
+
+    # === ПУБЛИЧНЫЙ API ===
+
+    async def start(self):
+        """Открыть очередь, вернуть в работу незавершенные задачи и запустить воркеры"""
+        if not self.enabled:
+            logger.info("📭 Очередь генераций выключена - задачи выполняются сразу")
+            return
+        try:
+            recovered = await self._run_sqlite(self._init_sqlite)
+            self._sqlite_ready = True
+        except Exception as e:
+            logger.error(f"❌ Очередь генераций недоступна, задачи выполняются без сохранения: {e}")
+            return
+
+        self.stats['recovered'] += recovered
+        if recovered:
+            logger.info(f"♻️ Восстановлено незавершенных генераций после перезапуска: {recovered}")
+
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.ensure_future(self._worker_loop(index)) for index in range(self.workers)
+        ]
+        logger.info(f"📬 Очередь генераций запущена: {self.workers} воркеров, файл {self.sqlite_path}")
+
+    async def enqueue(self, kind: str, user_key: int, chat_id: int, payload: Dict[str, Any]) -> Optional[int]:
+        """Поставить задачу в очередь (или выполнить сразу, если очередь недоступна)"""
+        self.stats['enqueued'] += 1
+        if not self._sqlite_ready:
+            job = GenerationJob(0, kind, user_key, chat_id, payload, attempts=1, max_attempts=1)
+            generation_tasks.start(user_key, self._execute_direct(job), name=f"generation:{kind}:{user_key}")
+            return None
+
+        job_id = await self._run_sqlite(
+            self._sqlite_insert, kind, user_key, chat_id, json.dumps(payload, ensure_ascii=False)
+        )
+        logger.info(f"📥 Задача {kind}#{job_id} поставлена в очередь (user={user_key})")
+        if self._wakeup:
+            self._wakeup.set()
+        return job_id
+
+    async def cancel_user(self, user_key: int, reason: str = "cancel"):
+        """Отменить задачи пользователя: ожидающие удаляются, выполняющаяся прерывается"""
+        if self._sqlite_ready:
+            try:
+                removed = await self._run_sqlite(self._sqlite_delete_queued, user_key)
+                if removed:
+                    self.stats['cancelled'] += len(removed)
+                    logger.info(f"⏹️ Удалено задач из очереди: {len(removed)} (user={user_key}, причина: {reason})")
+                for row in removed:
+                    await self._cancelled(self._job_from_row(row, attempted=False))
+            except Exception as e:
+                logger.error(f"❌ Не удалось удалить задачи пользователя из очереди: {e}")
+        generation_tasks.cancel(user_key, reason=reason)
+
+    async def stop(self, timeout: float):
+        """Дождаться выполняющихся задач; незавершенные остаются в очереди до перезапуска"""
+        if not self._workers:
+            return
+        self._stopping = True
+        if self._wakeup:
+            self._wakeup.set()
+        done, pending = await asyncio.wait(self._workers, timeout=timeout)
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if pending:
+            logger.warning("⏸️ Генерации, не успевшие завершиться, будут выполнены после перезапуска")
+
+    # === ВОРКЕРЫ ===
+
+    @staticmethod
+    async def _call(handler: JobHandler, job: GenerationJob) -> Optional[RetryJob]:
+        """Запрос повтора - штатный результат задачи, а не ошибка для generation_tasks"""
+        try:
+            await handler(job)
+        except RetryJob as e:
+            return e
+        return None
+
+    async def _execute_direct(self, job: GenerationJob):
+        """Режим без очереди: одна попытка, как обычная фоновая задача"""
+        handler = self._handlers[job.kind]
+        try:
+            await handler(job)
+        except RetryJob as e:
+            await self._fail(job, e)
+
+    async def _worker_loop(self, index: int):
+        while not self._stopping:
+            try:
+                row = await self._run_sqlite(self._sqlite_claim)
+            except Exception as e:
+                logger.error(f"❌ Воркер {index}: ошибка чтения очереди: {e}")
+                row = None
+
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job = self._job_from_row(row)
+            try:
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Воркер {index}: ошибка обработки {job.kind}#{job.id}: {e}")
+
+    def _job_from_row(self, row: tuple, attempted: bool = True) -> GenerationJob:
+        # Выбранная воркером задача уже получила attempts + 1 в БД
+        job_id, kind, user_key, chat_id, payload, attempts = row
+        return GenerationJob(job_id, kind, user_key, chat_id, json.loads(payload),
+                             attempts=attempts + (1 if attempted else 0), max_attempts=self.max_attempts)
+
+    async def _run_job(self, job: GenerationJob):
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            logger.error(f"❌ Нет обработчика для задачи {job.kind}#{job.id}")
+            await self._run_sqlite(self._sqlite_delete, job.id)
+            return
+
+        logger.info(f"⚙️ Выполняю {job.kind}#{job.id} (попытка {job.attempts}/{job.max_attempts})")
+        self._running_jobs.add(job.id)
+        task = generation_tasks.start(job.user_key, self._call(handler, job), name=f"generation:{job.kind}:{job.id}")
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            # Остановка бота: задача вернется в очередь и выполнится после перезапуска
+            job.interrupted = True
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await self._run_sqlite(
+                self._sqlite_reschedule, job.id, json.dumps(job.payload, ensure_ascii=False), 0, "shutdown", False
+            )
+            raise
+        finally:
+            self._running_jobs.discard(job.id)
+
+        if task.cancelled():
+            # /start, /cancel или новая генерация того же пользователя
+            self.stats['cancelled'] += 1
+            await self._run_sqlite(self._sqlite_delete, job.id)
+            return
+
+        error = task.exception() or task.result()
+        if error is None:
+            self.stats['completed'] += 1
+            await self._run_sqlite(self._sqlite_delete, job.id)
+            return
+
+        if isinstance(error, RetryJob) and not job.is_last_attempt:
+            delay = min(self.retry_max, self.retry_base * 2 ** (job.attempts - 1))
+            delay *= 1 + random.uniform(0, RETRY_JITTER)
+            self.stats['retried'] += 1
+            logger.warning(f"🔁 {job.kind}#{job.id} повторю через {delay:.0f}s: {error}")
+            await self._run_sqlite(
+                self._sqlite_reschedule, job.id, json.dumps(job.payload, ensure_ascii=False),
+                delay, str(error)[:500], True
+            )
+            return
+
+        await self._fail(job, error)
+        await self._run_sqlite(self._sqlite_delete, job.id)
+
+    async def _fail(self, job: GenerationJob, error: BaseException):
+        self.stats['failed'] += 1
+        logger.error(f"❌ {job.kind}#{job.id} не выполнена после {job.attempts} попыток: {error}")
+        on_failure = self._failure_handlers.get(job.kind)
+        if on_failure:
+            try:
+                await on_failure(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка on_failure для {job.kind}#{job.id}: {e}")
+
+    async def _cancelled(self, job: GenerationJob):
+        on_cancel = self._cancel_handlers.get(job.kind)
+        if on_cancel:
+            try:
+                await on_cancel(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка on_cancel для {job.kind}#{job.id}: {e}")
+
+    async def get_stats(self) -> dict:
+        counts = {}
+        if self._sqlite_ready:
+            try:
+                counts = await self._run_sqlite(self._sqlite_count)
+            except Exception:
+                pass
+        return {
+            **self.stats,
+            'queued': counts.get('queued', 0),
+            'running': len(self._running_jobs),
+            'workers': len(self._workers),
+            'durable': self._sqlite_ready
+        }
+
+
+# Глобальная очередь генераций
+generation_queue = GenerationQueue(
+    sqlite_path=GENERATION_QUEUE_PATH,
+    workers=GENERATION_WORKERS,
+    max_attempts=GENERATION_MAX_ATTEMPTS,
+    retry_base=GENERATION_RETRY_BASE_SECONDS,
+    retry_max=GENERATION_RETRY_MAX_SECONDS,
+    enabled=GENERATION_QUEUE_ENABLED
+)
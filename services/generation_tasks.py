@@ -0,0 +1,105 @@
+"""
+Реестр выполняющихся задач генерации писем по пользователям
+
+Генерации запускают воркеры очереди (generation_queue): каждая задача очереди
+выполняется через реестр. Реестр хранит сильные ссылки на задачи (иначе их может
+собрать GC), забирает их исключения и по user_key находит генерацию пользователя,
+чтобы отменить ее при /start или /cancel (отмена прерывает HTTP-запрос к провайдеру
+и экономит токены). Очередь не выдает воркерам вторую задачу пользователя, пока
+выполняется первая, поэтому замена генерации новой происходит только в режиме
+без очереди. При остановке бота реестр дожидается незавершенных задач.
+"""
+import asyncio
+import logging
+import time
+from typing import Coroutine, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationTaskRegistry:
+    """Не более одной активной генерации на пользователя"""
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._started_at: Dict[asyncio.Task, float] = {}
+        self.stats = {
+            'started': 0, 'completed': 0, 'failed': 0,
+            'cancelled': 0, 'superseded': 0,
+            'total_seconds': 0.0, 'max_seconds': 0.0
+        }
+
+    def start(self, user_key: Hashable, coro: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+        """Запустить генерацию, отменив предыдущую генерацию этого пользователя"""
+        previous = self._tasks.get(user_key)
+        if previous is not None and not previous.done():
+            logger.info(f"⏹️ Новая генерация заменяет незавершенную (user={user_key})")
+            self.stats['superseded'] += 1
+            previous.cancel()
+
+        task = asyncio.ensure_future(coro)
+        if name and hasattr(task, 'set_name'):
+            task.set_name(name)
+        self._tasks[user_key] = task
+        self._started_at[task] = time.monotonic()
+        self.stats['started'] += 1
+        task.add_done_callback(lambda done: self._on_done(user_key, done))
+        return task
+
+    def _on_done(self, user_key: Hashable, task: asyncio.Task):
+        duration = time.monotonic() - self._started_at.pop(task, time.monotonic())
+        if self._tasks.get(user_key) is task:
+            del self._tasks[user_key]
+
+        if task.cancelled():
+            self.stats['cancelled'] += 1
+            logger.info(f"⏹️ Генерация отменена через {duration:.1f}s (user={user_key})")
+            return
+
+        self.stats['total_seconds'] += duration
+        self.stats['max_seconds'] = max(self.stats['max_seconds'], duration)
+        error = task.exception()
+        if error is not None:
+            self.stats['failed'] += 1
+            logger.error(f"❌ Генерация завершилась ошибкой (user={user_key}): {error}", exc_info=error)
+        else:
+            self.stats['completed'] += 1
+
+    def cancel(self, user_key: Hashable, reason: str = "cancel") -> bool:
+        """Отменить активную генерацию пользователя; True если было что отменять"""
+        task = self._tasks.get(user_key)
+        if task is None or task.done():
+            return False
+        logger.info(f"⏹️ Отменяю генерацию (user={user_key}, причина: {reason})")
+        task.cancel()
+        return True
+
+    def is_running(self, user_key: Hashable) -> bool:
+        task = self._tasks.get(user_key)
+        return task is not None and not task.done()
+
+    async def drain(self, timeout: float):
+        """Дождаться незавершенных генераций (при остановке бота), остальные отменить"""
+        pending = [task for task in self._tasks.values() if not task.done()]
+        if not pending:
+            return
+        logger.info(f"⏳ Жду завершения {len(pending)} генераций (до {timeout:.0f}s)")
+        done, still_running = await asyncio.wait(pending, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.gather(*still_running, return_exceptions=True)
+            logger.warning(f"⏹️ Отменено генераций при остановке: {len(still_running)}")
+
+    def get_stats(self) -> dict:
+        finished = self.stats['completed'] + self.stats['failed']
+        return {
+            **{key: value for key, value in self.stats.items() if key != 'total_seconds'},
+            'active': sum(1 for task in self._tasks.values() if not task.done()),
+            'avg_seconds': round(self.stats['total_seconds'] / finished, 1) if finished else 0.0,
+            'max_seconds': round(self.stats['max_seconds'], 1)
+        }
+
+
+# Глобальный реестр генераций
+generation_tasks = GenerationTaskRegistry()
@@ -0,0 +1,165 @@
+"""
+Компактный контекст сессии для итераций улучшения письма
+
+Раньше каждая итерация отправляла в AI всю вакансию, все резюме и письмо, а перед
+этим заново читала строку сессии из БД. Теперь после генерации письма для сессии
+один раз собирается сжатый контекст: анализ вакансии (из общего кэша) или ее
+начало, выжимка резюме (строки с цифрами и ключевыми словами вакансии) и текущая
+версия письма. Улучшение отправляет только этот контекст и комментарий пользователя,
+а улучшенное письмо становится текущей версией для следующей итерации.
+"""
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Set
+
+from config import (
+    INCREMENTAL_IMPROVEMENT_ENABLED,
+    IMPROVEMENT_CONTEXT_MAX_SESSIONS,
+    IMPROVEMENT_CONTEXT_TTL_SECONDS,
+    IMPROVEMENT_VACANCY_BRIEF_CHARS,
+    IMPROVEMENT_RESUME_HIGHLIGHTS_CHARS
+)
+from .letter_cache import normalize_text
+from .vacancy_analysis import vacancy_analysis_cache, vacancy_fingerprint
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'[0-9a-zа-яё+#]{3,}', re.IGNORECASE)
+_DIGIT_RE = re.compile(r'\d')
+_BULLET_RE = re.compile(r'^\s*[-•*–—▪●]\s*')
+
+# Сколько совпадений с ключевыми словами вакансии учитывать в оценке строки
+MAX_KEYWORD_SCORE = 3
+
+
+@dataclass
+class ImprovementContext:
+    """Сжатые входные данные сессии для промпта улучшения"""
+    session_id: str
+    vacancy_brief: str
+    resume_highlights: str
+    current_letter: str
+    updated_at: float = field(default_factory=time.time)
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    """Обрезает текст по границе слова"""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars].rsplit(' ', 1)[0]
+    return cut.rstrip() + '…'
+
+
+def extract_resume_highlights(resume_text: str, vacancy_text: str = "",
+                              max_chars: int = IMPROVEMENT_RESUME_HIGHLIGHTS_CHARS) -> str:
+    """
+    Выжимка резюме для итераций улучшения
+
+    Строки оцениваются по наличию цифр (достижения), маркеров списка и слов из вакансии;
+    лучшие строки возвращаются в исходном порядке в пределах max_chars.
+    """
+    lines = [line for line in normalize_text(resume_text).split('\n') if line]
+    if sum(len(line) + 1 for line in lines) <= max_chars:
+        return '\n'.join(lines)
+
+    keywords: Set[str] = {word.lower() for word in _WORD_RE.findall(vacancy_text)}
+    scored = []
+    for index, line in enumerate(lines):
+        words = {word.lower() for word in _WORD_RE.findall(line)}
+        score = min(MAX_KEYWORD_SCORE, len(words & keywords))
+        if _DIGIT_RE.search(line):
+            score += 2
+        if _BULLET_RE.match(line):
+            score += 1
+        # Первые строки резюме обычно - должность и краткое "о себе"
+        if index < 3:
+            score += 1
+        scored.append((score, index, line))
+
+    selected = []
+    used = 0
+    for score, index, line in sorted(scored, key=lambda item: (-item[0], item[1])):
+        line = _truncate(line, max_chars // 3)
+        if used + len(line) + 1 > max_chars:
+            continue
+        selected.append((index, line))
+        used += len(line) + 1
+    return '\n'.join(line for _, line in sorted(selected))
+
+
+def build_vacancy_brief(vacancy_text: str, max_chars: int = IMPROVEMENT_VACANCY_BRIEF_CHARS) -> str:
+    """Анализ вакансии из общего кэша (без запроса к AI) или начало текста вакансии"""
+    analysis = vacancy_analysis_cache.get(vacancy_fingerprint(vacancy_text))
+    if analysis:
+        return analysis
+    return _truncate(normalize_text(vacancy_text), max_chars)
+
+
+class ImprovementContextStore:
+    """LRU + TTL хранилище компактных контекстов по session_id"""
+
+    def __init__(self, max_sessions: int = 5000, ttl_seconds: int = 86400, enabled: bool = True):
+        self.enabled = enabled
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._contexts: "OrderedDict[str, ImprovementContext]" = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0}
+
+    def get(self, session_id: str) -> Optional[ImprovementContext]:
+        if not self.enabled or not session_id:
+            return None
+        context = self._contexts.get(session_id)
+        if context and time.time() - context.updated_at < self.ttl_seconds:
+            self._contexts.move_to_end(session_id)
+            self.stats['hits'] += 1
+            return context
+        if context:
+            del self._contexts[session_id]
+        self.stats['misses'] += 1
+        return None
+
+    def remember(self, session_id: str, vacancy_text: str, resume_text: str,
+                 letter: str) -> Optional[ImprovementContext]:
+        """Собрать и сохранить контекст сессии после генерации письма"""
+        if not self.enabled or not session_id or not letter:
+            return None
+        context = ImprovementContext(
+            session_id=session_id,
+            vacancy_brief=build_vacancy_brief(vacancy_text),
+            resume_highlights=extract_resume_highlights(resume_text, vacancy_text),
+            current_letter=letter
+        )
+        self._contexts[session_id] = context
+        self._contexts.move_to_end(session_id)
+        self.stats['stores'] += 1
+        while len(self._contexts) > self.max_sessions:
+            self._contexts.popitem(last=False)
+        logger.info(
+            f"🧩 Контекст улучшений сессии {session_id}: вакансия {len(context.vacancy_brief)}, "
+            f"резюме {len(context.resume_highlights)} из {len(resume_text)} символов"
+        )
+        return context
+
+    def update_letter(self, session_id: str, letter: str):
+        """Улучшенное письмо становится текущей версией сессии"""
+        context = self._contexts.get(session_id)
+        if context and letter:
+            context.current_letter = letter
+            context.updated_at = time.time()
+
+    def forget(self, session_id: str):
+        self._contexts.pop(session_id, None)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, 'sessions': len(self._contexts)}
+
+
+# Глобальное хранилище контекстов
+improvement_contexts = ImprovementContextStore(
+    max_sessions=IMPROVEMENT_CONTEXT_MAX_SESSIONS,
+    ttl_seconds=IMPROVEMENT_CONTEXT_TTL_SECONDS,
+    enabled=INCREMENTAL_IMPROVEMENT_ENABLED
+)
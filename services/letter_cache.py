@@ -0,0 +1,189 @@
+"""
+Кэш готовых писем с адресацией по содержимому
+
+Ключ - хэш от (версия промпта, нормализованная вакансия, нормализованное резюме,
+модель, температура). Два уровня хранения:
+- в памяти: LRU + TTL (всегда)
+- локальный SQLite (опционально, переживает рестарт бота)
+"""
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import closing
+from typing import Optional, Tuple
+
+from config import (
+    LETTER_CACHE_ENABLED,
+    LETTER_CACHE_MAX_ENTRIES,
+    LETTER_CACHE_TTL_SECONDS,
+    LETTER_CACHE_SQLITE_PATH
+)
+from .executors import BoundedExecutor, ExecutorOverloaded, background_executor, critical_executor
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Нормализует текст для ключа кэша: Unicode NFC, схлопывание пробелов и пустых строк"""
+    if not text:
+        return ""
+    text = unicodedata.normalize('NFC', text)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = [re.sub(r'[ \t\u00a0]+', ' ', line).strip() for line in text.split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def make_letter_cache_key(
+    prompt_version: str,
+    vacancy_text: str,
+    resume_text: str,
+    model: str,
+    temperature: float
+) -> str:
+    """Строит ключ кэша письма (sha256 от нормализованных входных данных)"""
+    payload = json.dumps(
+        [prompt_version, normalize_text(vacancy_text), normalize_text(resume_text), model, round(temperature, 3)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LetterCache:
+    """
+    Двухуровневый кэш писем: LRU в памяти + опциональный SQLite
+
+    Все операции с SQLite выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, max_entries: int = 500, ttl_seconds: int = 86400,
+                 sqlite_path: Optional[str] = None, enabled: bool = True):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path or None
+
+        # key -> (expires_at, letter)
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._sqlite_lock = threading.Lock()
+        self._sqlite_ready = False
+
+        self.stats = {'hits_memory': 0, 'hits_sqlite': 0, 'misses': 0, 'stores': 0}
+
+        if self.enabled and self.sqlite_path:
+            self._init_sqlite()
+
+        logger.info(f"💾 LetterCache initialized: enabled={self.enabled}, max_entries={max_entries}, "
+                    f"ttl={ttl_seconds}s, sqlite={self.sqlite_path or 'disabled'}")
+
+    # === SQLITE УРОВЕНЬ ===
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.sqlite_path, timeout=5)
+
+    def _init_sqlite(self):
+        try:
+            with self._sqlite_lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS letter_cache ("
+                    "key TEXT PRIMARY KEY, letter TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("DELETE FROM letter_cache WHERE expires_at < ?", (time.time(),))
+            self._sqlite_ready = True
+        except Exception as e:
+            logger.error(f"❌ LetterCache: SQLite tier disabled: {e}")
+            self._sqlite_ready = False
+
+    def _sqlite_get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT expires_at, letter FROM letter_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[0] < time.time():
+                conn.execute("DELETE FROM letter_cache WHERE key = ?", (key,))
+                return None
+            return (row[0], row[1]) if row else None
+
+    def _sqlite_set(self, key: str, expires_at: float, letter: str):
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO letter_cache (key, letter, expires_at) VALUES (?, ?, ?)",
+                (key, letter, expires_at)
+            )
+
+    async def _run_sqlite(self, func, *args, executor: BoundedExecutor = critical_executor):
+        try:
+            return await executor.run(func, *args)
+        except ExecutorOverloaded:
+            # Запись в кэш необязательна - при перегрузке пропускаем
+            return None
+        except Exception as e:
+            logger.error(f"❌ LetterCache SQLite operation failed: {e}")
+            return None
+
+    # === ПУБЛИЧНЫЙ API ===
+
+    def _remember(self, key: str, expires_at: float, letter: str):
+        self._memory[key] = (expires_at, letter)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Получить письмо из кэша (сначала память, затем SQLite)"""
+        if not self.enabled:
+            return None
+
+        entry = self._memory.get(key)
+        if entry:
+            expires_at, letter = entry
+            if expires_at >= time.time():
+                self._memory.move_to_end(key)
+                self.stats['hits_memory'] += 1
+                return letter
+            del self._memory[key]
+
+        if self._sqlite_ready:
+            entry = await self._run_sqlite(self._sqlite_get, key)
+            if entry:
+                expires_at, letter = entry
+                self._remember(key, expires_at, letter)
+                self.stats['hits_sqlite'] += 1
+                return letter
+
+        self.stats['misses'] += 1
+        return None
+
+    async def set(self, key: str, letter: str):
+        """Сохранить письмо в кэш"""
+        if not self.enabled or not letter:
+            return
+
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, expires_at, letter)
+        self.stats['stores'] += 1
+
+        if self._sqlite_ready:
+            await self._run_sqlite(self._sqlite_set, key, expires_at, letter, executor=background_executor)
+
+    def get_stats(self) -> dict:
+        """Статистика кэша для мониторинга"""
+        return {
+            **self.stats,
+            'memory_entries': len(self._memory),
+            'sqlite_enabled': self._sqlite_ready
+        }
+
+
+# Глобальный экземпляр кэша
+letter_cache = LetterCache(
+    max_entries=LETTER_CACHE_MAX_ENTRIES,
+    ttl_seconds=LETTER_CACHE_TTL_SECONDS,
+    sqlite_path=LETTER_CACHE_SQLITE_PATH,
+    enabled=LETTER_CACHE_ENABLED
+)
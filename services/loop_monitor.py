@@ -0,0 +1,176 @@
+"""
+Мониторинг задержки event loop и поиск блокирующего кода
+
+Бот однопоточный: любой синхронный вызов внутри корутины (HTTP клиент, SQLite,
+тяжелый парсинг) останавливает обработку сообщений всех пользователей.
+
+Монитор состоит из двух частей:
+* фоновая задача раз в LOOP_MONITOR_INTERVAL_MS засыпает и измеряет, насколько
+  позже запланированного ее разбудил loop - это задержка (lag), из окна замеров
+  считаются перцентили p50/p95/p99;
+* сторожевой поток следит за отметками этой задачи; если loop не отвечает дольше
+  LOOP_BLOCK_THRESHOLD_MS, поток снимает стек потока loop (sys._current_frames) -
+  это и есть код, который сейчас блокирует бота.
+
+Накладные расходы - один таймер в loop и один спящий поток, поэтому монитор
+можно держать включенным в проде.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, List, Optional
+
+from config import (
+    LOOP_MONITOR_ENABLED,
+    LOOP_MONITOR_INTERVAL_MS,
+    LOOP_BLOCK_THRESHOLD_MS,
+    LOOP_MONITOR_WINDOW,
+    LOOP_MONITOR_REPORT_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних блокировок со стеком хранить для get_stats
+RECENT_BLOCKS = 5
+# Кадров стека в отчете о блокировке (самые глубокие - ближе к причине)
+STACK_DEPTH = 12
+
+
+class LoopMonitor:
+    """Задержка event loop (перцентили) и стеки блокирующих вызовов"""
+
+    def __init__(self, interval: float = 0.25, block_threshold: float = 0.5, window: int = 1200,
+                 report_interval: float = 300.0, enabled: bool = True):
+        self.enabled = enabled
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.report_interval = report_interval
+
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        # time.monotonic() последнего пробуждения задачи мониторинга
+        self._heartbeat = 0.0
+        self._recent_blocks: Deque[dict] = deque(maxlen=RECENT_BLOCKS)
+
+        self.stats = {'samples': 0, 'blocks': 0, 'max_lag_ms': 0.0}
+
+    def start(self):
+        """Запустить замеры и сторожевой поток (вызывается из post_init)"""
+        if not self.enabled or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._measure_loop())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        logger.info(f"⏱️ Мониторинг event loop: замер каждые {self.interval * 1000:.0f}мс, "
+                    f"блокировка > {self.block_threshold * 1000:.0f}мс")
+
+    async def stop(self):
+        """Остановить мониторинг"""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._watchdog = None
+
+    # === ЗАМЕРЫ В LOOP ===
+
+    async def _measure_loop(self):
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + self.report_interval
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self._heartbeat = time.monotonic()
+
+            lag = max(0.0, now - started - self.interval)
+            self._samples.append(lag)
+            self.stats['samples'] += 1
+            self.stats['max_lag_ms'] = max(self.stats['max_lag_ms'], round(lag * 1000, 1))
+
+            if now >= next_report:
+                next_report = now + self.report_interval
+                logger.info(f"⏱️ Задержка event loop: {self.get_percentiles()}")
+
+    # === СТОРОЖЕВОЙ ПОТОК ===
+
+    def _watch(self):
+        # Loop без блокировок обновляет отметку каждые interval секунд
+        allowed = self.interval + self.block_threshold
+        check_every = max(0.05, self.block_threshold / 2)
+        blocked_since_heartbeat = None
+
+        while not self._stop.wait(check_every):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled <= allowed:
+                blocked_since_heartbeat = None
+                continue
+            # Одна блокировка - один отчет со стеком
+            if blocked_since_heartbeat == heartbeat:
+                continue
+            blocked_since_heartbeat = heartbeat
+            self._report_block(stalled - self.interval)
+
+    def _report_block(self, blocked_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = traceback.format_stack(frame)[-STACK_DEPTH:]
+        self.stats['blocks'] += 1
+        self._recent_blocks.append({
+            'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'blocked_ms': round(blocked_for * 1000),
+            'stack': [line.strip() for line in stack]
+        })
+        logger.warning(f"🐌 Event loop заблокирован уже {blocked_for * 1000:.0f}мс, сейчас выполняется:\n"
+                       f"{''.join(stack)}")
+
+    # === СТАТИСТИКА ===
+
+    def get_percentiles(self) -> dict:
+        """Перцентили задержки loop в миллисекундах по окну замеров"""
+        if not self._samples:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+        ordered: List[float] = sorted(self._samples)
+        last = len(ordered) - 1
+
+        def percentile(p: float) -> float:
+            return round(ordered[min(last, int(p * len(ordered)))] * 1000, 1)
+
+        return {
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': round(ordered[last] * 1000, 1)
+        }
+
+    def get_stats(self) -> dict:
+        """Статистика для мониторинга"""
+        return {
+            **self.stats,
+            'running': self._task is not None,
+            'lag_ms': self.get_percentiles(),
+            'recent_blocks': list(self._recent_blocks)
+        }
+
+
+# Глобальный монитор event loop
+loop_monitor = LoopMonitor(
+    interval=LOOP_MONITOR_INTERVAL_MS / 1000,
+    block_threshold=LOOP_BLOCK_THRESHOLD_MS / 1000,
+    window=LOOP_MONITOR_WINDOW,
+    report_interval=LOOP_MONITOR_REPORT_SECONDS,
+    enabled=LOOP_MONITOR_ENABLED
+)
@@ -4,31 +4,60 @@
 import asyncio
 import logging
 import time
-from typing import Optional
+from typing import AsyncIterator, List, Optional
 from openai import AsyncOpenAI
-from .ai_service import AIService
+from .ai_service import (
+    AIService,
+    CONTINUATION_INSTRUCTION,
+    continuation_suffix,
+    estimate_tokens,
+    iterate_with_idle_timeout
+)
+from .adaptive_limits import adaptive_limits
+from .ai_hedging import hedged_request, hedged_stream
+from .rate_governor import rate_governor
+from .single_flight import ai_single_flight, request_fingerprint
+from .token_metering import metering_context, token_meter
 from config import (
     OPENAI_API_KEY, 
     OPENAI_MODEL, 
     OPENAI_FALLBACK_MODEL,
     OPENAI_TIMEOUT,
     MAX_GENERATION_ATTEMPTS,
+    AI_MAX_CONTINUATIONS,
     MIN_RESPONSE_LENGTH,
     OPENAI_TEMPERATURE,
     OPENAI_TOP_P,
     OPENAI_PRESENCE_PENALTY,
-    OPENAI_FREQUENCY_PENALTY
+    OPENAI_FREQUENCY_PENALTY,
+    STREAM_IDLE_TIMEOUT,
+    CIRCUIT_BREAKER_PROBE_TIMEOUT
 )
 # Старый импорт удален - используется smart_analyzer_v6.py с встроенными промптами
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+
+def _has_content(response) -> bool:
+    """Ответ OpenAI содержит непустой текст"""
+    return bool(response and response.choices and response.choices[0].message.content)
+
+
+def _is_truncated(response) -> bool:
+    """Ответ OpenAI обрезан по max_tokens"""
+    return bool(response and response.choices and response.choices[0].finish_reason == 'length')
+
+
 class OpenAIService(AIService):
     """Сервис для работы с OpenAI API"""
     
+    model_name = OPENAI_MODEL
+    models = (OPENAI_MODEL, OPENAI_FALLBACK_MODEL)
+    
     def __init__(self):
-        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        # Без повторов SDK (см. ai_hedging)
+        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
         self._stats_callback = None
     
     def set_stats_callback(self, callback):
@@ -102,6 +131,137 @@ class OpenAIService(AIService):
                 logger.error(f"❌ Fallback модель тоже не работает: {fallback_e}")
                 return False
 
+    async def _create_completion(
+        self,
+        model: str,
+        prompt: str,
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        continuation: Optional[str] = None,
+        request_type: Optional[str] = None,
+        **params
+    ):
+        """
+        chat.completions.create через rate governor: ждет квоту RPM/TPM модели
+        и корректирует ее по фактическому usage ответа
+
+        continuation - уже полученная обрезанная часть ответа: она передается
+        как ответ ассистента, и модель просят продолжить его.
+        С request_type max_tokens и timeout служат значениями по умолчанию:
+        реальные берутся из перцентилей прошлых ответов (см. adaptive_limits).
+        """
+        if request_type:
+            max_tokens = adaptive_limits.max_tokens(request_type, model, max_tokens)
+            timeout = adaptive_limits.timeout(request_type, model, timeout)
+        messages = [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        if continuation:
+            messages.append({"role": "assistant", "content": continuation})
+            messages.append({"role": "user", "content": CONTINUATION_INSTRUCTION})
+        # При n>1 модель пишет n ответов - резервируем токены на каждый
+        expected_tokens = estimate_tokens(prompt + (continuation or '')) + max_tokens * params.get('n', 1)
+        async with rate_governor.reserve(OPENAI_API_KEY, model, expected_tokens) as reservation:
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        **params
+                    ),
+                    timeout=timeout
+                )
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and request_type and timeout:
+                    adaptive_limits.record_timeout(request_type, model, timeout)
+                token_meter.record(
+                    'openai', model, request_type, 0, 0, time.monotonic() - started, success=False,
+                    error_message="Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)[:500],
+                    continuation=bool(continuation)
+                )
+                raise
+            token_meter.record(
+                'openai', model, request_type,
+                response.usage.prompt_tokens if response.usage else 0,
+                response.usage.completion_tokens if response.usage else 0,
+                time.monotonic() - started,
+                success=_has_content(response),
+                error_message=None if _has_content(response) else "Empty response",
+                continuation=bool(continuation)
+            )
+            if response.usage:
+                reservation.used_tokens = response.usage.total_tokens
+                if request_type and response.choices:
+                    adaptive_limits.record(
+                        request_type, model,
+                        response.usage.completion_tokens // len(response.choices),
+                        time.monotonic() - started,
+                        truncated=any(choice.finish_reason == 'length' for choice in response.choices)
+                    )
+            return response
+
+    async def probe_model(self, model: str) -> bool:
+        """Короткий пробный запрос к модели в обход хеджирования и circuit breaker"""
+        try:
+            response = await asyncio.wait_for(
+                self.client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": "Тест"
+                        }
+                    ],
+                    max_tokens=5,
+                    temperature=0.1
+                ),
+                timeout=CIRCUIT_BREAKER_PROBE_TIMEOUT
+            )
+            return _has_content(response)
+        except Exception as e:
+            logger.warning(f"⚠️ Проба модели {model} неуспешна: {e}")
+            return False
+
+    async def _continue_truncated(
+        self,
+        model: str,
+        prompt: str,
+        text: str,
+        max_tokens: int,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion",
+        **params
+    ) -> str:
+        """
+        Дописывает ответ, обрезанный по max_tokens, запросами продолжения
+
+        Почти готовое письмо не выбрасывается: модель получает обрезанный текст
+        и пишет только недостающий конец, который склеивается с началом.
+        """
+        for attempt in range(AI_MAX_CONTINUATIONS):
+            logger.info(f"✂️ Ответ GPT обрезан по max_tokens ({len(text)} символов), запрашиваю продолжение #{attempt + 1}")
+            try:
+                response = await self._create_completion(
+                    model, prompt, max_tokens=max_tokens, timeout=OPENAI_TIMEOUT, continuation=text,
+                    request_type=f"{request_type}_continuation", **params
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось получить продолжение ответа GPT: {e}")
+                break
+            
+            if not _has_content(response):
+                break
+            text += continuation_suffix(text, response.choices[0].message.content)
+            if not _is_truncated(response):
+                break
+        return text
+
     async def _make_openai_request(self, prompt: str) -> Optional[str]:
         """
         Выполняет запрос к OpenAI API
@@ -112,50 +272,7 @@ class OpenAIService(AIService):
         Returns:
             Ответ от OpenAI или None в случае ошибки
         """
-        try:
-            # Сначала пробуем основную модель
-            response = await self.client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                max_tokens=1500,
-                temperature=OPENAI_TEMPERATURE,
-                top_p=OPENAI_TOP_P,
-                presence_penalty=OPENAI_PRESENCE_PENALTY,
-                frequency_penalty=OPENAI_FREQUENCY_PENALTY
-            )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            logger.warning(f"Ошибка с моделью {OPENAI_MODEL}: {e}")
-            
-            # Пробуем fallback модель
-            try:
-                response = await self.client.chat.completions.create(
-                    model=OPENAI_FALLBACK_MODEL,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=1500,
-                    temperature=OPENAI_TEMPERATURE,
-                    top_p=OPENAI_TOP_P,
-                    presence_penalty=OPENAI_PRESENCE_PENALTY,
-                    frequency_penalty=OPENAI_FREQUENCY_PENALTY
-                )
-                
-                return response.choices[0].message.content
-                
-            except Exception as fallback_e:
-                logger.error(f"Ошибка с fallback моделью {OPENAI_FALLBACK_MODEL}: {fallback_e}")
-                return None
+        return await self._make_personalized_request(prompt, OPENAI_TEMPERATURE)
     
     def _is_response_complete(self, response: str) -> bool:
         """
@@ -217,7 +334,30 @@ class OpenAIService(AIService):
             
         Returns:
             Ответ от GPT или None в случае ошибки
+
+        Одинаковый запрос того же пользователя, который уже выполняется,
+        не отправляется повторно - ждет общий результат (см. single_flight).
         """
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens
+        )
+        with metering_context(user_id, session_id, request_type):
+            return await ai_single_flight.do(
+                key,
+                lambda: self._get_completion(prompt, temperature, max_tokens, user_id, session_id, request_type)
+            )
+
+    async def _get_completion(
+        self, 
+        prompt: str, 
+        temperature: float = 0.7, 
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> Optional[str]:
+        """Запрос к GPT с хеджированием (без объединения одинаковых вызовов)"""
         start_time = time.time()
         used_model = OPENAI_MODEL
         
@@ -225,39 +365,32 @@ class OpenAIService(AIService):
             logger.info(f"🤖 Отправляю запрос к GPT (temp={temperature}, max_tokens={max_tokens}, timeout={OPENAI_TIMEOUT}s)")
             logger.info(f"📝 Длина промпта: {len(prompt)} символов")
             
-            response = await asyncio.wait_for(
-                self.client.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
+            # Fallback модель запускается параллельно, если основная не ответила за p90
+            response, used_model = await hedged_request(
+                lambda model: self._create_completion(
+                    model,
+                    prompt,
                     max_tokens=max_tokens,
+                    timeout=OPENAI_TIMEOUT,
+                    request_type=request_type,
                     temperature=temperature
                 ),
-                timeout=OPENAI_TIMEOUT
+                OPENAI_MODEL,
+                OPENAI_FALLBACK_MODEL,
+                is_valid=_has_content
             )
-            
+
             response_time_ms = int((time.time() - start_time) * 1000)
-            
-            if response.choices and response.choices[0].message.content:
+
+            if _has_content(response):
                 content = response.choices[0].message.content
                 logger.info(f"✅ Получен ответ от GPT: {len(content)} символов")
-                
-                # 📊 АНАЛИТИКА: Логируем успешный запрос
-                await self._log_openai_request(
-                    model=used_model,
-                    request_type=request_type,
-                    prompt_tokens=response.usage.prompt_tokens if response.usage else 0,
-                    completion_tokens=response.usage.completion_tokens if response.usage else 0,
-                    total_tokens=response.usage.total_tokens if response.usage else 0,
-                    response_time_ms=response_time_ms,
-                    success=True,
-                    user_id=user_id,
-                    session_id=session_id
-                )
+                if _is_truncated(response):
+                    content = await self._continue_truncated(
+                        used_model, prompt, content, max_tokens,
+                        user_id, session_id, request_type, temperature=temperature
+                    )
+                logger.info(f"⏱️ Ответ GPT ({used_model}) за {response_time_ms}ms")
                 
                 # Сохраняем статистику для анализатора (если есть callback)
                 if hasattr(self, '_stats_callback') and self._stats_callback:
@@ -269,36 +402,10 @@ class OpenAIService(AIService):
                 return content
             else:
                 logger.error("❌ GPT вернул пустой ответ")
-                # 📊 АНАЛИТИКА: Логируем пустой ответ
-                await self._log_openai_request(
-                    model=used_model,
-                    request_type=request_type,
-                    prompt_tokens=0,
-                    completion_tokens=0,
-                    total_tokens=0,
-                    response_time_ms=response_time_ms,
-                    success=False,
-                    user_id=user_id,
-                    session_id=session_id,
-                    error_message="Empty response"
-                )
                 return None
                 
         except asyncio.TimeoutError:
             logger.error("❌ Таймаут запроса к GPT")
-            # 📊 АНАЛИТИКА: Логируем таймаут
-            await self._log_openai_request(
-                model=used_model,
-                request_type=request_type,
-                prompt_tokens=0,
-                completion_tokens=0,
-                total_tokens=0,
-                response_time_ms=response_time_ms,
-                success=False,
-                user_id=user_id,
-                session_id=session_id,
-                error_message="Timeout"
-            )
             return None
         except Exception as e:
             logger.error(f"❌ Ошибка запроса к GPT: {e}")
@@ -320,13 +427,159 @@ class OpenAIService(AIService):
                 await analytics.log_error(error_data)
             except Exception as log_error:
                 logger.error(f"Failed to log OpenAI error to database: {log_error}")
+
+            return None
+
+    async def get_completions(
+        self,
+        prompt: str,
+        n: int = 2,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> List[str]:
+        """n вариантов ответа одним запросом (параметр n у chat.completions)"""
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens, n=n
+        )
+        with metering_context(user_id, session_id, request_type):
+            return await ai_single_flight.do(
+                key,
+                lambda: self._get_completions(prompt, n, temperature, max_tokens, user_id, session_id, request_type)
+            )
+
+    async def _get_completions(
+        self,
+        prompt: str,
+        n: int,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> List[str]:
+        start_time = time.time()
+        used_model = OPENAI_MODEL
+        
+        try:
+            logger.info(f"🤖 Запрашиваю у GPT {n} вариантов одним запросом (temp={temperature}, max_tokens={max_tokens})")
+            response, used_model = await hedged_request(
+                lambda model: self._create_completion(
+                    model,
+                    prompt,
+                    max_tokens=max_tokens,
+                    timeout=OPENAI_TIMEOUT,
+                    request_type=request_type,
+                    temperature=temperature,
+                    n=n
+                ),
+                OPENAI_MODEL,
+                OPENAI_FALLBACK_MODEL,
+                is_valid=_has_content
+            )
+            choices = [
+                choice for choice in (response.choices if response else [])
+                if choice.message and choice.message.content
+            ]
+            # Обрезанные варианты дописываются параллельно
+            variants = await asyncio.gather(*(
+                self._continue_truncated(
+                    used_model, prompt, choice.message.content, max_tokens,
+                    user_id, session_id, request_type, temperature=temperature
+                ) if choice.finish_reason == 'length' else asyncio.sleep(0, result=choice.message.content)
+                for choice in choices
+            ))
             
-            # Пробуем fallback модель
-            try:
-                logger.info(f"🔄 Пробую fallback модель {OPENAI_FALLBACK_MODEL}...")
-                response = await asyncio.wait_for(
+            if variants and self._stats_callback:
+                self._stats_callback(
+                    model=used_model,
+                    tokens=response.usage.total_tokens if response.usage else 0
+                )
+            
+            logger.info(f"✅ Получено вариантов от GPT: {len(variants)} из {n} за {time.time() - start_time:.2f}s")
+            return variants
+            
+        except Exception as e:
+            error_message = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"❌ Ошибка запроса вариантов к GPT: {error_message}")
+            return []
+
+    async def stream_completion(
+        self,
+        prompt: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1500,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None,
+        request_type: str = "completion"
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый запрос к GPT: отдает фрагменты текста по мере генерации
+
+        Если основная модель не выдала первый фрагмент за p90, параллельно
+        запускается fallback модель (см. ai_hedging.hedged_stream). После первого
+        фрагмента ошибка пробрасывается вызывающему коду (часть письма уже показана).
+        Повторный одинаковый поток получает готовый текст ведущего одним фрагментом.
+
+        Args:
+            prompt: Промпт для GPT
+            temperature: Температура для генерации
+            max_tokens: Максимальное количество токенов
+            user_id: ID пользователя для аналитики
+            session_id: ID сессии для аналитики
+            request_type: Тип запроса для аналитики
+
+        Yields:
+            Фрагменты (дельты) текста ответа
+        """
+        key = request_fingerprint(
+            user_id, session_id, prompt,
+            model=self.model_name, temperature=temperature, max_tokens=max_tokens, stream=True
+        )
+        stream = ai_single_flight.stream(
+            key,
+            lambda: hedged_stream(
+                lambda model: self._stream_model(
+                    model, prompt, temperature, max_tokens, user_id, session_id, request_type
+                ),
+                OPENAI_MODEL,
+                OPENAI_FALLBACK_MODEL
+            )
+        )
+        async for delta in stream:
+            yield delta
+
+    async def _stream_model(
+        self,
+        model: str,
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+        user_id: Optional[int],
+        session_id: Optional[str],
+        request_type: str
+    ) -> AsyncIterator[str]:
+        """Потоковый запрос к одной модели GPT с логированием в аналитику"""
+        start_time = time.time()
+        received_chars = 0
+        parts = []
+        finish_reason = None
+        prompt_tokens = estimate_tokens(prompt)
+        try:
+            max_tokens = adaptive_limits.max_tokens(request_type, model, max_tokens)
+            logger.info(f"🌊 Потоковый запрос к GPT {model} (temp={temperature}, max_tokens={max_tokens})")
+
+            # Открытие потока и первый фрагмент - в пределах таймаута попытки,
+            # дальше STREAM_IDLE_TIMEOUT ограничивает только паузы между фрагментами
+            open_timeout = adaptive_limits.timeout(request_type, model, OPENAI_TIMEOUT)
+            async with rate_governor.reserve(OPENAI_API_KEY, model, prompt_tokens + max_tokens) as reservation:
+                first_chunk_deadline = time.monotonic() + open_timeout
+                stream = await asyncio.wait_for(
                     self.client.chat.completions.create(
-                        model=OPENAI_FALLBACK_MODEL,
+                        model=model,
                         messages=[
                             {
                                 "role": "user",
@@ -334,22 +587,65 @@ class OpenAIService(AIService):
                             }
                         ],
                         max_tokens=max_tokens,
-                        temperature=temperature
+                        temperature=temperature,
+                        stream=True
                     ),
-                    timeout=OPENAI_TIMEOUT
+                    timeout=open_timeout
                 )
-                
-                if response.choices and response.choices[0].message.content:
-                    content = response.choices[0].message.content
-                    logger.info(f"✅ Fallback модель ответила: {len(content)} символов")
-                    return content
-                else:
-                    logger.error("❌ Fallback модель вернула пустой ответ")
-                    return None
-                    
-            except Exception as fallback_e:
-                logger.error(f"❌ Fallback модель тоже не работает: {fallback_e}")
-                return None
+
+                try:
+                    first_timeout = max(0.0, first_chunk_deadline - time.monotonic())
+                    async for chunk in iterate_with_idle_timeout(stream, STREAM_IDLE_TIMEOUT, first_timeout):
+                        if not chunk.choices:
+                            continue
+                        finish_reason = chunk.choices[0].finish_reason or finish_reason
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if not received_chars:
+                                logger.info(f"⚡ Первый фрагмент от GPT через {time.time() - start_time:.2f}s")
+                            received_chars += len(delta)
+                            parts.append(delta)
+                            yield delta
+                finally:
+                    # usage в потоковом режиме не возвращается - оцениваем по тексту
+                    reservation.used_tokens = prompt_tokens + estimate_tokens(''.join(parts))
+
+            response_time_ms = int((time.time() - start_time) * 1000)
+            logger.info(f"✅ Поток GPT завершен: {received_chars} символов за {response_time_ms}ms")
+            if parts:
+                adaptive_limits.record(
+                    request_type, model, estimate_tokens(''.join(parts)), response_time_ms / 1000,
+                    truncated=finish_reason == 'length'
+                )
+
+            # 📊 АНАЛИТИКА: usage в потоковом режиме не возвращается - токены оценены по тексту
+            token_meter.record(
+                'openai', model, request_type, prompt_tokens, estimate_tokens(''.join(parts)) if parts else 0,
+                response_time_ms / 1000, success=received_chars > 0,
+                error_message=None if received_chars else "Empty response",
+                estimated=True, user_id=user_id, session_id=session_id
+            )
+
+            # Поток уперся в max_tokens - дописываем конец одним фрагментом
+            if finish_reason == 'length' and parts:
+                text = ''.join(parts)
+                with metering_context(user_id, session_id, request_type):
+                    continued = await self._continue_truncated(
+                        model, prompt, text, max_tokens, user_id, session_id, request_type, temperature=temperature
+                    )
+                if len(continued) > len(text):
+                    yield continued[len(text):]
+
+        except Exception as e:
+            error_message = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"❌ Ошибка потокового запроса к GPT {model}: {error_message}")
+            token_meter.record(
+                'openai', model, request_type, prompt_tokens if received_chars else 0,
+                estimate_tokens(''.join(parts)) if parts else 0, time.time() - start_time,
+                success=False, error_message=error_message[:500],
+                estimated=True, user_id=user_id, session_id=session_id
+            )
+            raise
 
     async def generate_personalized_letter(self, prompt: str, temperature: Optional[float] = None) -> Optional[str]:
         """
@@ -365,15 +661,17 @@ class OpenAIService(AIService):
         # Используем переданную температуру или берем из конфигурации
         temp = temperature if temperature is not None else OPENAI_TEMPERATURE
         
-        # Пробуем сгенерировать письмо с несколькими попытками
+        with metering_context(None, None, "personalized_letter"):
+            return await self._generate_personalized_letter(prompt, temp)
+
+    async def _generate_personalized_letter(self, prompt: str, temp: float) -> Optional[str]:
+        """Попытки персонализированной генерации (все учитываются за один запрос)"""
         for attempt in range(MAX_GENERATION_ATTEMPTS):
             try:
                 logger.info(f"Персонализированная генерация #{attempt + 1} (temp={temp})")
                 
-                response = await asyncio.wait_for(
-                    self._make_personalized_request(prompt, temp),
-                    timeout=OPENAI_TIMEOUT
-                )
+                # Таймаут - у каждой попытки к модели (адаптивный, см. adaptive_limits)
+                response = await self._make_personalized_request(prompt, temp)
                 
                 if response and self._is_response_complete(response):
                     logger.info("Успешно сгенерировано персонализированное письмо")
@@ -401,89 +699,41 @@ class OpenAIService(AIService):
             Ответ от OpenAI или None в случае ошибки
         """
         try:
-            # Сначала пробуем основную модель
-            response = await self.client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                max_tokens=1500,
-                temperature=temperature,
-                top_p=OPENAI_TOP_P,
-                presence_penalty=OPENAI_PRESENCE_PENALTY,
-                frequency_penalty=OPENAI_FREQUENCY_PENALTY
-            )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            logger.warning(f"Ошибка с моделью {OPENAI_MODEL}: {e}")
-            
-            # Пробуем fallback модель
-            try:
-                response = await self.client.chat.completions.create(
-                    model=OPENAI_FALLBACK_MODEL,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
+            # Основная модель с хеджированием fallback моделью
+            response, used_model = await hedged_request(
+                lambda model: self._create_completion(
+                    model,
+                    prompt,
                     max_tokens=1500,
+                    timeout=OPENAI_TIMEOUT,
+                    request_type="personalized_letter",
                     temperature=temperature,
                     top_p=OPENAI_TOP_P,
                     presence_penalty=OPENAI_PRESENCE_PENALTY,
                     frequency_penalty=OPENAI_FREQUENCY_PENALTY
-                )
-                
-                return response.choices[0].message.content
-                
-            except Exception as fallback_e:
-                logger.error(f"Ошибка с fallback моделью {OPENAI_FALLBACK_MODEL}: {fallback_e}")
+                ),
+                OPENAI_MODEL,
+                OPENAI_FALLBACK_MODEL,
+                is_valid=_has_content
+            )
+
+            if not _has_content(response):
                 return None
+            content = response.choices[0].message.content
+            if _is_truncated(response):
+                content = await self._continue_truncated(
+                    used_model, prompt, content, 1500,
+                    request_type="personalized_letter",
+                    temperature=temperature,
+                    top_p=OPENAI_TOP_P,
+                    presence_penalty=OPENAI_PRESENCE_PENALTY,
+                    frequency_penalty=OPENAI_FREQUENCY_PENALTY
+                )
+            return content
 
-    async def _log_openai_request(
-        self,
-        model: str,
-        request_type: str,
-        prompt_tokens: int,
-        completion_tokens: int,
-        total_tokens: int,
-        response_time_ms: int,
-        success: bool,
-        user_id: Optional[int] = None,
-        session_id: Optional[str] = None,
-        error_message: Optional[str] = None
-    ) -> None:
-        """
-        Логирует запрос к OpenAI в базу данных
-        """
-        try:
-            # Импортируем здесь чтобы избежать циклических импортов
-            from services.analytics_service import analytics  # Используем глобальный экземпляр
-            from models.analytics_models import OpenAIRequestData
-            
-            request_data = OpenAIRequestData(
-                model=model,
-                request_type=request_type,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=total_tokens,
-                response_time_ms=response_time_ms,
-                success=success,
-                user_id=user_id,
-                session_id=session_id,
-                error_message=error_message
-            )
-            
-            await analytics.log_openai_request(request_data)
         except Exception as e:
-            # Логируем ошибку, но не прерываем основной процесс
-            logger.error(f"Ошибка при логировании OpenAI запроса: {e}")
-
+            logger.error(f"Ошибка с моделями {OPENAI_MODEL}/{OPENAI_FALLBACK_MODEL}: {e}")
+            return None
 
 # УДАЛЕН: Глобальный экземпляр убран во избежание конфликтов с AI Factory
 # Используйте ai_factory.get_ai_service() для получения экземпляра
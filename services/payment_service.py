@@ -16,13 +16,14 @@ from yookassa.domain.models import Amount, Receipt, ReceiptItem
 
 from utils.database import SupabaseClient
 from services.subscription_service import subscription_service
+from services.executors import payments_executor
 from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_ENABLED, BOT_USERNAME, TELEGRAM_BOT_TOKEN
 
 logger = logging.getLogger(__name__)
 
 class PaymentService:
     def __init__(self):
-        self.supabase = SupabaseClient.get_client()
+        self.supabase = SupabaseClient.get_async_client()
         self.enabled = YOOKASSA_ENABLED and YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY
         
         if self.enabled:
@@ -87,7 +88,8 @@ class PaymentService:
             })
             
             # Создаем платеж
-            payment = Payment.create(payment_request)
+            # SDK ЮKassa синхронный - выполняем в отдельном пуле, не блокируя бота
+            payment = await payments_executor.run(Payment.create, payment_request)
             
             # Проверяем что платеж создан успешно
             if not payment or not payment.id:
@@ -252,7 +254,7 @@ class PaymentService:
                 'created_at': datetime.now().isoformat()
             }
             
-            response = self.supabase.table('payments').insert(payment_data).execute()
+            response = await self.supabase.table('payments').insert(payment_data).execute()
             return bool(response.data)
             
         except Exception as e:
@@ -270,7 +272,7 @@ class PaymentService:
                 'updated_at': datetime.now().isoformat()
             }
             
-            response = self.supabase.table('payments').update(update_data).eq('payment_id', payment_id).execute()
+            response = await self.supabase.table('payments').update(update_data).eq('payment_id', payment_id).execute()
             
             # При UPDATE операции Supabase может возвращать пустой массив при успешном обновлении
             # Проверяем что запрос выполнился без ошибок (response.data может быть None или пустым массивом)
@@ -294,7 +296,7 @@ class PaymentService:
             if not self.supabase:
                 return False
             
-            response = self.supabase.table('payments').select('status').eq('payment_id', payment_id).execute()
+            response = await self.supabase.table('payments').select('status').eq('payment_id', payment_id).execute()
             if response.data:
                 return response.data[0]['status'] == 'succeeded'
             return False
@@ -309,7 +311,7 @@ class PaymentService:
             if not self.supabase:
                 return None
             
-            response = self.supabase.table('payments').select('user_id').eq('payment_id', payment_id).execute()
+            response = await self.supabase.table('payments').select('user_id').eq('payment_id', payment_id).execute()
             if response.data and response.data[0].get('user_id'):
                 return int(response.data[0]['user_id'])
             return None
@@ -330,7 +332,7 @@ class PaymentService:
                 # Получаем telegram_user_id из metadata платежа
                 telegram_user_id = None
                 if self.supabase:
-                    response = self.supabase.table('payments').select('metadata').eq('payment_id', payment_id).execute()
+                    response = await self.supabase.table('payments').select('metadata').eq('payment_id', payment_id).execute()
                     if response.data and response.data[0].get('metadata'):
                         metadata = response.data[0]['metadata']
                         telegram_user_id = metadata.get('telegram_id')
@@ -368,7 +370,7 @@ class PaymentService:
                 logger.error(f"❌ Supabase not available for getting period_end for user {user_id}")
                 return False, "Ошибка подключения к базе данных", None
             
-            response = self.supabase.table('subscriptions').select('period_end').eq('user_id', user_id).execute()
+            response = await self.supabase.table('subscriptions').select('period_end').eq('user_id', user_id).execute()
             if not response.data:
                 logger.error(f"❌ Could not get period_end for user {user_id}")
                 return False, "Ошибка получения даты окончания подписки", None
@@ -439,9 +441,9 @@ class PaymentService:
                 if reply_markup:
                     data["reply_markup"] = reply_markup
                 
-                # Отправляем синхронный запрос
-                with httpx.Client(timeout=10.0) as client:
-                    response = client.post(url, json=data)
+                # Асинхронный запрос: синхронный клиент блокировал event loop на время ответа Telegram
+                async with httpx.AsyncClient(timeout=10.0) as client:
+                    response = await client.post(url, json=data)
                     
                     if response.status_code == 200:
                         logger.info(f"📨 Premium activation notification sent to user {user_id} (telegram: {telegram_user_id})")
@@ -474,7 +476,7 @@ class PaymentService:
             if not self.supabase:
                 return None
             
-            response = self.supabase.table('payments').select('status').eq('payment_id', payment_id).execute()
+            response = await self.supabase.table('payments').select('status').eq('payment_id', payment_id).execute()
             if response.data:
                 return response.data[0]['status']
             return None
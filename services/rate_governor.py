@@ -0,0 +1,256 @@
+"""
+Клиентский ограничитель RPM/TPM для AI-провайдеров
+
+Для каждой пары (API-ключ, модель) ведутся два token bucket'а: запросы в минуту
+и токены в минуту. Перед запросом резервируется оценка токенов (промпт + max_tokens),
+после ответа резерв корректируется по фактическому usage. Если провайдер ответил
+429 / overloaded, все запросы к модели приостанавливаются на Retry-After (или
+экспоненциальную паузу) со случайным джиттером, чтобы не тратить запросы впустую.
+"""
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from config import (
+    AI_GOVERNOR_ENABLED,
+    AI_DEFAULT_RPM,
+    AI_DEFAULT_TPM,
+    AI_MODEL_RPM_LIMITS,
+    AI_MODEL_TPM_LIMITS,
+    AI_GOVERNOR_MAX_WAIT
+)
+from .ai_service import parse_model_values
+from .ai_scheduler import SchedulerRejectedError
+
+logger = logging.getLogger(__name__)
+
+# Экспоненциальная пауза, если провайдер не прислал Retry-After
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 60.0
+BACKOFF_JITTER = 0.3  # До +30% к паузе
+
+
+class RateLimitWaitError(SchedulerRejectedError):
+    """Квота модели не освободилась за AI_GOVERNOR_MAX_WAIT"""
+
+
+# time.monotonic() выдачи квоты последнему запросу текущей задачи: ожидание своей
+# квоты - не задержка модели (circuit breaker считает время с этого момента)
+_quota_granted_at: ContextVar[Optional[float]] = ContextVar('quota_granted_at', default=None)
+
+
+def quota_granted_at() -> Optional[float]:
+    """Когда запросу в текущей задаче выдана квота (None - запрос квоту не ждал)"""
+    return _quota_granted_at.get()
+
+
+def reset_quota_granted_at():
+    _quota_granted_at.set(None)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """429 (rate limit) или 529 (overloaded у Anthropic)"""
+    status = getattr(error, 'status_code', None)
+    return status in (429, 529) or type(error).__name__ in ('RateLimitError', 'OverloadedError')
+
+
+def extract_retry_after(error: Exception) -> Optional[float]:
+    """Retry-After из ответа провайдера в секундах (если есть)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket:
+    """Token bucket с пополнением `per_minute` единиц в минуту"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """Через сколько секунд в ведре будет `amount` (запрос больше емкости ждет полного ведра)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        """Списать (или вернуть при отрицательном amount); баланс может уйти в минус"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class Reservation:
+    """Резерв токенов под один запрос; used_tokens заполняется по usage ответа"""
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens: Optional[int] = None
+
+
+class ModelGovernor:
+    """Квоты одной модели на одном API-ключе"""
+
+    def __init__(self, name: str, rpm: float, tpm: float):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self._strikes = 0
+        self.stats = {'requests': 0, 'waits': 0, 'waited_seconds': 0.0, 'throttled': 0}
+
+    async def acquire(self, estimated_tokens: int):
+        """Дождаться квоты на запрос и списать ее"""
+        waited = 0.0
+        while True:
+            wait = max(
+                self.blocked_until - time.monotonic(),
+                self.requests.time_until(1),
+                self.tokens.time_until(estimated_tokens)
+            )
+            if wait <= 0:
+                self.requests.consume(1)
+                self.tokens.consume(estimated_tokens)
+                self.stats['requests'] += 1
+                if waited:
+                    self.stats['waits'] += 1
+                    self.stats['waited_seconds'] += waited
+                return
+            if waited + wait > AI_GOVERNOR_MAX_WAIT:
+                raise RateLimitWaitError(f"Quota for {self.name} not available within {AI_GOVERNOR_MAX_WAIT}s")
+            if not waited:
+                logger.info(f"🚦 {self.name}: жду квоту {wait:.1f}s (~{estimated_tokens} токенов)")
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """Скорректировать TPM по фактическому расходу"""
+        self.tokens.consume(used_tokens - estimated_tokens)
+
+    def penalize(self, retry_after: Optional[float]):
+        """Провайдер сообщил о перегрузке: пауза по Retry-After или экспоненциальная, с джиттером"""
+        self._strikes += 1
+        self.stats['throttled'] += 1
+        if retry_after is None:
+            retry_after = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (self._strikes - 1))
+        delay = retry_after * (1 + random.uniform(0, BACKOFF_JITTER))
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        logger.warning(f"🚦 {self.name}: провайдер ограничил запросы, пауза {delay:.1f}s")
+
+    def note_success(self):
+        self._strikes = 0
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            'waited_seconds': round(self.stats['waited_seconds'], 1),
+            'tokens_available': int(self.tokens.tokens),
+            'blocked_for': max(0.0, round(self.blocked_until - time.monotonic(), 1))
+        }
+
+
+class RateGovernor:
+    """Реестр ModelGovernor по (API-ключ, модель)"""
+
+    def __init__(self, enabled: bool = True, default_rpm: float = 500, default_tpm: float = 150000,
+                 model_rpm: Optional[Dict[str, float]] = None, model_tpm: Optional[Dict[str, float]] = None):
+        self.enabled = enabled
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.model_rpm = model_rpm or {}
+        self.model_tpm = model_tpm or {}
+        self._governors: Dict[Tuple[str, str], ModelGovernor] = {}
+
+    @staticmethod
+    def _key_fingerprint(api_key: Optional[str]) -> str:
+        # Сам ключ нигде не хранится и не логируется
+        return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:8]
+
+    def get(self, api_key: Optional[str], model: str) -> ModelGovernor:
+        key = (self._key_fingerprint(api_key), model)
+        governor = self._governors.get(key)
+        if governor is None:
+            governor = ModelGovernor(
+                f"{model}@{key[0]}",
+                rpm=self.model_rpm.get(model, self.default_rpm),
+                tpm=self.model_tpm.get(model, self.default_tpm)
+            )
+            self._governors[key] = governor
+        return governor
+
+    @asynccontextmanager
+    async def reserve(self, api_key: Optional[str], model: str, estimated_tokens: int):
+        """
+        Резерв квоты на время запроса
+
+        Внутри блока нужно заполнить reservation.used_tokens из usage ответа.
+        Ошибки 429/529 приостанавливают модель с учетом Retry-After.
+        """
+        reservation = Reservation(estimated_tokens)
+        if not self.enabled:
+            yield reservation
+            return
+
+        governor = self.get(api_key, model)
+        await governor.acquire(estimated_tokens)
+        _quota_granted_at.set(time.monotonic())
+        try:
+            yield reservation
+        except Exception as e:
+            if is_rate_limit_error(e):
+                # Запрос не выполнен - токены не потрачены
+                governor.settle(estimated_tokens, 0)
+                governor.penalize(extract_retry_after(e))
+            raise
+        else:
+            governor.note_success()
+        finally:
+            if reservation.used_tokens is not None:
+                governor.settle(estimated_tokens, reservation.used_tokens)
+
+    def get_stats(self) -> dict:
+        return {governor.name: governor.get_stats() for governor in self._governors.values()}
+
+
+# Глобальный экземпляр (общий для всех сервисов: квоты привязаны к ключу, а не к объекту)
+rate_governor = RateGovernor(
+    enabled=AI_GOVERNOR_ENABLED,
+    default_rpm=AI_DEFAULT_RPM,
+    default_tpm=AI_DEFAULT_TPM,
+    model_rpm=parse_model_values(AI_MODEL_RPM_LIMITS),
+    model_tpm=parse_model_values(AI_MODEL_TPM_LIMITS)
+)
@@ -0,0 +1,259 @@
+"""
+Выжимка резюме пользователя, переиспользуемая для всех его вакансий
+
+Пользователь отправляет одно и то же резюме вакансия за вакансией, а каждое письмо
+заново передавало модели все резюме целиком. Теперь по резюме один раз строится
+структурированная выжимка (должность, места работы с достижениями в цифрах, навыки,
+образование, сильные стороны), и следующие генерации передают в промпт ее.
+
+Выжимка хранится по пользователю вместе с хэшем резюме: новое или измененное резюме
+строит новую выжимку. Первое письмо по новому резюме не ждет выжимку - она строится
+в фоне, а письмо использует сокращенное резюме (см. resume_sections).
+Два уровня хранения, как у кэша писем: LRU в памяти и опциональный SQLite.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, Optional, Tuple
+
+from config import (
+    RESUME_DIGEST_ENABLED,
+    RESUME_DIGEST_MAX_USERS,
+    RESUME_DIGEST_TTL_SECONDS,
+    RESUME_DIGEST_SQLITE_PATH
+)
+from .ai_scheduler import ai_request_context
+from .ai_service import estimate_tokens
+from .executors import BoundedExecutor, ExecutorOverloaded, background_executor, critical_executor
+from .letter_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Версия промпта выжимки - входит в хэш резюме
+RESUME_DIGEST_PROMPT_VERSION = "v1.0"
+RESUME_DIGEST_MAX_TOKENS = 700
+# Короткие резюме передаются как есть - выжимка их не сократит
+RESUME_DIGEST_MIN_TOKENS = 700
+
+
+def build_resume_digest_prompt(resume_text: str) -> str:
+    """Промпт построения выжимки резюме"""
+    return f"""Ты - эксперт по найму. Подготовь структурированную выжимку резюме, которая затем заменит полное резюме при написании сопроводительных писем на разные вакансии.
+
+РЕЗЮМЕ: {resume_text}
+
+Выдели:
+* Текущая/желаемая должность и общий стаж
+* Места работы (компания, должность, период) и для каждого - конкретные задачи и достижения, ОБЯЗАТЕЛЬНО сохрани все цифры и результаты
+* Навыки и технологии
+* Образование, курсы, сертификаты
+* Управление командой, масштаб (бюджеты, пользователи, обороты)
+* Уникальные преимущества кандидата
+
+ФОРМАТ ОТВЕТА: только выжимка по пунктам выше, кратко и конкретно, без вступлений и оценок. Ничего не придумывай - только факты из резюме."""
+
+
+def resume_hash(resume_text: str) -> str:
+    """Хэш нормализованного резюме с учетом версии промпта выжимки"""
+    payload = f"{RESUME_DIGEST_PROMPT_VERSION}\n{normalize_text(resume_text)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResumeDigestStore:
+    """
+    Выжимки резюме по пользователям: LRU в памяти + опциональный SQLite
+
+    На пользователя хранится одна выжимка - для его последнего резюме.
+    Все операции с SQLite выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, max_users: int = 10000, ttl_seconds: int = 30 * 86400,
+                 sqlite_path: Optional[str] = None, enabled: bool = True):
+        self.enabled = enabled
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path or None
+
+        # user_id -> (resume_hash, expires_at, digest)
+        self._memory: "OrderedDict[int, Tuple[str, float, str]]" = OrderedDict()
+        self._sqlite_lock = threading.Lock()
+        self._sqlite_ready = False
+        # Фоновые построения выжимок (сильные ссылки, не больше одного на пользователя)
+        self._building: Dict[int, asyncio.Task] = {}
+
+        self.stats = {'hits_memory': 0, 'hits_sqlite': 0, 'misses': 0, 'stores': 0, 'build_failures': 0}
+
+        if self.enabled and self.sqlite_path:
+            self._init_sqlite()
+
+    # === SQLITE УРОВЕНЬ ===
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.sqlite_path, timeout=5)
+
+    def _init_sqlite(self):
+        try:
+            directory = os.path.dirname(self.sqlite_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._sqlite_lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS resume_digests ("
+                    "user_id INTEGER PRIMARY KEY, resume_hash TEXT NOT NULL, "
+                    "digest TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("DELETE FROM resume_digests WHERE expires_at < ?", (time.time(),))
+            self._sqlite_ready = True
+        except Exception as e:
+            logger.error(f"❌ ResumeDigestStore: SQLite tier disabled: {e}")
+            self._sqlite_ready = False
+
+    def _sqlite_get(self, user_id: int) -> Optional[Tuple[str, float, str]]:
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT resume_hash, expires_at, digest FROM resume_digests WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            return (row[0], row[1], row[2]) if row else None
+
+    def _sqlite_set(self, user_id: int, digest_hash: str, expires_at: float, digest: str):
+        with self._sqlite_lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO resume_digests (user_id, resume_hash, digest, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, digest_hash, digest, expires_at)
+            )
+
+    async def _run_sqlite(self, func, *args, executor: BoundedExecutor = critical_executor):
+        try:
+            return await executor.run(func, *args)
+        except ExecutorOverloaded:
+            # Выжимка остается в памяти - запись в SQLite при перегрузке пропускаем
+            return None
+        except Exception as e:
+            logger.error(f"❌ ResumeDigestStore SQLite operation failed: {e}")
+            return None
+
+    # === ПУБЛИЧНЫЙ API ===
+
+    def _remember(self, user_id: int, digest_hash: str, expires_at: float, digest: str):
+        self._memory[user_id] = (digest_hash, expires_at, digest)
+        self._memory.move_to_end(user_id)
+        while len(self._memory) > self.max_users:
+            self._memory.popitem(last=False)
+
+    async def get(self, user_id: int, digest_hash: str) -> Optional[str]:
+        """Выжимка, если она построена для этого же резюме и не устарела"""
+        if not self.enabled:
+            return None
+
+        entry = self._memory.get(user_id)
+        if entry is None and self._sqlite_ready:
+            entry = await self._run_sqlite(self._sqlite_get, user_id)
+            if entry and entry[0] == digest_hash and entry[1] >= time.time():
+                self._remember(user_id, *entry)
+                self.stats['hits_sqlite'] += 1
+                return entry[2]
+            entry = None
+
+        if entry and entry[0] == digest_hash and entry[1] >= time.time():
+            self._memory.move_to_end(user_id)
+            self.stats['hits_memory'] += 1
+            return entry[2]
+
+        self.stats['misses'] += 1
+        return None
+
+    async def set(self, user_id: int, digest_hash: str, digest: str):
+        """Сохранить выжимку последнего резюме пользователя"""
+        if not self.enabled or not digest:
+            return
+
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(user_id, digest_hash, expires_at, digest)
+        self.stats['stores'] += 1
+
+        if self._sqlite_ready:
+            await self._run_sqlite(self._sqlite_set, user_id, digest_hash, expires_at, digest,
+                                   executor=background_executor)
+
+    async def _build(self, user_id: int, digest_hash: str, resume_text: str, ai_service):
+        try:
+            response = await ai_service.get_completion(
+                prompt=build_resume_digest_prompt(resume_text),
+                temperature=0.2,
+                max_tokens=RESUME_DIGEST_MAX_TOKENS,
+                user_id=user_id,
+                request_type="resume_digest"
+            )
+            digest = response.strip() if response else ''
+            # Выжимка длиннее самого резюме бесполезна
+            if not digest or len(digest) >= len(resume_text):
+                self.stats['build_failures'] += 1
+                return
+            await self.set(user_id, digest_hash, digest)
+            logger.info(f"🧾 Выжимка резюме пользователя {user_id}: {len(resume_text)} → {len(digest)} символов")
+        except Exception as e:
+            self.stats['build_failures'] += 1
+            logger.error(f"❌ Не удалось построить выжимку резюме (user_id={user_id}): {e}")
+
+    def schedule_build(self, user_id: int, digest_hash: str, resume_text: str, ai_service) -> asyncio.Task:
+        """Построить выжимку в фоне (не больше одного построения на пользователя)"""
+        running = self._building.get(user_id)
+        if running is not None and not running.done():
+            return running
+        # Фоновый запрос не должен обновлять позицию в очереди у сообщения пользователя
+        with ai_request_context(user_id):
+            task = asyncio.ensure_future(self._build(user_id, digest_hash, resume_text, ai_service))
+        self._building[user_id] = task
+        task.add_done_callback(lambda done: self._building.pop(user_id, None) if self._building.get(user_id) is done else None)
+        return task
+
+    def get_stats(self) -> dict:
+        """Статистика для мониторинга"""
+        return {
+            **self.stats,
+            'memory_entries': len(self._memory),
+            'building': len(self._building),
+            'sqlite_enabled': self._sqlite_ready
+        }
+
+
+# Глобальное хранилище выжимок
+resume_digests = ResumeDigestStore(
+    max_users=RESUME_DIGEST_MAX_USERS,
+    ttl_seconds=RESUME_DIGEST_TTL_SECONDS,
+    sqlite_path=RESUME_DIGEST_SQLITE_PATH,
+    enabled=RESUME_DIGEST_ENABLED
+)
+
+
+async def get_resume_digest(resume_text: str, user_id: Optional[int], ai_service,
+                            wait: bool = False) -> Optional[str]:
+    """
+    Готовая выжимка резюме пользователя или None
+
+    Если выжимки для этого резюме еще нет, она строится в фоне и пригодится
+    следующим генерациям (повтор, следующая вакансия). wait=True дожидается
+    построения - когда по одному резюме сразу пишется несколько писем.
+    """
+    if not resume_digests.enabled or user_id is None or estimate_tokens(resume_text) < RESUME_DIGEST_MIN_TOKENS:
+        return None
+
+    digest_hash = resume_hash(resume_text)
+    digest = await resume_digests.get(user_id, digest_hash)
+    if digest:
+        logger.info(f"🧾 Использую выжимку резюме вместо полного текста (user_id={user_id})")
+        return digest
+
+    task = resume_digests.schedule_build(user_id, digest_hash, resume_text, ai_service)
+    if not wait:
+        return None
+    # shield: отмена ожидающего не прерывает построение, нужное и другим письмам
+    await asyncio.shield(task)
+    return await resume_digests.get(user_id, digest_hash)
@@ -0,0 +1,276 @@
+"""
+Разбор резюме на разделы и отбор релевантных вакансии для промпта
+
+Резюме до 15000 символов раньше целиком вставлялось в промпт письма. Теперь длинное
+резюме разбивается на разделы (шапка, отдельные места работы, навыки, образование...),
+каждый раздел оценивается по BM25 относительно текста вакансии, и в промпт попадают
+самые релевантные разделы в пределах бюджета токенов - в исходном порядке.
+Шапка резюме (имя, должность) включается всегда.
+
+Токенизация общая для русского и английского: слова приводятся к нижнему регистру
+и обрезаются до префикса (грубый стемминг, чтобы "управлял" и "управление" совпадали).
+Матрица частот и BM25 считаются в NumPy; без NumPy - тот же расчет на чистом Python.
+"""
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from config import RESUME_TRIMMING_ENABLED, RESUME_PROMPT_TOKEN_BUDGET
+from .ai_service import estimate_tokens
+
+# Безопасный импорт NumPy
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Длина префикса слова после "стемминга"
+STEM_LENGTH = 6
+
+# Заголовки разделов резюме → тип раздела
+SECTION_HEADINGS = {
+    'experience': (
+        'опыт работы', 'опыт', 'трудовая деятельность', 'места работы', 'карьера',
+        'experience', 'work experience', 'professional experience', 'employment', 'employment history'
+    ),
+    'skills': (
+        'ключевые навыки', 'навыки', 'профессиональные навыки', 'компетенции', 'технологии', 'стек',
+        'skills', 'key skills', 'technical skills', 'hard skills', 'soft skills', 'tech stack'
+    ),
+    'education': (
+        'образование', 'высшее образование', 'повышение квалификации', 'курсы', 'сертификаты',
+        'education', 'courses', 'certifications', 'certificates', 'training'
+    ),
+    'summary': (
+        'о себе', 'обо мне', 'цель', 'желаемая должность', 'summary', 'about', 'about me',
+        'profile', 'objective'
+    ),
+    'projects': ('проекты', 'достижения', 'projects', 'achievements'),
+    'languages': ('языки', 'знание языков', 'languages'),
+    'other': ('дополнительная информация', 'хобби', 'additional information', 'hobbies', 'interests')
+}
+
+_MONTHS = (
+    r'янв\w*|фев\w*|мар\w*|апр\w*|ма[йя]\w*|июн\w*|июл\w*|авг\w*|сен\w*|окт\w*|ноя\w*|дек\w*|'
+    r'jan\w*|feb\w*|mar\w*|apr\w*|may|jun\w*|jul\w*|aug\w*|sep\w*|oct\w*|nov\w*|dec\w*'
+)
+# Строка с периодом работы: "Январь 2020 — настоящее время", "03.2019 - 2021", "2018–2020"
+_DATE_RANGE_RE = re.compile(
+    rf'(?:(?:{_MONTHS})\.?\s+|\d{{1,2}}[./])?(?:19|20)\d{{2}}\s*[—–-]\s*'
+    rf'(?:(?:(?:{_MONTHS})\.?\s+|\d{{1,2}}[./])?(?:19|20)\d{{2}}|настоящ\w*|по\s+н\.?\s*в\.?|н\.\s*в\.?|сейчас|present|now|current)',
+    re.IGNORECASE
+)
+_TOKEN_RE = re.compile(r'[0-9a-zа-яё][0-9a-zа-яё+#]*', re.IGNORECASE)
+_STOP_WORDS = frozenset((
+    'и', 'в', 'во', 'на', 'с', 'со', 'по', 'для', 'из', 'от', 'до', 'за', 'не', 'что', 'как', 'это',
+    'или', 'а', 'но', 'при', 'к', 'у', 'о', 'об', 'мы', 'вы', 'я', 'мой', 'наш', 'ваш', 'их', 'его',
+    'the', 'and', 'of', 'to', 'in', 'for', 'with', 'on', 'at', 'by', 'an', 'or', 'is', 'are', 'be', 'as'
+))
+
+
+@dataclass
+class ResumeSection:
+    """Раздел резюме: шапка, место работы, навыки и т.д."""
+    kind: str
+    title: Optional[str] = None
+    lines: List[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.lines)
+
+
+def tokenize(text: str) -> List[str]:
+    """Токены для BM25: нижний регистр, без стоп-слов, длинные слова обрезаны до префикса"""
+    tokens = []
+    for word in _TOKEN_RE.findall(text.lower()):
+        if len(word) < 2 or word in _STOP_WORDS:
+            continue
+        tokens.append(word[:STEM_LENGTH])
+    return tokens
+
+
+def _heading_kind(line: str) -> Optional[str]:
+    """Тип раздела, если строка - заголовок ("Опыт работы", "SKILLS:", "Опыт работы — 8 лет")"""
+    if len(line) > 60:
+        return None
+    normalized = line.strip(' :—–-•*').lower()
+    for kind, headings in SECTION_HEADINGS.items():
+        for heading in headings:
+            if normalized == heading:
+                return kind
+            if normalized.startswith(heading) and re.match(r'^\s*[—–:-]+\s*\d', normalized[len(heading):]):
+                return kind
+    return None
+
+
+def split_resume_sections(resume_text: str) -> List[ResumeSection]:
+    """
+    Делит резюме на разделы по заголовкам; раздел опыта - на отдельные места работы
+
+    Место работы узнается по строке с периодом ("2019 — 2022"). Сколько строк
+    (компания, должность) стоит перед периодом, определяется по первому месту работы;
+    если перед новым местом есть пустая строка, граница проходит по ней.
+    """
+    sections: List[ResumeSection] = []
+    current = ResumeSection(kind='header')
+    # Индекс в current.lines, с которого начался абзац (после последней пустой строки)
+    paragraph_start = 0
+    # Строк перед периодом работы в первом месте работы раздела (None - периода еще не было)
+    date_offset: Optional[int] = None
+
+    def flush(section: ResumeSection):
+        if section.lines:
+            sections.append(section)
+
+    for raw_line in resume_text.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        line = re.sub(r'[ \t\u00a0]+', ' ', raw_line).strip()
+        if not line:
+            paragraph_start = len(current.lines)
+            continue
+
+        kind = _heading_kind(line)
+        if kind:
+            flush(current)
+            current = ResumeSection(kind=kind, title=line)
+            paragraph_start = 0
+            date_offset = None
+            continue
+
+        if current.kind == 'experience' and _DATE_RANGE_RE.search(line):
+            if date_offset is None:
+                date_offset = len(current.lines)
+            else:
+                if 0 < paragraph_start and len(current.lines) - paragraph_start <= date_offset:
+                    split_at = paragraph_start
+                else:
+                    split_at = max(1, len(current.lines) - date_offset)
+                carried = current.lines[split_at:]
+                del current.lines[split_at:]
+                flush(current)
+                current = ResumeSection(kind='experience', title=current.title, lines=carried)
+                paragraph_start = 0
+        current.lines.append(line)
+
+    flush(current)
+    return sections
+
+
+def _bm25_numpy(documents: Sequence[List[str]], query: Dict[str, float]) -> List[float]:
+    vocabulary = {term: index for index, term in enumerate(query)}
+    rows, columns = [], []
+    for row, tokens in enumerate(documents):
+        for token in tokens:
+            column = vocabulary.get(token)
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+
+    tf = np.zeros((len(documents), len(vocabulary)))
+    np.add.at(tf, (np.array(rows, dtype=int), np.array(columns, dtype=int)), 1.0)
+    lengths = np.array([len(tokens) for tokens in documents], dtype=float)
+    average_length = lengths.mean() or 1.0
+
+    document_frequency = (tf > 0).sum(axis=0)
+    idf = np.log1p((len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+    weights = np.array([query[term] for term in vocabulary])
+    scores = (tf * (BM25_K1 + 1) / (tf + norm[:, None]) * idf) @ weights
+    return scores.tolist()
+
+
+def _bm25_python(documents: Sequence[List[str]], query: Dict[str, float]) -> List[float]:
+    counts = []
+    for tokens in documents:
+        document_counts: Dict[str, int] = {}
+        for token in tokens:
+            if token in query:
+                document_counts[token] = document_counts.get(token, 0) + 1
+        counts.append(document_counts)
+    average_length = (sum(len(tokens) for tokens in documents) / len(documents)) or 1.0
+
+    idf = {}
+    for term in query:
+        frequency = sum(1 for document_counts in counts if term in document_counts)
+        idf[term] = math.log1p((len(documents) - frequency + 0.5) / (frequency + 0.5))
+
+    scores = []
+    for tokens, document_counts in zip(documents, counts):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / average_length)
+        scores.append(sum(
+            query[term] * idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            for term, tf in document_counts.items()
+        ))
+    return scores
+
+
+def score_sections(sections: Sequence[ResumeSection], vacancy_text: str) -> List[float]:
+    """BM25-релевантность каждого раздела тексту вакансии"""
+    query: Dict[str, float] = {}
+    for token in tokenize(vacancy_text):
+        query[token] = query.get(token, 0.0) + 1.0
+    if not query or not sections:
+        return [0.0] * len(sections)
+    # Повторы слова в вакансии важны, но не линейно
+    query = {term: 1.0 + math.log(count) for term, count in query.items()}
+    documents = [tokenize(section.text) for section in sections]
+    if NUMPY_AVAILABLE:
+        return _bm25_numpy(documents, query)
+    return _bm25_python(documents, query)
+
+
+def trim_resume_for_prompt(resume_text: str, vacancy_text: str,
+                           token_budget: int = RESUME_PROMPT_TOKEN_BUDGET) -> str:
+    """
+    Резюме для промпта: целиком, если укладывается в бюджет, иначе - шапка
+    и самые релевантные вакансии разделы в исходном порядке
+    """
+    if not RESUME_TRIMMING_ENABLED or estimate_tokens(resume_text) <= token_budget:
+        return resume_text
+
+    sections = split_resume_sections(resume_text)
+    if len(sections) < 3:
+        return resume_text
+
+    scores = score_sections(sections, vacancy_text)
+    selected = set()
+    used = 0
+    if sections[0].kind == 'header':
+        selected.add(0)
+        used += estimate_tokens(sections[0].text)
+    for index in sorted(range(len(sections)), key=lambda i: (-scores[i], i)):
+        if index in selected:
+            continue
+        cost = estimate_tokens(sections[index].text)
+        if used + cost <= token_budget:
+            selected.add(index)
+            used += cost
+
+    if len(selected) <= 1:
+        return resume_text
+
+    blocks = []
+    last_title = None
+    for index in sorted(selected):
+        section = sections[index]
+        lines = section.lines
+        if section.title and section.title != last_title:
+            lines = [section.title] + lines
+        last_title = section.title
+        blocks.append('\n'.join(lines))
+    trimmed = '\n\n'.join(blocks)
+
+    logger.info(
+        f"✂️ Резюме для промпта: {len(resume_text)} → {len(trimmed)} символов, "
+        f"разделов {len(selected)} из {len(sections)}"
+    )
+    return trimmed
@@ -0,0 +1,170 @@
+"""
+Отложенная запись обновлений letter_sessions (write-behind)
+
+Одна генерация письма обновляла строку сессии несколько раз: данные резюме,
+готовое письмо, номер итерации - и каждый раз отдельным PATCH. Теперь частичные
+обновления сессии накапливаются в памяти и сливаются в один PATCH, который уходит
+на этапе сессии (финальный статус: completed, failed, cancelled, abandoned) или,
+если этапа не было, через SESSION_WRITE_DELAY_MS после первого изменения.
+
+Кроме того, здесь хранится известное состояние итераций сессий (current_iteration,
+max_iterations, has_feedback): статус итераций после генерации отдается из памяти,
+без чтения строки из БД. Чтения строки сессии накладывают еще не записанные поля
+поверх прочитанных (read-your-writes). При остановке бота все изменения дописываются.
+"""
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from config import SESSION_WRITE_BEHIND_ENABLED, SESSION_WRITE_DELAY_MS, SESSION_STATE_MAX_SESSIONS
+
+logger = logging.getLogger(__name__)
+
+# Финальные статусы - этапы, на которых изменения сессии записываются сразу
+MILESTONE_STATUSES = ('completed', 'failed', 'cancelled', 'abandoned')
+# Поля, которые хранятся в памяти для статуса итераций
+TRACKED_FIELDS = ('current_iteration', 'max_iterations', 'has_feedback', 'status')
+
+# PATCH строки сессии: (session_id, поля) -> успех
+SessionWriter = Callable[[str, Dict[str, Any]], Awaitable[bool]]
+
+
+class SessionWriteBehind:
+    """Слияние частичных обновлений letter_sessions в один PATCH на этап сессии"""
+
+    def __init__(self, delay: float = 60.0, max_sessions: int = 10000, enabled: bool = True):
+        self.enabled = enabled
+        self.delay = delay
+        self.max_sessions = max_sessions
+
+        self._writer: Optional[SessionWriter] = None
+        # session_id -> поля, еще не записанные в БД
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # session_id -> известные значения TRACKED_FIELDS (LRU)
+        self._known: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Отложенные записи (сильные ссылки) и блокировки порядка PATCH по сессии
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._stopped = False
+
+        self.stats = {'updates': 0, 'coalesced': 0, 'patches': 0, 'failures': 0, 'state_hits': 0}
+
+    def set_writer(self, writer: SessionWriter):
+        """Функция записи сессии (AnalyticsService._patch_session)"""
+        self._writer = writer
+
+    # === ИЗВЕСТНОЕ СОСТОЯНИЕ ===
+
+    def remember(self, session_id: str, fields: Dict[str, Any], from_db: bool = False):
+        """
+        Запомнить поля итераций сессии (после создания, обновления или чтения из БД)
+
+        from_db=True не затирает значения, которые еще не записаны в БД.
+        """
+        if not self.enabled or not session_id:
+            return
+        pending = self._pending.get(session_id, {}) if from_db else {}
+        tracked = {key: fields[key] for key in TRACKED_FIELDS if key in fields and key not in pending}
+        state = self._known.pop(session_id, {})
+        state.update(tracked)
+        self._known[session_id] = state
+        while len(self._known) > self.max_sessions:
+            self._known.popitem(last=False)
+
+    def get_state(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Известные поля итераций сессии или None"""
+        state = self._known.get(session_id)
+        if state is None:
+            return None
+        self._known.move_to_end(session_id)
+        self.stats['state_hits'] += 1
+        return dict(state)
+
+    def overlay(self, session_id: str, row: Dict[str, Any]) -> Dict[str, Any]:
+        """Строка сессии из БД с еще не записанными изменениями поверх"""
+        pending = self._pending.get(session_id)
+        return {**row, **pending} if pending else row
+
+    # === ЗАПИСЬ ===
+
+    async def update(self, session_id: str, fields: Dict[str, Any], flush: bool = False) -> bool:
+        """
+        Добавить изменения сессии в ожидающий PATCH
+
+        False - отложенная запись недоступна (выключена, бот останавливается),
+        изменения нужно записать напрямую. Финальный статус записывается сразу.
+        """
+        if not self.enabled or self._stopped or self._writer is None or not session_id:
+            return False
+
+        self.stats['updates'] += 1
+        self.remember(session_id, fields)
+        pending = self._pending.get(session_id)
+        if pending is None:
+            self._pending[session_id] = dict(fields)
+        else:
+            self.stats['coalesced'] += 1
+            pending.update(fields)
+
+        if flush or fields.get('status') in MILESTONE_STATUSES:
+            await self.flush(session_id)
+        elif session_id not in self._timers:
+            self._timers[session_id] = asyncio.ensure_future(self._flush_later(session_id))
+        return True
+
+    async def _flush_later(self, session_id: str):
+        await asyncio.sleep(self.delay)
+        # Таймер больше не отменяем: запись уже началась
+        self._timers.pop(session_id, None)
+        await self.flush(session_id)
+
+    async def flush(self, session_id: str) -> bool:
+        """Записать накопленные изменения сессии одним PATCH"""
+        timer = self._timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        # Блокировка сохраняет порядок PATCH одной сессии
+        async with lock:
+            fields = self._pending.pop(session_id, None)
+            if not fields:
+                return True
+            self.stats['patches'] += 1
+            try:
+                written = await self._writer(session_id, fields)
+            except Exception as e:
+                logger.error(f"❌ Не удалось записать сессию {session_id}: {e}")
+                written = False
+            if not written:
+                self.stats['failures'] += 1
+            return written
+
+    async def stop(self):
+        """Дописать все изменения (при остановке бота); дальнейшие обновления пишутся сразу"""
+        self._stopped = True
+        pending = list(self._pending)
+        if pending:
+            logger.info(f"💾 Дописываю изменения сессий: {len(pending)}")
+            await asyncio.gather(*(self.flush(session_id) for session_id in pending), return_exceptions=True)
+
+    def get_stats(self) -> dict:
+        """Статистика для мониторинга"""
+        return {
+            **self.stats,
+            'pending_sessions': len(self._pending),
+            'known_sessions': len(self._known)
+        }
+
+
+# Глобальный буфер изменений сессий
+session_writes = SessionWriteBehind(
+    delay=SESSION_WRITE_DELAY_MS / 1000,
+    max_sessions=SESSION_STATE_MAX_SESSIONS,
+    enabled=SESSION_WRITE_BEHIND_ENABLED
+)
@@ -0,0 +1,144 @@
+"""
+Single-flight: объединение одинаковых одновременных запросов к AI
+
+Двойное нажатие "повторить", повторная вставка резюме, пока письмо еще пишется,
+или дважды сработавший обработчик улучшения запускают одинаковые запросы к
+провайдеру. Пока запрос с таким же отпечатком (пользователь, промпт, параметры)
+выполняется, повторные вызовы ждут его результат, а не платят за токены заново.
+
+Отмена одного из ожидающих не отменяет общий запрос, пока его ждет кто-то еще.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from config import SINGLE_FLIGHT_ENABLED
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SharedStreamError(Exception):
+    """Общий потоковый запрос завершился без результата (ошибка или отмена у ведущего)"""
+
+
+def request_fingerprint(
+    user_id: Optional[int],
+    session_id: Optional[str],
+    prompt: str,
+    **params
+) -> str:
+    """
+    Отпечаток запроса к AI
+
+    Пользователь важнее сессии: повторная вставка и "повторить" создают новую
+    сессию с тем же промптом, поэтому сессия учитывается, только если пользователь неизвестен.
+    """
+    owner = f"user:{user_id}" if user_id is not None else f"session:{session_id}"
+    payload = json.dumps(
+        [owner, hashlib.sha256(prompt.encode('utf-8')).hexdigest(), sorted(params.items())],
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Реестр выполняющихся запросов по отпечатку"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def _finish(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _wait(self, key: str, flight: _Flight):
+        """Ждать общий результат; последний ушедший ожидающий отменяет запрос"""
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.future.done():
+                flight.future.cancel()
+                self._finish(key, flight)
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Выполнить call или дождаться уже выполняющегося запроса с тем же ключом"""
+        if not self.enabled:
+            return await call()
+
+        self.stats['calls'] += 1
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.stats['shared'] += 1
+            logger.info(f"🔗 Одинаковый запрос уже выполняется, жду его результат ({key[:12]})")
+            return await self._wait(key, flight)
+
+        flight = _Flight(asyncio.ensure_future(call()))
+        self._flights[key] = flight
+        flight.future.add_done_callback(lambda _: self._finish(key, flight))
+        return await self._wait(key, flight)
+
+    async def stream(self, key: str, open_stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Потоковый вариант: ведущий получает фрагменты по мере генерации,
+        повторные вызовы - готовый текст одним фрагментом после завершения
+        """
+        if not self.enabled:
+            async for delta in open_stream():
+                yield delta
+            return
+
+        self.stats['calls'] += 1
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.stats['shared'] += 1
+            logger.info(f"🔗 Одинаковый поток уже выполняется, жду его результат ({key[:12]})")
+            flight.waiters += 1
+            try:
+                text = await asyncio.shield(flight.future)
+            finally:
+                flight.waiters -= 1
+            if text:
+                yield text
+            return
+
+        flight = _Flight(asyncio.get_event_loop().create_future())
+        self._flights[key] = flight
+        parts: List[str] = []
+        try:
+            async for delta in open_stream():
+                parts.append(delta)
+                yield delta
+        except BaseException as e:
+            if flight.waiters:
+                flight.future.set_exception(SharedStreamError(f"Shared stream failed: {type(e).__name__}"))
+            else:
+                flight.future.cancel()
+            raise
+        else:
+            flight.future.set_result(''.join(parts))
+        finally:
+            self._finish(key, flight)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, 'in_flight': len(self._flights)}
+
+
+# Глобальный реестр (общий для всех провайдеров)
+ai_single_flight = SingleFlight(enabled=SINGLE_FLIGHT_ENABLED)
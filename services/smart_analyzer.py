@@ -3,54 +3,35 @@ Smart Analyzer v7.0 - UNIFIED LETTER GENERATION
 Максимально упрощенная и оптимизированная версия
 Только твой промпт → AI → готовое письмо
 """
+import asyncio
 import logging
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-logger = logging.getLogger(__name__)
+from config import LETTER_VARIANTS_TEMPERATURE, MIN_RESPONSE_LENGTH, VACANCY_ANALYSIS_STAGE_ENABLED
+from services.improvement_context import ImprovementContext
+from services.letter_cache import letter_cache, make_letter_cache_key
+from services.resume_digest import get_resume_digest
+from services.resume_sections import trim_resume_for_prompt
+from services.vacancy_analysis import VACANCY_ANALYSIS_STEP, get_vacancy_analysis
 
+logger = logging.getLogger(__name__)
 
-async def generate_simple_letter(
-    vacancy_text: str,
-    resume_text: str,
-    ai_service=None,
-    user_id: Optional[int] = None,
-    session_id: Optional[str] = None
-) -> str:
-    """
-    🎯 ЕДИНСТВЕННАЯ ФУНКЦИЯ: Вакансия + Резюме → Готовое письмо
-    """
-    if ai_service is None:
-        from services.ai_factory import get_ai_service
-        ai_service = get_ai_service()
-    
-    # ТВОЙ ПРОМПТ - ТОЧНАЯ КОПИЯ
-    prompt = f"""Ты - эксперт по созданию сопроводительных писем, которые заставляют HR-менеджеров остановиться и подумать: "Черт, этот кандидат ТОЧНО понимает, что нам нужно". Твоя задача - создать письмо, которое демонстрирует глубокое понимание потребностей компании и показывает кандидата как идеальное решение их проблем.
+# Версия промпта генерации - входит в ключ кэша писем, менять при любой правке промпта
+LETTER_PROMPT_VERSION = "v7.0"
+LETTER_TEMPERATURE = 0.7
 
-ВХОДНЫЕ ДАННЫЕ
 
-ВАКАНСИЯ: {vacancy_text}
+def _letter_cache_key(vacancy_text: str, resume_text: str, ai_service) -> str:
+    """Ключ кэша письма для текущего промпта и модели"""
+    model = getattr(ai_service, 'model_name', None) or type(ai_service).__name__
+    prompt_version = f"{LETTER_PROMPT_VERSION}-staged" if VACANCY_ANALYSIS_STAGE_ENABLED else LETTER_PROMPT_VERSION
+    return make_letter_cache_key(prompt_version, vacancy_text, resume_text, model, LETTER_TEMPERATURE)
 
-РЕЗЮМЕ КАНДИДАТА: {resume_text}
 
-АЛГОРИТМ АНАЛИЗА
+# ТВОЙ ПРОМПТ - ТОЧНАЯ КОПИЯ (разбит на блоки, чтобы анализ вакансии можно было вынести в отдельный этап)
+LETTER_PROMPT_INTRO = """Ты - эксперт по созданию сопроводительных писем, которые заставляют HR-менеджеров остановиться и подумать: "Черт, этот кандидат ТОЧНО понимает, что нам нужно". Твоя задача - создать письмо, которое демонстрирует глубокое понимание потребностей компании и показывает кандидата как идеальное решение их проблем."""
 
-ШАГ 1: ГЛУБОКИЙ АНАЛИЗ ВАКАНСИИ
-Проанализируй вакансию и выдели:
-А) ЯВНЫЕ ПОТРЕБНОСТИ:
-* Конкретные навыки и технологии
-* Опыт работы и достижения
-* Личностные качества
-Б) СКРЫТЫЕ ПОТРЕБНОСТИ (читай между строк):
-* Какие проблемы решает эта позиция?
-* Какие боли есть у команды/отдела?
-* Что стоит за формулировками типа "желателен опыт в..."?
-* Какой результат ждут от нового сотрудника?
-В) ЭМОЦИОНАЛЬНЫЕ ТРИГГЕРЫ:
-* Какие слова используются в описании?
-* Какая культура компании просвечивает?
-* На что делается особый акцент?
-
-ШАГ 2: АНАЛИЗ РЕЗЮМЕ
+RESUME_ANALYSIS_STEP = """ШАГ 2: АНАЛИЗ РЕЗЮМЕ
 Найди в резюме:
 А) ПРЯМЫЕ СОВПАДЕНИЯ:
 * Навыки 1 в 1 с требованиями
@@ -62,9 +43,9 @@ async def generate_simple_letter(
 * Достижения, показывающие нужные качества
 В) УНИКАЛЬНЫЕ ПРЕИМУЩЕСТВА:
 * Что выделяет кандидата среди других?
-* Какой дополнительный value он может принести?
+* Какой дополнительный value он может принести?"""
 
-ШАГ 3: СОЗДАНИЕ ПИСЬМА
+LETTER_WRITING_STEPS = """ШАГ 3: СОЗДАНИЕ ПИСЬМА
 
 СТРУКТУРА:
 ХУК (первое предложение):
@@ -153,11 +134,117 @@ B2B в HotelTech — это баланс между функциональнос
 5. Стоит ли с ним встретиться?
 
 РЕЗУЛЬТАТ: Создай сопроводительное письмо объемом 200-250 слов в стиле приведенного примера, которое заставит HR подумать: "Этот человек ТОЧНО понимает, что нам нужно, и может это дать"."""
+
+
+def build_simple_letter_prompt(vacancy_text: str, resume_text: str) -> str:
+    """
+    Собирает единый промпт генерации письма (общий для обычного и потокового режима)
+    """
+    return f"""{LETTER_PROMPT_INTRO}
+
+ВХОДНЫЕ ДАННЫЕ
+
+ВАКАНСИЯ: {vacancy_text}
+
+РЕЗЮМЕ КАНДИДАТА: {resume_text}
+
+АЛГОРИТМ АНАЛИЗА
+
+{VACANCY_ANALYSIS_STEP}
+
+{RESUME_ANALYSIS_STEP}
+
+{LETTER_WRITING_STEPS}"""
+
+
+def build_staged_letter_prompt(vacancy_analysis: str, resume_text: str) -> str:
+    """
+    Промпт генерации письма по готовому анализу вакансии (двухэтапный режим)
+    
+    Шаг анализа вакансии уже выполнен отдельно и взят из общего кэша,
+    поэтому сырой текст вакансии в промпт не передается.
+    """
+    return f"""{LETTER_PROMPT_INTRO}
+
+ВХОДНЫЕ ДАННЫЕ
+
+АНАЛИЗ ВАКАНСИИ (уже выполнен, используй его как ШАГ 1):
+{vacancy_analysis}
+
+РЕЗЮМЕ КАНДИДАТА: {resume_text}
+
+АЛГОРИТМ АНАЛИЗА
+
+ШАГ 1: АНАЛИЗ ВАКАНСИИ - готов, опирайся на него и не повторяй.
+
+{RESUME_ANALYSIS_STEP}
+
+{LETTER_WRITING_STEPS}"""
+
+
+async def prepare_letter_prompt(
+    vacancy_text: str,
+    resume_text: str,
+    ai_service,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    vacancy_analysis: Optional[str] = None
+) -> str:
+    """
+    Готовит промпт письма: в двухэтапном режиме сначала получает анализ вакансии
+    (готовый спекулятивный, из общего кэша или отдельным запросом), иначе - единый промпт
+    
+    Длинное резюме заменяется готовой выжимкой пользователя (см. resume_digest),
+    а пока ее нет - сокращается до разделов, релевантных вакансии (см. resume_sections).
+    """
+    resume_digest = await get_resume_digest(resume_text, user_id, ai_service)
+    resume_text = resume_digest or trim_resume_for_prompt(resume_text, vacancy_text)
+    if VACANCY_ANALYSIS_STAGE_ENABLED:
+        if not vacancy_analysis:
+            vacancy_analysis = await get_vacancy_analysis(
+                vacancy_text, ai_service=ai_service, user_id=user_id, session_id=session_id
+            )
+        if vacancy_analysis:
+            return build_staged_letter_prompt(vacancy_analysis, resume_text)
+        logger.warning("⚠️ Анализ вакансии не получен, использую единый промпт")
+    
+    return build_simple_letter_prompt(vacancy_text, resume_text)
+
+
+async def generate_simple_letter(
+    vacancy_text: str,
+    resume_text: str,
+    ai_service=None,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    regenerate: bool = False,
+    vacancy_analysis: Optional[str] = None
+) -> str:
+    """
+    🎯 ЕДИНСТВЕННАЯ ФУНКЦИЯ: Вакансия + Резюме → Готовое письмо
+    
+    regenerate=True пропускает чтение кэша (повторная генерация нового варианта),
+    vacancy_analysis - готовый анализ вакансии (например, спекулятивный из handle_vacancy)
+    """
+    if ai_service is None:
+        from services.ai_factory import get_ai_service
+        ai_service = get_ai_service()
+    
+    cache_key = _letter_cache_key(vacancy_text, resume_text, ai_service)
+    if not regenerate:
+        cached_letter = await letter_cache.get(cache_key)
+        if cached_letter:
+            logger.info(f"💾 Письмо взято из кэша (user_id={user_id}, session_id={session_id})")
+            return cached_letter
     
     try:
+        prompt = await prepare_letter_prompt(
+            vacancy_text, resume_text, ai_service, user_id, session_id, vacancy_analysis=vacancy_analysis
+        )
+        
         response = await ai_service.get_completion(
             prompt=prompt,
-            temperature=0.7,
+            temperature=LETTER_TEMPERATURE,
             max_tokens=800,
             user_id=user_id,
             session_id=session_id,
@@ -167,7 +254,10 @@ B2B в HotelTech — это баланс между функциональнос
         if not response:
             return "Не удалось сгенерировать письмо. Попробуйте еще раз."
         
-        return response.strip()
+        letter = response.strip()
+        if len(letter) >= MIN_RESPONSE_LENGTH:
+            await letter_cache.set(cache_key, letter)
+        return letter
         
     except Exception as e:
         logger.error(f"❌ Ошибка генерации письма: {e}")
@@ -192,40 +282,136 @@ B2B в HotelTech — это баланс между функциональнос
         
         return "Произошла ошибка при генерации письма. Попробуйте еще раз." 
 
-async def generate_improved_letter(
+
+async def generate_letter_variants(
     vacancy_text: str,
     resume_text: str,
-    previous_letter: str,
-    user_feedback: str,
-    improvement_request: str,
+    count: int,
     ai_service=None,
     user_id: Optional[int] = None,
     session_id: Optional[str] = None
-) -> str:
+) -> List[str]:
     """
-    🔄 ФУНКЦИЯ УЛУЧШЕНИЯ ПИСЬМА: Предыдущее письмо + Комментарии → Улучшенное письмо
+    🎲 НЕСКОЛЬКО ВАРИАНТОВ ПИСЬМА ЗА ОДИН РАУНД (повторная генерация)
+    
+    Кэш писем не используется: пользователь просит новые варианты.
+    Возвращает только полноценные письма без дубликатов; пустой список - ни одного.
     """
     if ai_service is None:
         from services.ai_factory import get_ai_service
         ai_service = get_ai_service()
     
-    # ПРОМПТ ДЛЯ УЛУЧШЕНИЯ ПИСЬМА
-    prompt = f"""Ты - эксперт по созданию сопроводительных писем. Твоя задача - улучшить существующее письмо на основе комментариев пользователя.
+    try:
+        prompt = await prepare_letter_prompt(vacancy_text, resume_text, ai_service, user_id, session_id)
+        responses = await ai_service.get_completions(
+            prompt=prompt,
+            n=count,
+            temperature=LETTER_VARIANTS_TEMPERATURE,
+            max_tokens=800,
+            user_id=user_id,
+            session_id=session_id,
+            request_type="letter_variants"
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка генерации вариантов письма: {e}")
+        return []
+    
+    variants: List[str] = []
+    for response in responses:
+        letter = response.strip()
+        if len(letter) >= MIN_RESPONSE_LENGTH and letter not in variants:
+            variants.append(letter)
+    return variants
 
-ИСХОДНЫЕ ДАННЫЕ:
 
-ВАКАНСИЯ: {vacancy_text}
+async def generate_letters_for_vacancies(
+    vacancies: Dict[int, str],
+    resume_text: str,
+    session_ids: Dict[int, Optional[str]],
+    ai_service=None,
+    user_id: Optional[int] = None
+) -> AsyncIterator[Tuple[int, str]]:
+    """
+    📚 ОДНО РЕЗЮМЕ - МНОГО ВАКАНСИЙ: письма пишутся одновременно
+    
+    Резюме обрабатывается один раз: до запуска писем строится его выжимка,
+    которую затем используют все письма. Выдает (номер вакансии, письмо)
+    по мере готовности; запросы к AI идут через общий планировщик.
+    """
+    if ai_service is None:
+        from services.ai_factory import get_ai_service
+        ai_service = get_ai_service()
+    
+    await get_resume_digest(resume_text, user_id, ai_service, wait=True)
+    
+    async def generate(index: int) -> Tuple[int, str]:
+        letter = await generate_simple_letter(
+            vacancies[index], resume_text, ai_service=ai_service,
+            user_id=user_id, session_id=session_ids.get(index)
+        )
+        return index, letter
+    
+    tasks = [asyncio.ensure_future(generate(index)) for index in vacancies]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
 
-РЕЗЮМЕ КАНДИДАТА: {resume_text}
 
-ТЕКУЩАЯ ВЕРСИЯ ПИСЬМА:
-{previous_letter}
+async def stream_simple_letter(
+    vacancy_text: str,
+    resume_text: str,
+    ai_service=None,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    regenerate: bool = False,
+    vacancy_analysis: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    🌊 ПОТОКОВАЯ ВЕРСИЯ generate_simple_letter: отдает фрагменты письма по мере генерации
+    
+    При попадании в кэш письмо отдается одним фрагментом.
+    Ошибки не перехватываются - вызывающий код решает, делать ли fallback
+    на обычную генерацию.
+    """
+    if ai_service is None:
+        from services.ai_factory import get_ai_service
+        ai_service = get_ai_service()
+    
+    cache_key = _letter_cache_key(vacancy_text, resume_text, ai_service)
+    if not regenerate:
+        cached_letter = await letter_cache.get(cache_key)
+        if cached_letter:
+            logger.info(f"💾 Письмо взято из кэша (user_id={user_id}, session_id={session_id})")
+            yield cached_letter
+            return
+    
+    prompt = await prepare_letter_prompt(
+        vacancy_text, resume_text, ai_service, user_id, session_id, vacancy_analysis=vacancy_analysis
+    )
+    
+    parts = []
+    async for delta in ai_service.stream_completion(
+        prompt=prompt,
+        temperature=LETTER_TEMPERATURE,
+        max_tokens=800,
+        user_id=user_id,
+        session_id=session_id,
+        request_type="letter_generation"
+    ):
+        parts.append(delta)
+        yield delta
+    
+    letter = ''.join(parts).strip()
+    if len(letter) >= MIN_RESPONSE_LENGTH:
+        await letter_cache.set(cache_key, letter)
 
-КОММЕНТАРИЙ ПОЛЬЗОВАТЕЛЯ: {user_feedback}
 
-ЗАПРОС НА УЛУЧШЕНИЕ: {improvement_request}
+IMPROVEMENT_PROMPT_INTRO = """Ты - эксперт по созданию сопроводительных писем. Твоя задача - улучшить существующее письмо на основе комментариев пользователя."""
 
-ЗАДАЧА:
+IMPROVEMENT_PRINCIPLES = """ЗАДАЧА:
 Улучши существующее письмо, учитывая комментарии и пожелания пользователя. 
 
 ПРИНЦИПЫ УЛУЧШЕНИЯ:
@@ -247,6 +433,94 @@ async def generate_improved_letter(
 - Делай изменения точечно, а не глобально
 
 РЕЗУЛЬТАТ: Улучшенная версия письма с учетом всех пожеланий пользователя."""
+
+
+def build_improvement_prompt(
+    vacancy_text: str,
+    resume_text: str,
+    previous_letter: str,
+    user_feedback: str,
+    improvement_request: str
+) -> str:
+    """Полный промпт улучшения: вся вакансия и все резюме"""
+    return f"""{IMPROVEMENT_PROMPT_INTRO}
+
+ИСХОДНЫЕ ДАННЫЕ:
+
+ВАКАНСИЯ: {vacancy_text}
+
+РЕЗЮМЕ КАНДИДАТА: {resume_text}
+
+ТЕКУЩАЯ ВЕРСИЯ ПИСЬМА:
+{previous_letter}
+
+КОММЕНТАРИЙ ПОЛЬЗОВАТЕЛЯ: {user_feedback}
+
+ЗАПРОС НА УЛУЧШЕНИЕ: {improvement_request}
+
+{IMPROVEMENT_PRINCIPLES}"""
+
+
+def build_compact_improvement_prompt(
+    improvement_context: ImprovementContext,
+    user_feedback: str,
+    improvement_request: str
+) -> str:
+    """
+    Промпт улучшения по сжатому контексту сессии
+
+    Вместо полной вакансии и резюме - анализ вакансии и выжимка резюме;
+    текущее письмо берется из контекста (последняя версия после прошлых итераций).
+    """
+    request_block = f"КОММЕНТАРИЙ ПОЛЬЗОВАТЕЛЯ: {user_feedback}"
+    if improvement_request and improvement_request != user_feedback:
+        request_block += f"\n\nЗАПРОС НА УЛУЧШЕНИЕ: {improvement_request}"
+
+    return f"""{IMPROVEMENT_PROMPT_INTRO}
+
+ИСХОДНЫЕ ДАННЫЕ:
+
+КЛЮЧЕВОЕ О ВАКАНСИИ:
+{improvement_context.vacancy_brief}
+
+КЛЮЧЕВОЕ ИЗ РЕЗЮМЕ КАНДИДАТА:
+{improvement_context.resume_highlights}
+
+ТЕКУЩАЯ ВЕРСИЯ ПИСЬМА:
+{improvement_context.current_letter}
+
+{request_block}
+
+{IMPROVEMENT_PRINCIPLES}"""
+
+
+async def generate_improved_letter(
+    vacancy_text: str,
+    resume_text: str,
+    previous_letter: str,
+    user_feedback: str,
+    improvement_request: str,
+    ai_service=None,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    improvement_context: Optional[ImprovementContext] = None
+) -> str:
+    """
+    🔄 ФУНКЦИЯ УЛУЧШЕНИЯ ПИСЬМА: Предыдущее письмо + Комментарии → Улучшенное письмо
+    
+    improvement_context - сжатый контекст сессии: если передан, полные тексты
+    вакансии и резюме в промпт не отправляются
+    """
+    if ai_service is None:
+        from services.ai_factory import get_ai_service
+        ai_service = get_ai_service()
+    
+    if improvement_context:
+        prompt = build_compact_improvement_prompt(improvement_context, user_feedback, improvement_request)
+    else:
+        prompt = build_improvement_prompt(
+            vacancy_text, resume_text, previous_letter, user_feedback, improvement_request
+        )
     
     try:
         response = await ai_service.get_completion(
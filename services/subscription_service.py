@@ -14,7 +14,7 @@ logger = logging.getLogger(__name__)
 
 class SubscriptionService:
     def __init__(self):
-        self.supabase = SupabaseClient.get_client()
+        self.supabase = SupabaseClient.get_async_client()
         self.enabled = SUBSCRIPTIONS_ENABLED and SupabaseClient.is_available()
     
     def _parse_period_end_safely(self, period_end) -> date:
@@ -72,7 +72,7 @@ class SubscriptionService:
             logger.info(f"🔄 Force refreshing limits for user {user_id}")
         
         try:
-            response = self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
+            response = await self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
             
             if not response.data:
                 logger.info(f"No subscription found for user {user_id}, attempting to create one.")
@@ -83,7 +83,7 @@ class SubscriptionService:
                         logger.error(f"Failed to create subscription for user {user_id}")
                         return self._free_access_fallback()
                     
-                    response = self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
+                    response = await self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
                     if not response.data:
                         logger.error(f"Analytics created subscription but not found in DB for user {user_id}")
                         return self._free_access_fallback()
@@ -150,7 +150,7 @@ class SubscriptionService:
                 return False
             
             # Получаем подписку
-            response = self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
+            response = await self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
             if not response.data:
                 return False
             
@@ -197,7 +197,7 @@ class SubscriptionService:
                 period_end = next_month.isoformat()
                 period_type = "месячные"
             
-            self.supabase.table('subscriptions').update({
+            await self.supabase.table('subscriptions').update({
                 'letters_used': 0,
                 'period_start': today.isoformat(),
                 'period_end': period_end
@@ -225,7 +225,7 @@ class SubscriptionService:
             logger.info(f"🔄 Attempting atomic increment for user {user_id}")
             
             # Используем атомарную SQL функцию
-            response = self.supabase.rpc('increment_user_letters', {
+            response = await self.supabase.rpc('increment_user_letters', {
                 'user_id_param': user_id
             }).execute()
             
@@ -267,7 +267,7 @@ class SubscriptionService:
                     new_used = current_used + 1
                     
                     # Обновляем в БД
-                    self.supabase.table('subscriptions').update({
+                    await self.supabase.table('subscriptions').update({
                         'letters_used': new_used,
                         'updated_at': 'now()'
                     }).eq('user_id', user_id).execute()
@@ -282,6 +282,59 @@ class SubscriptionService:
                 logger.error(f"❌ Fallback increment also failed for user {user_id}: {fallback_e}")
                 return False
     
+    async def reserve_letters(self, user_id: int, count: int) -> int:
+        """
+        Зарезервировать сразу несколько писем (пакетная генерация /bulk)
+
+        Списывает min(count, остаток) писем АТОМАРНО (SQL функция reserve_user_letters)
+        и возвращает, сколько удалось зарезервировать; 0 - если резерв не записан.
+        Неиспользованный резерв возвращается через release_letters.
+        """
+        if not self.enabled or not self.supabase:
+            return count
+
+        # Проверка лимитов заодно сбрасывает истекший период
+        limits = await self.check_user_limits(user_id, force_refresh=True)
+        if not limits.get('can_generate'):
+            return 0
+
+        try:
+            response = await self.supabase.rpc('reserve_user_letters', {
+                'user_id_param': user_id,
+                'count_param': count
+            }).execute()
+            if not response.data:
+                logger.error(f"❌ No response from reserve_user_letters for user {user_id}")
+                return 0
+            granted = response.data[0]['granted']
+            logger.info(f"✅ Reserved {granted}/{count} letters for user {user_id}: "
+                        f"count={response.data[0]['new_count']}")
+            return granted
+        except Exception as e:
+            # Резерв не записан - письма не генерируем, иначе release вернет несписанное
+            logger.error(f"❌ Error reserving letters for user {user_id}: {e}")
+            return 0
+
+    async def release_letters(self, user_id: int, count: int) -> bool:
+        """Вернуть неиспользованные письма из резерва reserve_letters (АТОМАРНО)"""
+        if not self.enabled or not self.supabase or count <= 0:
+            return True
+
+        try:
+            response = await self.supabase.rpc('release_user_letters', {
+                'user_id_param': user_id,
+                'count_param': count
+            }).execute()
+            if not response.data:
+                logger.error(f"❌ No subscription to release letters for user {user_id}")
+                return False
+            logger.info(f"↩️ Released {count} reserved letters for user {user_id}: "
+                        f"count={response.data[0]['new_count']}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error releasing letters for user {user_id}: {e}")
+            return False
+
     def format_limit_message(self, limits: Dict[str, Any]) -> str:
         """Форматировать сообщение о лимитах"""
         if not limits['can_generate']:
@@ -352,7 +405,7 @@ class SubscriptionService:
                 return False
             
             # Получаем текущую подписку
-            response = self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
+            response = await self.supabase.table('subscriptions').select('*').eq('user_id', user_id).execute()
             
             today = date.today()
             
@@ -409,12 +462,12 @@ class SubscriptionService:
             
             if response.data:
                 # Обновляем существующую подписку
-                self.supabase.table('subscriptions').update(subscription_data).eq('user_id', user_id).execute()
+                await self.supabase.table('subscriptions').update(subscription_data).eq('user_id', user_id).execute()
                 logger.info(f"✅ Premium subscription extended for user {user_id} until {new_period_end}")
             else:
                 # Создаем новую подписку
                 subscription_data['created_at'] = datetime.now().isoformat()
-                self.supabase.table('subscriptions').insert(subscription_data).execute()
+                await self.supabase.table('subscriptions').insert(subscription_data).execute()
                 logger.info(f"✅ Premium subscription created for user {user_id} until {new_period_end}")
             
             return True
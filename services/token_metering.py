@@ -0,0 +1,228 @@
+"""
+Единый учет токенов и стоимости запросов к AI (OpenAI и Claude)
+
+Раньше каждый путь логировал запросы сам: Claude - через _log_claude_request,
+у OpenAI usage части путей терялся, а запросы fallback моделей и переключение
+Claude → OpenAI не логировались вовсе. Теперь каждый вызов API провайдера
+(основная и fallback модель, хеджирование, продолжения обрезанных ответов,
+потоки) проходит через token_meter.record в точке вызова API.
+
+Пользователь, сессия и тип запроса берутся из metering_context, который
+устанавливает верхнеуровневый метод сервиса: вложенные вызовы (fallback модели,
+другой провайдер) учитываются за тот же логический запрос, а номер попытки
+показывает, сколько вызовов API понадобилось на один ответ.
+
+Запись в таблицу openai_requests выполняется в фоне; агрегаты по типу запроса,
+модели и пользователям доступны в get_stats (см. AIFactory.get_health).
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+from config import AI_MODEL_PRICES, AI_MODEL_INPUT_PRICES, AI_MODEL_OUTPUT_PRICES, TOKEN_METERING_MAX_USERS
+from .ai_service import parse_model_values
+
+logger = logging.getLogger(__name__)
+
+# Anthropic: запись промпта в кэш дороже обычного ввода, чтение - в 10 раз дешевле
+CACHE_WRITE_PRICE_FACTOR = 1.25
+CACHE_READ_PRICE_FACTOR = 0.1
+
+
+@dataclass
+class MeteringContext:
+    """Логический запрос, за который учитываются вызовы API"""
+    user_id: Optional[int] = None
+    session_id: Optional[str] = None
+    request_type: Optional[str] = None
+    attempts: int = 0
+
+
+_current_call: ContextVar[Optional[MeteringContext]] = ContextVar('metering_context', default=None)
+
+
+@contextmanager
+def metering_context(user_id: Optional[int], session_id: Optional[str], request_type: str):
+    """
+    Атрибуция вызовов API внутри блока
+
+    Вложенный контекст (например, Claude переключился на OpenAI) не заменяет внешний:
+    все вызовы учитываются за исходный запрос пользователя.
+    """
+    if _current_call.get() is not None:
+        yield _current_call.get()
+        return
+    token = _current_call.set(MeteringContext(user_id, session_id, request_type))
+    try:
+        yield _current_call.get()
+    finally:
+        _current_call.reset(token)
+
+
+class TokenMeter:
+    """Токены, задержка, попытки и оценка стоимости каждого вызова API"""
+
+    def __init__(self, input_prices: Dict[str, float], output_prices: Dict[str, float],
+                 blended_prices: Dict[str, float], max_users: int = 10000):
+        self.input_prices = input_prices
+        self.output_prices = output_prices
+        self.blended_prices = blended_prices
+        self.max_users = max_users
+        # (тип запроса, модель) -> счетчики
+        self._by_type: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._by_user: "OrderedDict[int, Dict[str, float]]" = OrderedDict()
+        # Фоновые записи в аналитику (сильные ссылки)
+        self._pending: Set[asyncio.Task] = set()
+
+    def estimate_cost(self, model: str, input_tokens: int, output_tokens: int,
+                      cache_write_tokens: int = 0, cache_read_tokens: int = 0) -> float:
+        """Оценка стоимости вызова в $ по ценам за 1K токенов"""
+        blended = self.blended_prices.get(model, 0.0)
+        input_price = self.input_prices.get(model, blended)
+        output_price = self.output_prices.get(model, blended)
+        prompt_units = (
+            input_tokens
+            + cache_write_tokens * CACHE_WRITE_PRICE_FACTOR
+            + cache_read_tokens * CACHE_READ_PRICE_FACTOR
+        )
+        return (prompt_units * input_price + output_tokens * output_price) / 1000
+
+    def record(
+        self,
+        provider: str,
+        model: str,
+        request_type: Optional[str],
+        input_tokens: int,
+        output_tokens: int,
+        latency: float,
+        success: bool,
+        error_message: Optional[str] = None,
+        continuation: bool = False,
+        estimated: bool = False,
+        cache_write_tokens: int = 0,
+        cache_read_tokens: int = 0,
+        user_id: Optional[int] = None,
+        session_id: Optional[str] = None
+    ):
+        """
+        Учесть один вызов API провайдера
+
+        user_id и session_id нужны только вне metering_context (потоковые запросы).
+        """
+        context = _current_call.get()
+        attempt = 1
+        if context is not None:
+            context.attempts += 1
+            attempt = context.attempts
+            request_type = context.request_type or request_type
+            user_id = context.user_id
+            session_id = context.session_id
+        request_type = request_type or 'completion'
+        if continuation and not request_type.endswith('_continuation'):
+            request_type = f"{request_type}_continuation"
+
+        total_input = input_tokens + cache_write_tokens + cache_read_tokens
+        cost = self.estimate_cost(model, input_tokens, output_tokens, cache_write_tokens, cache_read_tokens)
+
+        totals = self._by_type.setdefault((request_type, model), {
+            'requests': 0, 'failures': 0, 'retries': 0, 'input_tokens': 0, 'output_tokens': 0,
+            'cache_read_tokens': 0, 'cost_usd': 0.0, 'latency_sum': 0.0
+        })
+        totals['requests'] += 1
+        totals['failures'] += 0 if success else 1
+        totals['retries'] += 1 if attempt > 1 else 0
+        totals['input_tokens'] += total_input
+        totals['output_tokens'] += output_tokens
+        totals['cache_read_tokens'] += cache_read_tokens
+        totals['cost_usd'] += cost
+        totals['latency_sum'] += latency
+
+        if user_id is not None:
+            user_totals = self._by_user.pop(user_id, None) or {'requests': 0, 'tokens': 0, 'cost_usd': 0.0}
+            user_totals['requests'] += 1
+            user_totals['tokens'] += total_input + output_tokens
+            user_totals['cost_usd'] += cost
+            self._by_user[user_id] = user_totals
+            while len(self._by_user) > self.max_users:
+                self._by_user.popitem(last=False)
+
+        self._persist(
+            provider=provider,
+            model=model,
+            request_type=request_type,
+            prompt_tokens=total_input,
+            completion_tokens=output_tokens,
+            response_time_ms=int(latency * 1000),
+            success=success,
+            user_id=user_id,
+            session_id=session_id,
+            error_message=error_message,
+            attempt=attempt,
+            cost_usd=round(cost, 6),
+            tokens_estimated=estimated
+        )
+
+    def _persist(self, **fields):
+        """Запись вызова в openai_requests в фоне - не задерживает ответ пользователю"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет работающего event loop (скрипты, тесты) - только агрегаты в памяти
+            return
+        task = loop.create_task(self._log_request(**fields))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    @staticmethod
+    async def _log_request(prompt_tokens: int, completion_tokens: int, **fields):
+        try:
+            # Импортируем здесь чтобы избежать циклических импортов
+            from services.analytics_service import analytics
+            from models.analytics_models import OpenAIRequestData
+
+            await analytics.log_openai_request(OpenAIRequestData(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+                **fields
+            ))
+        except Exception as e:
+            # Логируем ошибку, но не прерываем основной процесс
+            logger.error(f"Ошибка при логировании запроса к AI: {e}")
+
+    def get_stats(self, top_users: int = 10) -> dict:
+        """Агрегаты по (модель, тип запроса) и самые дорогие пользователи"""
+        by_type = {}
+        for (request_type, model), totals in sorted(self._by_type.items()):
+            by_type[f"{model}:{request_type}"] = {
+                'requests': totals['requests'],
+                'failures': totals['failures'],
+                'retries': totals['retries'],
+                'input_tokens': totals['input_tokens'],
+                'output_tokens': totals['output_tokens'],
+                'cache_read_tokens': totals['cache_read_tokens'],
+                'cost_usd': round(totals['cost_usd'], 4),
+                'avg_latency': round(totals['latency_sum'] / totals['requests'], 2)
+            }
+        expensive_users = sorted(self._by_user.items(), key=lambda item: item[1]['cost_usd'], reverse=True)
+        return {
+            'total_cost_usd': round(sum(totals['cost_usd'] for totals in self._by_type.values()), 4),
+            'by_type': by_type,
+            'top_users': {
+                str(user_id): {**totals, 'cost_usd': round(totals['cost_usd'], 4)}
+                for user_id, totals in expensive_users[:top_users]
+            }
+        }
+
+
+# Глобальный учет токенов (общий для всех провайдеров)
+token_meter = TokenMeter(
+    input_prices=parse_model_values(AI_MODEL_INPUT_PRICES),
+    output_prices=parse_model_values(AI_MODEL_OUTPUT_PRICES),
+    blended_prices=parse_model_values(AI_MODEL_PRICES),
+    max_users=TOKEN_METERING_MAX_USERS
+)
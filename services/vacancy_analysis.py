@@ -0,0 +1,428 @@
+"""
+Отдельный этап анализа вакансии с общим кэшем для всех пользователей
+
+Одну и ту же вакансию с hh.ru присылают многие пользователи, поэтому
+"ШАГ 1: ГЛУБОКИЙ АНАЛИЗ ВАКАНСИИ" выполняется один раз, а результат
+переиспользуется. Ключ кэша - хэш нормализованного текста вакансии: копии,
+отличающиеся пробелами, регистром или трекинг-параметрами ссылок, попадают в кэш.
+
+Поиск почти-дубликатов по SimHash (VACANCY_SIMHASH_MAX_DISTANCE > 0) выключен по
+умолчанию: письмо пишется по анализу без исходного текста вакансии, а смена
+должности или грейда меняет SimHash всего на 1-3 бита. Поэтому почти-дубликат
+засчитывается, только если совпадают заголовок и строки требований вакансии.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from config import (
+    VACANCY_ANALYSIS_CACHE_MAX_ENTRIES,
+    VACANCY_ANALYSIS_CACHE_TTL_SECONDS,
+    VACANCY_SIMHASH_MAX_DISTANCE,
+    VACANCY_ANALYSIS_STAGE_ENABLED,
+    SPECULATIVE_ANALYSIS_ENABLED,
+    SPECULATIVE_ANALYSIS_TOKEN_BUDGET
+)
+from .ai_scheduler import ai_request_context
+from .ai_service import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Версия промпта анализа - входит в ключ кэша
+VACANCY_ANALYSIS_PROMPT_VERSION = "v1.0"
+VACANCY_ANALYSIS_MAX_TOKENS = 700
+
+SIMHASH_BITS = 64
+# 4 полосы по 16 бит: вакансии на расстоянии Хэмминга <= 3 совпадают хотя бы в одной полосе
+SIMHASH_BANDS = 4
+SIMHASH_BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+# Больше полосы LSH не гарантируют находку, а правки становятся содержательными
+SIMHASH_MAX_SAFE_DISTANCE = 3
+
+# Строки с этими словами описывают роль и требования - для почти-дубликата они
+# должны совпасть дословно (после нормализации)
+_KEY_LINE_MARKERS = (
+    'требован', 'обязан', 'опыт', 'знани', 'навык', 'умени', 'ожида', 'стаж', 'лет',
+    'junior', 'middle', 'senior', 'lead', 'младш', 'старш', 'ведущ', 'главн', 'руковод',
+    'разработчик', 'инженер', 'аналитик', 'менеджер', 'дизайнер', 'специалист',
+    'requirement', 'experience', 'skill', 'must', 'years'
+)
+
+VACANCY_ANALYSIS_STEP = """ШАГ 1: ГЛУБОКИЙ АНАЛИЗ ВАКАНСИИ
+Проанализируй вакансию и выдели:
+А) ЯВНЫЕ ПОТРЕБНОСТИ:
+* Конкретные навыки и технологии
+* Опыт работы и достижения
+* Личностные качества
+Б) СКРЫТЫЕ ПОТРЕБНОСТИ (читай между строк):
+* Какие проблемы решает эта позиция?
+* Какие боли есть у команды/отдела?
+* Что стоит за формулировками типа "желателен опыт в..."?
+* Какой результат ждут от нового сотрудника?
+В) ЭМОЦИОНАЛЬНЫЕ ТРИГГЕРЫ:
+* Какие слова используются в описании?
+* Какая культура компании просвечивает?
+* На что делается особый акцент?"""
+
+_URL_RE = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+_TOKEN_RE = re.compile(r'[0-9a-zа-яё+#]+', re.IGNORECASE)
+
+
+def build_vacancy_analysis_prompt(vacancy_text: str) -> str:
+    """Промпт отдельного этапа анализа вакансии"""
+    return f"""Ты - эксперт по найму. Подготовь структурированный анализ вакансии, который затем будет использован для написания сопроводительного письма.
+
+ВАКАНСИЯ: {vacancy_text}
+
+{VACANCY_ANALYSIS_STEP}
+
+Дополнительно укажи:
+* Название компании и позиции (если есть в тексте)
+* Ключевые слова из вакансии, которые стоит естественно использовать в письме
+
+ФОРМАТ ОТВЕТА: только анализ по пунктам выше, кратко и конкретно, без вступлений и без текста письма."""
+
+
+def normalize_vacancy(text: str) -> str:
+    """
+    Нормализует вакансию перед снятием отпечатка:
+    убирает ссылки (вместе с utm-метками и прочими трекерами), регистр и лишние пробелы
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize('NFKC', text).lower().replace('ё', 'е')
+    text = _URL_RE.sub(' ', text)
+    return ' '.join(_TOKEN_RE.findall(text))
+
+
+def vacancy_key_lines(text: str) -> str:
+    """Заголовок (первая непустая строка) и строки о роли и требованиях, нормализованные"""
+    lines = [normalize_vacancy(line) for line in (text or '').splitlines()]
+    lines = [line for line in lines if line]
+    if not lines:
+        return ""
+    key_lines = [lines[0]] + [
+        line for line in lines[1:] if any(marker in line for marker in _KEY_LINE_MARKERS)
+    ]
+    return '\n'.join(key_lines)
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """64-битный SimHash по шинглам из слов нормализованного текста"""
+    tokens = normalize_vacancy(text).split()
+    if not tokens:
+        return 0
+
+    if len(tokens) < shingle_size:
+        shingles = [' '.join(tokens)]
+    else:
+        shingles = [' '.join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = _feature_hash(shingle)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _bands(fingerprint: int) -> List[Tuple[int, int]]:
+    mask = (1 << SIMHASH_BAND_BITS) - 1
+    return [(i, (fingerprint >> (i * SIMHASH_BAND_BITS)) & mask) for i in range(SIMHASH_BANDS)]
+
+
+class VacancyFingerprint(NamedTuple):
+    """Отпечаток вакансии для кэша анализов"""
+    digest: str  # хэш нормализованного текста - точное совпадение
+    simhash: int  # для поиска почти-дубликатов
+    key_digest: str  # хэш заголовка и строк требований
+
+
+class VacancyAnalysisCache:
+    """
+    Кэш анализов вакансий: точное совпадение нормализованного текста и (если
+    max_distance > 0) почти-дубликаты по SimHash с тем же заголовком и требованиями
+
+    Поиск кандидатов идет через индекс по полосам отпечатка (LSH), поэтому
+    не требует перебора всех записей.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: int = 7 * 86400,
+                 max_distance: int = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        if max_distance > SIMHASH_MAX_SAFE_DISTANCE:
+            logger.warning(f"⚠️ VACANCY_SIMHASH_MAX_DISTANCE={max_distance} слишком велико, "
+                           f"использую {SIMHASH_MAX_SAFE_DISTANCE}")
+        self.max_distance = max(0, min(max_distance, SIMHASH_MAX_SAFE_DISTANCE))
+
+        # digest -> (expires_at, analysis, fingerprint)
+        self._entries: "OrderedDict[str, Tuple[float, str, VacancyFingerprint]]" = OrderedDict()
+        # (номер полосы, значение полосы) -> digest записей
+        self._band_index: Dict[Tuple[int, int], Set[str]] = {}
+
+        self.stats = {'hits_exact': 0, 'hits_near': 0, 'misses': 0, 'stores': 0}
+
+    def _unindex(self, fingerprint: VacancyFingerprint):
+        for band in _bands(fingerprint.simhash):
+            bucket = self._band_index.get(band)
+            if bucket:
+                bucket.discard(fingerprint.digest)
+                if not bucket:
+                    del self._band_index[band]
+
+    def _evict(self, digest: str):
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            self._unindex(entry[2])
+
+    def _find_near(self, fingerprint: VacancyFingerprint) -> Optional[str]:
+        candidates: Set[str] = set()
+        for band in _bands(fingerprint.simhash):
+            candidates.update(self._band_index.get(band, ()))
+
+        best: Optional[Tuple[int, str]] = None
+        for digest in candidates:
+            other = self._entries[digest][2]
+            # Другая должность, грейд или требования - другая вакансия, как бы ни был близок текст
+            if other.key_digest != fingerprint.key_digest:
+                continue
+            distance = hamming_distance(fingerprint.simhash, other.simhash)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, digest)
+        return best[1] if best is not None else None
+
+    def get(self, fingerprint: VacancyFingerprint) -> Optional[str]:
+        """Найти анализ для той же вакансии (или почти-дубликата, если разрешено)"""
+        now = time.time()
+
+        digest = fingerprint.digest if fingerprint.digest in self._entries else None
+        exact = digest is not None
+        if digest is None and self.max_distance > 0:
+            digest = self._find_near(fingerprint)
+
+        if digest is not None:
+            expires_at, analysis, _ = self._entries[digest]
+            if expires_at >= now:
+                self._entries.move_to_end(digest)
+                self.stats['hits_exact' if exact else 'hits_near'] += 1
+                return analysis
+            self._evict(digest)
+
+        self.stats['misses'] += 1
+        return None
+
+    def set(self, fingerprint: VacancyFingerprint, analysis: str):
+        """Сохранить анализ вакансии"""
+        if not analysis:
+            return
+        self._evict(fingerprint.digest)
+        self._entries[fingerprint.digest] = (time.time() + self.ttl_seconds, analysis, fingerprint)
+        for band in _bands(fingerprint.simhash):
+            self._band_index.setdefault(band, set()).add(fingerprint.digest)
+        self.stats['stores'] += 1
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._evict(oldest)
+
+    def get_stats(self) -> dict:
+        """Статистика кэша для мониторинга"""
+        return {**self.stats, 'entries': len(self._entries), 'max_distance': self.max_distance}
+
+
+# Глобальный кэш, общий для всех пользователей
+vacancy_analysis_cache = VacancyAnalysisCache(
+    max_entries=VACANCY_ANALYSIS_CACHE_MAX_ENTRIES,
+    ttl_seconds=VACANCY_ANALYSIS_CACHE_TTL_SECONDS,
+    max_distance=VACANCY_SIMHASH_MAX_DISTANCE
+)
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(
+        f"{VACANCY_ANALYSIS_PROMPT_VERSION}\n{text}".encode('utf-8'), digest_size=16
+    ).hexdigest()
+
+
+def vacancy_fingerprint(vacancy_text: str) -> VacancyFingerprint:
+    """Отпечаток вакансии с учетом версии промпта анализа"""
+    return VacancyFingerprint(
+        digest=_digest(normalize_vacancy(vacancy_text)),
+        simhash=simhash(vacancy_text),
+        key_digest=_digest(vacancy_key_lines(vacancy_text))
+    )
+
+
+async def _analyze_vacancy(
+    vacancy_text: str,
+    ai_service=None,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    request_type: str = "vacancy_analysis"
+) -> Tuple[Optional[str], int]:
+    """Анализ вакансии и оценка потраченных на него токенов (0 - взят из кэша)"""
+    fingerprint = vacancy_fingerprint(vacancy_text)
+    cached = vacancy_analysis_cache.get(fingerprint)
+    if cached:
+        logger.info(f"💾 Анализ вакансии взят из общего кэша (digest={fingerprint.digest})")
+        return cached, 0
+
+    if ai_service is None:
+        from services.ai_factory import get_ai_service
+        ai_service = get_ai_service()
+
+    prompt = build_vacancy_analysis_prompt(vacancy_text)
+    response = await ai_service.get_completion(
+        prompt=prompt,
+        temperature=0.3,
+        max_tokens=VACANCY_ANALYSIS_MAX_TOKENS,
+        user_id=user_id,
+        session_id=session_id,
+        request_type=request_type
+    )
+    spent = estimate_tokens(prompt) + estimate_tokens(response or '')
+    if not response or not response.strip():
+        return None, spent
+
+    analysis = response.strip()
+    vacancy_analysis_cache.set(fingerprint, analysis)
+    logger.info(f"🔍 Анализ вакансии выполнен и сохранен в кэш ({len(analysis)} символов)")
+    return analysis, spent
+
+
+async def get_vacancy_analysis(
+    vacancy_text: str,
+    ai_service=None,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    request_type: str = "vacancy_analysis"
+) -> Optional[str]:
+    """
+    Возвращает анализ вакансии: из общего кэша или через отдельный запрос к AI
+
+    Returns:
+        Текст анализа или None, если AI не ответил
+    """
+    analysis, _ = await _analyze_vacancy(
+        vacancy_text, ai_service=ai_service, user_id=user_id, session_id=session_id, request_type=request_type
+    )
+    return analysis
+
+
+# === СПЕКУЛЯТИВНЫЙ АНАЛИЗ (пока пользователь вставляет резюме) ===
+
+class TokenBudget:
+    """
+    Бюджет токенов в скользящем окне для фоновых запросов
+
+    Спекулятивный анализ может оказаться ненужным (пользователь не пришлет резюме),
+    поэтому он расходует отдельный бюджет и не запускается, если бюджет исчерпан.
+    Перед запросом резервируется оценка (промпт + max_tokens), после ответа резерв
+    исправляется по фактическому расходу (settle), как в rate_governor.
+    """
+
+    def __init__(self, tokens_per_window: int, window_seconds: int = 3600):
+        self.tokens_per_window = tokens_per_window
+        self.window_seconds = window_seconds
+        # [время резерва, токены] - токены исправляет settle
+        self._reservations: Deque[List] = deque()
+
+    def _used(self, now: float) -> int:
+        while self._reservations and self._reservations[0][0] <= now - self.window_seconds:
+            self._reservations.popleft()
+        return sum(tokens for _, tokens in self._reservations)
+
+    def try_reserve(self, tokens: int) -> Optional[List]:
+        """Зарезервировать токены; None если бюджет окна исчерпан"""
+        now = time.time()
+        if self._used(now) + tokens > self.tokens_per_window:
+            return None
+        reservation = [now, tokens]
+        self._reservations.append(reservation)
+        return reservation
+
+    def settle(self, reservation: List, used_tokens: int):
+        """Заменить оценку резерва фактическим расходом"""
+        reservation[1] = max(0, used_tokens)
+
+    def get_stats(self) -> dict:
+        used = self._used(time.time())
+        return {'used': used, 'limit': self.tokens_per_window, 'window_seconds': self.window_seconds}
+
+
+speculative_budget = TokenBudget(SPECULATIVE_ANALYSIS_TOKEN_BUDGET)
+
+
+def start_speculative_analysis(
+    vacancy_text: str,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None
+) -> Optional[asyncio.Task]:
+    """
+    Запускает анализ вакансии в фоне, пока пользователь готовит резюме
+
+    Returns:
+        Задача с результатом get_vacancy_analysis или None, если спекуляция
+        выключена, анализ уже есть в кэше или исчерпан бюджет
+    """
+    # Без отдельного этапа анализа prepare_letter_prompt анализ не использует
+    if not SPECULATIVE_ANALYSIS_ENABLED or not VACANCY_ANALYSIS_STAGE_ENABLED:
+        return None
+
+    if vacancy_analysis_cache.get(vacancy_fingerprint(vacancy_text)):
+        return None
+
+    estimated = estimate_tokens(build_vacancy_analysis_prompt(vacancy_text)) + VACANCY_ANALYSIS_MAX_TOKENS
+    reservation = speculative_budget.try_reserve(estimated)
+    if reservation is None:
+        logger.info(f"💸 Бюджет спекулятивного анализа исчерпан, пропускаю (user_id={user_id})")
+        return None
+
+    logger.info(f"🔮 Запускаю спекулятивный анализ вакансии (user_id={user_id}, ~{estimated} токенов)")
+    # Контекст копируется в задачу: планировщик учитывает пользователя в честной очереди
+    with ai_request_context(user_id):
+        return asyncio.create_task(
+            _speculative_analysis(vacancy_text, reservation, user_id=user_id, session_id=session_id)
+        )
+
+
+async def _speculative_analysis(
+    vacancy_text: str,
+    reservation: List,
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None
+) -> Optional[str]:
+    """Спекулятивный анализ с исправлением резерва бюджета по фактическому расходу"""
+    spent = None
+    try:
+        analysis, spent = await _analyze_vacancy(
+            vacancy_text,
+            user_id=user_id,
+            session_id=session_id,
+            request_type="vacancy_analysis_speculative"
+        )
+        return analysis
+    finally:
+        if spent is None:
+            # Отмененный или упавший запрос мог успеть потратить токены промпта
+            spent = estimate_tokens(build_vacancy_analysis_prompt(vacancy_text))
+        speculative_budget.settle(reservation, spent)
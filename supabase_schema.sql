@@ -120,9 +120,19 @@ CREATE TABLE IF NOT EXISTS openai_requests (
     response_time_ms INTEGER NOT NULL,
     success BOOLEAN DEFAULT TRUE,
     error_message TEXT,
+    provider VARCHAR(20),
+    attempt INTEGER DEFAULT 1,
+    cost_usd NUMERIC(12, 6),
+    tokens_estimated BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Учет токенов и стоимости для уже созданных таблиц
+ALTER TABLE openai_requests ADD COLUMN IF NOT EXISTS provider VARCHAR(20);
+ALTER TABLE openai_requests ADD COLUMN IF NOT EXISTS attempt INTEGER DEFAULT 1;
+ALTER TABLE openai_requests ADD COLUMN IF NOT EXISTS cost_usd NUMERIC(12, 6);
+ALTER TABLE openai_requests ADD COLUMN IF NOT EXISTS tokens_estimated BOOLEAN DEFAULT FALSE;
+
 -- Индексы для openai_requests
 CREATE INDEX idx_openai_model ON openai_requests(model);
 CREATE INDEX idx_openai_type ON openai_requests(request_type);
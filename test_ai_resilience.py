@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Тесты устойчивости AI-запросов: circuit breaker, квоты rate governor, адаптивные таймауты и таймауты потоков
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.adaptive_limits import TIMEOUT_MAX_GROWTH, AdaptiveLimits, adaptive_limits
+from services.ai_hedging import _guarded_call
+from services.ai_service import iterate_with_idle_timeout
+from services.claude_service import ClaudeService
+from services.circuit_breaker import circuit_breakers
+from services.rate_governor import RateGovernor, RateLimitWaitError
+
+
+def spy_breaker(model: str):
+    breaker = circuit_breakers.get(model)
+    outcomes = []
+    breaker.record_success = lambda latency: outcomes.append(('success', latency))
+    breaker.record_failure = lambda: outcomes.append(('failure', None))
+    breaker.record_cancelled = lambda: outcomes.append(('cancelled', None))
+    return outcomes
+
+
+def test_quota_wait_is_not_counted_as_model_latency():
+    outcomes = spy_breaker('test-quota-wait')
+    governor = RateGovernor(enabled=True, default_rpm=1000, default_tpm=1000000)
+
+    async def call(model):
+        # Ожидание квоты, затем быстрый ответ модели
+        await asyncio.sleep(0.3)
+        async with governor.reserve('key', model, 10) as reservation:
+            reservation.used_tokens = 10
+            return 'ok'
+
+    assert asyncio.run(_guarded_call('test-quota-wait', call)) == 'ok'
+    [(outcome, latency)] = outcomes
+    assert outcome == 'success'
+    assert latency < 0.2
+
+
+def test_rate_limit_wait_is_not_a_model_failure():
+    outcomes = spy_breaker('test-quota-timeout')
+
+    async def call(model):
+        raise RateLimitWaitError("quota wait exceeded")
+
+    with pytest.raises(RateLimitWaitError):
+        asyncio.run(_guarded_call('test-quota-timeout', call))
+    assert outcomes == [('cancelled', None)]
+
+
+def test_model_error_is_recorded_as_failure():
+    outcomes = spy_breaker('test-model-error')
+
+    async def call(model):
+        raise RuntimeError("500")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(_guarded_call('test-model-error', call))
+    assert outcomes == [('failure', None)]
+
+
+def test_repeated_timeouts_do_not_compound():
+    limits = AdaptiveLimits(min_timeout=1, max_timeout=1000)
+    default = 30.0
+    for _ in range(200):
+        limits.record_timeout('letter', 'model', limits.timeout('letter', 'model', default))
+
+    assert limits.timeout('letter', 'model', default) <= default * TIMEOUT_MAX_GROWTH
+
+
+def test_timeout_learns_from_fast_responses():
+    limits = AdaptiveLimits(min_timeout=1, max_timeout=1000)
+    for _ in range(50):
+        limits.record('letter', 'model', 500, 4.0)
+
+    assert limits.timeout('letter', 'model', 30.0) == pytest.approx(4.0 * limits.timeout_headroom)
+
+
+async def _chunks(first_delay: float, delays):
+    await asyncio.sleep(first_delay)
+    yield 'first'
+    for delay in delays:
+        await asyncio.sleep(delay)
+        yield 'next'
+
+
+def test_first_chunk_waits_for_attempt_timeout_not_idle_timeout():
+    async def scenario():
+        return [item async for item in iterate_with_idle_timeout(_chunks(0.2, [0.01]), 0.1, first_timeout=1)]
+
+    assert asyncio.run(scenario()) == ['first', 'next']
+
+
+def test_gap_between_chunks_is_limited_by_idle_timeout():
+    async def scenario():
+        return [item async for item in iterate_with_idle_timeout(_chunks(0, [0.3]), 0.1, first_timeout=1)]
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scenario())
+
+
+class _HangingStream:
+    async def __aenter__(self):
+        await asyncio.sleep(10)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def test_claude_stream_open_is_limited_by_adaptive_timeout(monkeypatch):
+    service = ClaudeService.__new__(ClaudeService)
+    service.client = SimpleNamespace(messages=SimpleNamespace(stream=lambda **kwargs: _HangingStream()))
+    monkeypatch.setattr(adaptive_limits, 'timeout', lambda request_type, model, default: 0.1)
+
+    async def scenario():
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in service._stream_model('test-stream-open', 'prompt', 0.7, 100, None, None, 'letter'):
+                pass
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1
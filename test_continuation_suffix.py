@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Тесты склейки ответа, обрезанного по max_tokens, с его продолжением
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.ai_service import continuation_suffix
+
+
+def test_space_after_punctuation_is_inserted_once():
+    assert continuation_suffix("Опыт - пять лет.", "Готов обсудить") == " Готов обсудить"
+    # Клиент уже получил пробел в конце потока - продолжение Claude (префилл без пробела) его не дублирует
+    assert continuation_suffix("Опыт - пять лет. ", "Готов обсудить") == "Готов обсудить"
+    assert continuation_suffix("Опыт - пять лет. ", " Готов обсудить") == "Готов обсудить"
+
+
+def test_paragraph_break_is_kept():
+    assert continuation_suffix("Опыт - пять лет.\n", "\nС уважением") == "\nС уважением"
+
+
+def test_repeated_ending_is_dropped_even_after_trailing_space():
+    head = "Работал с PostgreSQL и Redis в высоконагруженных сервисах. "
+    tail = "Redis в высоконагруженных сервисах. Готов обсудить детали."
+    assert head + continuation_suffix(head, tail) == head + "Готов обсудить детали."
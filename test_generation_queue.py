@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Тесты очереди генераций: повторы, отмена, восстановление после перезапуска
+"""
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.generation_queue import GenerationQueue, RetryJob
+
+
+def make_queue(tmp_path, **kwargs) -> GenerationQueue:
+    params = dict(workers=4, max_attempts=3, retry_base=0.05, retry_max=0.1)
+    params.update(kwargs)
+    return GenerationQueue(str(tmp_path / 'queue.db'), **params)
+
+
+async def wait_until(predicate, timeout: float = 3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "condition not reached"
+        await asyncio.sleep(0.02)
+
+
+def test_completed_job_is_removed(tmp_path):
+    async def scenario():
+        queue = make_queue(tmp_path)
+        handled = []
+
+        async def handler(job):
+            handled.append(job.payload['n'])
+
+        queue.register('letter', handler)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {'n': 1})
+        await wait_until(lambda: queue.stats['completed'] == 1)
+        stats = await queue.get_stats()
+        await queue.stop(1)
+        return handled, stats
+
+    handled, stats = asyncio.run(scenario())
+    assert handled == [1]
+    assert stats['queued'] == 0
+
+
+def test_retry_keeps_payload_and_then_completes(tmp_path):
+    async def scenario():
+        queue = make_queue(tmp_path)
+        attempts = []
+
+        async def handler(job):
+            attempts.append((job.attempts, dict(job.payload)))
+            if job.attempts == 1:
+                job.payload['session_id'] = 'created-on-first-attempt'
+                raise RetryJob("AI error")
+
+        queue.register('letter', handler)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {'n': 1})
+        await wait_until(lambda: queue.stats['completed'] == 1)
+        await queue.stop(1)
+        return attempts, queue.stats
+
+    attempts, stats = asyncio.run(scenario())
+    assert [attempt for attempt, _ in attempts] == [1, 2]
+    # Payload, измененный первой попыткой, сохраняется для повтора
+    assert attempts[1][1]['session_id'] == 'created-on-first-attempt'
+    assert stats['retried'] == 1
+    assert stats['failed'] == 0
+
+
+def test_exhausted_retries_call_on_failure(tmp_path):
+    async def scenario():
+        queue = make_queue(tmp_path, max_attempts=2)
+        failed = []
+
+        async def handler(job):
+            raise RetryJob("still failing")
+
+        async def on_failure(job):
+            failed.append(job.attempts)
+
+        queue.register('letter', handler, on_failure=on_failure)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {})
+        await wait_until(lambda: queue.stats['failed'] == 1)
+        stats = await queue.get_stats()
+        await queue.stop(1)
+        return failed, stats
+
+    failed, stats = asyncio.run(scenario())
+    assert failed == [2]
+    assert stats['queued'] == 0
+
+
+def test_cancel_user_releases_queued_job(tmp_path):
+    """Задача, ждущая повтора, удаляется по /cancel и возвращает резерв через on_cancel"""
+    async def scenario():
+        queue = make_queue(tmp_path, retry_base=30, retry_max=30)
+        released = []
+
+        async def handler(job):
+            raise RetryJob("bulk: 2 letters failed")
+
+        async def on_cancel(job):
+            released.append(job.payload['reserved'])
+
+        queue.register('bulk', handler, on_cancel=on_cancel)
+        await queue.start()
+        await queue.enqueue('bulk', 7, 7, {'reserved': 2})
+        await wait_until(lambda: queue.stats['retried'] == 1)
+        await queue.cancel_user(7)
+        stats = await queue.get_stats()
+        await queue.stop(1)
+        return released, stats
+
+    released, stats = asyncio.run(scenario())
+    assert released == [2]
+    assert stats['queued'] == 0
+    assert stats['cancelled'] == 1
+
+
+def test_cancel_user_interrupts_running_job(tmp_path):
+    async def scenario():
+        queue = make_queue(tmp_path)
+        started = asyncio.Event()
+        failed = []
+
+        async def handler(job):
+            started.set()
+            await asyncio.sleep(10)
+
+        async def on_failure(job):
+            failed.append(job.id)
+
+        queue.register('letter', handler, on_failure=on_failure)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {})
+        await asyncio.wait_for(started.wait(), 3)
+        await queue.cancel_user(1)
+        await wait_until(lambda: queue.stats['cancelled'] == 1)
+        stats = await queue.get_stats()
+        await queue.stop(1)
+        return failed, stats
+
+    failed, stats = asyncio.run(scenario())
+    assert failed == []
+    assert stats['queued'] == 0
+    assert stats['running'] == 0
+
+
+def test_jobs_of_one_user_do_not_supersede_each_other(tmp_path):
+    """Вторая задача пользователя ждет первую, а не отменяет ее"""
+    async def scenario():
+        queue = make_queue(tmp_path)
+        events = []
+
+        async def handler(job):
+            events.append(('start', job.payload['n']))
+            await asyncio.sleep(0.1)
+            events.append(('end', job.payload['n']))
+
+        queue.register('letter', handler)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {'n': 1})
+        await queue.enqueue('letter', 1, 1, {'n': 2})
+        await queue.enqueue('letter', 2, 2, {'n': 3})
+        await wait_until(lambda: queue.stats['completed'] == 3)
+        await queue.stop(1)
+        return events, queue.stats
+
+    events, stats = asyncio.run(scenario())
+    assert stats['cancelled'] == 0
+    assert events.index(('end', 1)) < events.index(('start', 2))
+    # Задачи разных пользователей идут параллельно
+    assert events.index(('start', 3)) < events.index(('end', 1))
+
+
+def test_running_job_is_recovered_after_restart(tmp_path):
+    async def first_process():
+        queue = make_queue(tmp_path)
+        await queue.start()
+        await queue.stop(1)
+        # Воркеров нет: задачу "берем" вручную и процесс "падает" во время выполнения
+        await queue.enqueue('letter', 1, 1, {'n': 1})
+        row = queue._sqlite_claim()
+        assert row is not None
+
+    async def second_process():
+        queue = make_queue(tmp_path)
+        handled = []
+
+        async def handler(job):
+            handled.append(job.attempts)
+
+        queue.register('letter', handler)
+        await queue.start()
+        await wait_until(lambda: queue.stats['completed'] == 1)
+        await queue.stop(1)
+        return handled, queue.stats
+
+    asyncio.run(first_process())
+    handled, stats = asyncio.run(second_process())
+    assert stats['recovered'] == 1
+    assert handled == [2]
+
+
+def test_stop_returns_unfinished_job_to_queue(tmp_path):
+    async def scenario():
+        queue = make_queue(tmp_path)
+        started = asyncio.Event()
+
+        async def handler(job):
+            started.set()
+            await asyncio.sleep(10)
+
+        queue.register('letter', handler)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {})
+        await asyncio.wait_for(started.wait(), 3)
+        await queue.stop(0.05)
+        return queue._sqlite_count()
+
+    counts = asyncio.run(scenario())
+    assert counts == {'queued': 1}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Тест доставки письма, генерация которого прервана остановкой бота (редеплой)
+"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram.error import BadRequest
+
+import handlers.simple_conversation_v6 as conversation
+from services.generation_queue import GenerationQueue
+
+LETTER = (
+    "Здравствуйте! Меня заинтересовала позиция Python-разработчика: мой опыт в backend - пять лет.\n"
+    "С уважением, Иван"
+)
+
+
+class FakeBot:
+    """Бот, записывающий отправленные сообщения; сообщение задачи уже удалено"""
+
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.deleted.append(message_id)
+        raise BadRequest("Message to delete not found")
+
+    async def edit_message_text(self, *args, **kwargs):
+        raise BadRequest("Message to edit not found")
+
+
+def patch_services(monkeypatch, generate):
+    sessions = {'created': 0, 'updates': []}
+
+    async def create_letter_session(session_data):
+        sessions['created'] += 1
+        return 'session-1'
+
+    async def update_letter_session(session_id, updates, flush=False):
+        sessions['updates'].append(dict(updates))
+        return True
+
+    async def check_user_limits(user_id, force_refresh=False):
+        return {'can_generate': True, 'plan_type': 'free'}
+
+    async def noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(conversation.analytics, 'create_letter_session', create_letter_session)
+    monkeypatch.setattr(conversation.analytics, 'update_letter_session', update_letter_session)
+    monkeypatch.setattr(conversation.subscription_service, 'check_user_limits', check_user_limits)
+    monkeypatch.setattr(conversation.subscription_service, 'increment_usage', noop)
+    monkeypatch.setattr(conversation.feedback_service, 'get_session_iteration_status', noop)
+    monkeypatch.setattr(conversation.AIFactory, 'is_available', staticmethod(lambda: True))
+    monkeypatch.setattr(conversation, '_generate_letter_with_preview', generate)
+    return sessions
+
+
+def make_queue(tmp_path, bot) -> GenerationQueue:
+    queue = GenerationQueue(str(tmp_path / 'queue.db'), workers=2, max_attempts=3, retry_base=0.05, retry_max=0.1)
+
+    async def handler(job):
+        await conversation._run_letter_job(SimpleNamespace(bot=bot, user_data=None), job)
+
+    queue.register('letter', handler)
+    return queue
+
+
+def test_letter_interrupted_by_shutdown_is_delivered_after_restart(tmp_path, monkeypatch):
+    async def first_process():
+        bot = FakeBot()
+        generation_started = asyncio.Event()
+
+        async def slow_generate(*args, **kwargs):
+            generation_started.set()
+            await asyncio.sleep(10)
+
+        sessions = patch_services(monkeypatch, slow_generate)
+        queue = make_queue(tmp_path, bot)
+        await queue.start()
+        await queue.enqueue('letter', 1, 1, {
+            'user_id': 10, 'vacancy_text': 'vacancy', 'resume_text': 'resume',
+            'max_iterations': 2, 'processing_message_id': 42
+        })
+        await asyncio.wait_for(generation_started.wait(), 3)
+        await queue.stop(0.05)
+        return bot, sessions
+
+    async def second_process():
+        bot = FakeBot()
+
+        async def generate(*args, **kwargs):
+            return LETTER
+
+        sessions = patch_services(monkeypatch, generate)
+        queue = make_queue(tmp_path, bot)
+        await queue.start()
+        deadline = asyncio.get_running_loop().time() + 3
+        while queue.stats['completed'] < 1:
+            assert asyncio.get_running_loop().time() < deadline, "letter not delivered"
+            await asyncio.sleep(0.02)
+        await queue.stop(1)
+        return bot, sessions, queue.stats
+
+    bot, sessions = asyncio.run(first_process())
+    # Остановка бота - не отмена: сессия и сообщение "пишу письмо..." не тронуты
+    assert {'status': 'cancelled'} not in sessions['updates']
+    assert bot.deleted == [] and bot.sent == []
+
+    bot, sessions, stats = asyncio.run(second_process())
+    assert stats['completed'] == 1
+    # Сессия создана первой попыткой и сохранена в payload задачи
+    assert sessions['created'] == 0
+    assert any(LETTER in text for text in bot.sent)
+    assert sessions['updates'][-1]['status'] == 'completed'
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Тесты отложенной записи сессий писем (SessionWriteBehind)
+"""
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.session_writes import SessionWriteBehind
+
+
+def make_buffer(delay: float = 30.0, **kwargs):
+    buffer = SessionWriteBehind(delay=delay, **kwargs)
+    patches = []
+
+    async def writer(session_id, fields):
+        patches.append((session_id, dict(fields)))
+        return True
+
+    buffer.set_writer(writer)
+    return buffer, patches
+
+
+def test_updates_are_coalesced_into_one_patch_on_milestone():
+    async def scenario():
+        buffer, patches = make_buffer()
+        await buffer.update('s1', {'resume_text': 'resume'})
+        await buffer.update('s1', {'generated_letter': 'letter'})
+        assert patches == []
+        await buffer.update('s1', {'status': 'completed'})
+        return buffer, patches
+
+    buffer, patches = asyncio.run(scenario())
+    assert patches == [('s1', {'resume_text': 'resume', 'generated_letter': 'letter', 'status': 'completed'})]
+    assert buffer.stats['coalesced'] == 2
+    assert buffer.get_stats()['pending_sessions'] == 0
+
+
+def test_pending_changes_are_written_after_delay():
+    async def scenario():
+        buffer, patches = make_buffer(delay=0.05)
+        await buffer.update('s1', {'current_iteration': 2})
+        await asyncio.sleep(0.2)
+        return patches
+
+    assert asyncio.run(scenario()) == [('s1', {'current_iteration': 2})]
+
+
+def test_overlay_and_known_state_serve_unwritten_fields():
+    async def scenario():
+        buffer, _ = make_buffer()
+        buffer.remember('s1', {'current_iteration': 1, 'max_iterations': 3, 'resume_text': 'ignored'})
+        await buffer.update('s1', {'current_iteration': 2})
+        # Чтение из БД со старым значением не затирает незаписанное
+        buffer.remember('s1', {'current_iteration': 1}, from_db=True)
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert buffer.get_state('s1') == {'current_iteration': 2, 'max_iterations': 3}
+    assert buffer.overlay('s1', {'id': 's1', 'current_iteration': 1}) == {'id': 's1', 'current_iteration': 2}
+
+
+def test_stop_flushes_everything_and_disables_buffering():
+    async def scenario():
+        buffer, patches = make_buffer()
+        await buffer.update('s1', {'current_iteration': 2})
+        await buffer.update('s2', {'has_feedback': True})
+        await buffer.stop()
+        buffered = await buffer.update('s3', {'current_iteration': 1})
+        return patches, buffered
+
+    patches, buffered = asyncio.run(scenario())
+    assert sorted(patches) == [('s1', {'current_iteration': 2}), ('s2', {'has_feedback': True})]
+    # После остановки вызывающий код пишет изменения напрямую
+    assert buffered is False
+
+
+def test_failed_write_is_counted():
+    async def scenario():
+        buffer = SessionWriteBehind(delay=30)
+
+        async def writer(session_id, fields):
+            raise RuntimeError("db down")
+
+        buffer.set_writer(writer)
+        await buffer.update('s1', {'status': 'failed'})
+        return buffer
+
+    assert asyncio.run(scenario()).stats['failures'] == 1
+
+
+def test_known_state_is_bounded():
+    buffer, _ = make_buffer(max_sessions=2)
+    for session_id in ('s1', 's2', 's3'):
+        buffer.remember(session_id, {'current_iteration': 1})
+
+    assert buffer.get_state('s1') is None
+    assert buffer.get_stats()['known_sessions'] == 2
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Тесты резерва писем пакетной генерации (reserve_letters / release_letters)
+"""
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.subscription_service import SubscriptionService
+from utils.async_postgrest import APIResponse, PostgrestError
+
+
+class FakeRPC:
+    def __init__(self, client, name, params):
+        self.client, self.name, self.params = client, name, params
+
+    async def execute(self):
+        self.client.calls.append((self.name, self.params))
+        result = self.client.results[self.name]
+        if isinstance(result, Exception):
+            raise result
+        return APIResponse(data=result)
+
+
+class FakeSupabase:
+    """Асинхронный клиент Supabase, отвечающий заданными результатами rpc"""
+
+    def __init__(self, **results):
+        self.results = results
+        self.calls = []
+
+    def rpc(self, name, params=None):
+        return FakeRPC(self, name, params or {})
+
+
+def make_service(supabase, can_generate: bool = True) -> SubscriptionService:
+    service = SubscriptionService()
+    service.supabase = supabase
+    service.enabled = True
+
+    async def check_user_limits(user_id, force_refresh=False):
+        return {'can_generate': can_generate, 'letters_used': 1, 'remaining': 2 if can_generate else 0}
+
+    service.check_user_limits = check_user_limits
+    return service
+
+
+def test_reserve_returns_granted_from_atomic_rpc():
+    supabase = FakeSupabase(reserve_user_letters=[{'granted': 2, 'new_count': 3}])
+    service = make_service(supabase)
+
+    assert asyncio.run(service.reserve_letters(5, 4)) == 2
+    assert supabase.calls == [('reserve_user_letters', {'user_id_param': 5, 'count_param': 4})]
+
+
+def test_reserve_returns_zero_when_write_fails():
+    """Несписанный резерв нельзя потом вернуть в лимит"""
+    supabase = FakeSupabase(reserve_user_letters=PostgrestError(503, {'message': 'unavailable'}))
+    service = make_service(supabase)
+
+    assert asyncio.run(service.reserve_letters(5, 3)) == 0
+
+
+def test_reserve_returns_zero_on_empty_response():
+    service = make_service(FakeSupabase(reserve_user_letters=[]))
+
+    assert asyncio.run(service.reserve_letters(5, 3)) == 0
+
+
+def test_reserve_skips_rpc_when_limit_exhausted():
+    supabase = FakeSupabase(reserve_user_letters=[{'granted': 1, 'new_count': 3}])
+    service = make_service(supabase, can_generate=False)
+
+    assert asyncio.run(service.reserve_letters(5, 3)) == 0
+    assert supabase.calls == []
+
+
+def test_release_uses_atomic_rpc():
+    supabase = FakeSupabase(release_user_letters=[{'new_count': 1}])
+    service = make_service(supabase)
+
+    assert asyncio.run(service.release_letters(5, 2)) is True
+    assert supabase.calls == [('release_user_letters', {'user_id_param': 5, 'count_param': 2})]
+
+
+def test_release_reports_failure():
+    service = make_service(FakeSupabase(release_user_letters=PostgrestError(500, {'message': 'boom'})))
+
+    assert asyncio.run(service.release_letters(5, 2)) is False
+
+
+def test_release_of_nothing_is_noop():
+    supabase = FakeSupabase()
+    service = make_service(supabase)
+
+    assert asyncio.run(service.release_letters(5, 0)) is True
+    assert supabase.calls == []
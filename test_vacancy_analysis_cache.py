@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Тесты общего кэша анализов вакансий и бюджета спекулятивного анализа
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from services.vacancy_analysis import (
+    SIMHASH_MAX_SAFE_DISTANCE,
+    TokenBudget,
+    VacancyAnalysisCache,
+    hamming_distance,
+    vacancy_fingerprint
+)
+
+BODY = """
+Мы ищем разработчика в продуктовую команду.
+Требования: опыт коммерческой разработки от 3 лет, знание SQL, Docker.
+Условия: удаленная работа, ДМС, гибкий график.
+Задачи: развитие платформы, code review, менторинг."""
+
+ABOUT = """
+О компании: мы строим сервис онлайн-бронирования для сети клиник по всей стране.
+Команда из двенадцати человек, релизы каждую неделю, собственный дизайн-отдел.
+Офис в центре Москвы рядом с метро, можно приходить с собакой.
+Компенсируем обучение, конференции и покупку книг.
+Корпоративный английский два раза в неделю.
+Большой парк тестовых устройств и быстрые ноутбуки."""
+
+
+def test_exact_copy_hits_despite_formatting_and_tracking_links():
+    cache = VacancyAnalysisCache()
+    cache.set(vacancy_fingerprint("Senior Python-разработчик" + BODY), "analysis")
+
+    copy = "SENIOR   python-разработчик" + BODY.replace('\n', '\n\n') + "\nhttps://hh.ru/vacancy/1?utm_source=tg"
+    assert cache.get(vacancy_fingerprint(copy)) == "analysis"
+    assert cache.stats['hits_exact'] == 1
+
+
+def test_exact_mode_does_not_reuse_across_words():
+    cache = VacancyAnalysisCache()
+    cache.set(vacancy_fingerprint("Senior Python-разработчик" + BODY), "analysis")
+
+    assert cache.get(vacancy_fingerprint("Senior Python-разработчик" + BODY.replace('ДМС', 'ДМС, спорт'))) is None
+
+
+def test_role_or_grade_change_is_never_a_near_duplicate():
+    """Смена должности или грейда - другая вакансия, даже если SimHash почти совпадает"""
+    cache = VacancyAnalysisCache(max_distance=SIMHASH_MAX_SAFE_DISTANCE)
+    original = vacancy_fingerprint("Senior Python-разработчик" + BODY)
+    cache.set(original, "analysis")
+
+    for title in ("Junior Python-разработчик", "Senior Go-разработчик", "Junior Java"):
+        assert cache.get(vacancy_fingerprint(title + BODY)) is None, title
+    for requirements in ("опыт коммерческой разработки от 1 года", "опыт коммерческой разработки от 6 лет"):
+        changed = BODY.replace("опыт коммерческой разработки от 3 лет", requirements)
+        assert cache.get(vacancy_fingerprint("Senior Python-разработчик" + changed)) is None, requirements
+
+
+def test_near_duplicate_with_same_title_and_requirements_hits_when_enabled():
+    text = "Senior Python-разработчик" + BODY + ABOUT
+    original = vacancy_fingerprint(text)
+    edited = vacancy_fingerprint(text.replace("два раза", "три раза"))
+    assert original.key_digest == edited.key_digest
+    assert hamming_distance(original.simhash, edited.simhash) <= SIMHASH_MAX_SAFE_DISTANCE
+
+    exact_only = VacancyAnalysisCache()
+    exact_only.set(original, "analysis")
+    assert exact_only.get(edited) is None
+
+    near = VacancyAnalysisCache(max_distance=SIMHASH_MAX_SAFE_DISTANCE)
+    near.set(original, "analysis")
+    assert near.get(edited) == "analysis"
+
+
+def test_near_duplicate_threshold_is_capped():
+    assert VacancyAnalysisCache(max_distance=10).max_distance == SIMHASH_MAX_SAFE_DISTANCE
+
+
+def test_token_budget_settles_reservation_to_actual_usage():
+    budget = TokenBudget(tokens_per_window=1000)
+    reservation = budget.try_reserve(800)
+    assert reservation is not None
+    assert budget.try_reserve(300) is None
+
+    budget.settle(reservation, 250)
+    assert budget.get_stats()['used'] == 250
+    assert budget.try_reserve(300) is not None
@@ -0,0 +1,293 @@
+"""
+Асинхронный клиент Supabase (PostgREST) на httpx
+
+Синхронный supabase-py блокировал event loop: сервисы вызывали .execute() прямо
+внутри корутин или гоняли каждый запрос через пул потоков. Этот клиент говорит
+с PostgREST напрямую через пул соединений httpx (keep-alive, HTTP/2 при наличии h2),
+с таймаутами и повторами, и повторяет API supabase-py, которым пользуются сервисы:
+
+    response = await client.table('users').select('id').eq('telegram_user_id', 1).execute()
+    response.data  # список строк
+
+Повторы: безопасные запросы (чтение, update/delete по фильтру, upsert) повторяются
+при сетевых ошибках и ответах 429/502/503/504; insert и rpc - только если запрос
+не ушел на сервер (ошибка соединения), чтобы не записать строку дважды.
+"""
+import asyncio
+import logging
+import random
+import weakref
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    httpx = None
+    HTTPX_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401 - нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+class PostgrestError(Exception):
+    """Ошибка PostgREST (код PostgreSQL в тексте, как у supabase-py)"""
+
+    def __init__(self, status: int, body: Any):
+        self.status = status
+        body = body if isinstance(body, dict) else {'message': str(body)}
+        self.code = body.get('code')
+        self.message = body.get('message')
+        self.details = body.get('details')
+        self.hint = body.get('hint')
+        super().__init__(str({'code': self.code, 'message': self.message, 'details': self.details,
+                              'hint': self.hint, 'status': status}))
+
+
+@dataclass
+class APIResponse:
+    """Результат запроса: строки и (для select(count='exact')) общее количество"""
+    data: Any
+    count: Optional[int] = None
+
+
+def _format_value(value: Any) -> str:
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+class QueryBuilder:
+    """Запрос к таблице в стиле supabase-py: table(...).select(...).eq(...).execute()"""
+
+    def __init__(self, client: "AsyncPostgrestClient", table: str):
+        self._client = client
+        self._table = table
+        self._method = 'GET'
+        self._params: List[Tuple[str, str]] = []
+        self._json: Any = None
+        self._prefer: List[str] = []
+        self._idempotent = True
+
+    # === ОПЕРАЦИИ ===
+
+    def select(self, columns: str = '*', count: Optional[str] = None) -> "QueryBuilder":
+        self._method = 'GET'
+        self._params.append(('select', ''.join(columns.split())))
+        if count:
+            self._prefer.append(f'count={count}')
+        return self
+
+    def insert(self, rows: Any, returning: str = 'representation') -> "QueryBuilder":
+        self._method = 'POST'
+        self._json = rows
+        self._prefer.append(f'return={returning}')
+        self._idempotent = False
+        return self
+
+    def upsert(self, rows: Any, on_conflict: Optional[str] = None,
+               returning: str = 'representation') -> "QueryBuilder":
+        self._method = 'POST'
+        self._json = rows
+        self._prefer.extend(['resolution=merge-duplicates', f'return={returning}'])
+        if on_conflict:
+            self._params.append(('on_conflict', on_conflict))
+        return self
+
+    def update(self, values: Dict[str, Any], returning: str = 'representation') -> "QueryBuilder":
+        self._method = 'PATCH'
+        self._json = values
+        self._prefer.append(f'return={returning}')
+        return self
+
+    def delete(self, returning: str = 'representation') -> "QueryBuilder":
+        self._method = 'DELETE'
+        self._prefer.append(f'return={returning}')
+        return self
+
+    # === ФИЛЬТРЫ И МОДИФИКАТОРЫ ===
+
+    def _filter(self, column: str, operator: str, value: Any) -> "QueryBuilder":
+        self._params.append((column, f'{operator}.{_format_value(value)}'))
+        return self
+
+    def eq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'eq', value)
+
+    def neq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'neq', value)
+
+    def gt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'gt', value)
+
+    def gte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'gte', value)
+
+    def lt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'lt', value)
+
+    def lte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'lte', value)
+
+    def is_(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, 'is', value)
+
+    def in_(self, column: str, values: List[Any]) -> "QueryBuilder":
+        return self._filter(column, 'in', f"({','.join(_format_value(v) for v in values)})")
+
+    def order(self, column: str, desc: bool = False) -> "QueryBuilder":
+        self._params.append(('order', f"{column}.{'desc' if desc else 'asc'}"))
+        return self
+
+    def limit(self, count: int) -> "QueryBuilder":
+        self._params.append(('limit', str(count)))
+        return self
+
+    async def execute(self) -> APIResponse:
+        headers = {'Prefer': ','.join(self._prefer)} if self._prefer else None
+        return await self._client.request(
+            self._method, self._table, params=self._params, json=self._json,
+            headers=headers, idempotent=self._idempotent
+        )
+
+
+class RPCBuilder:
+    """Вызов SQL функции: rpc('name', {...}).execute()"""
+
+    def __init__(self, client: "AsyncPostgrestClient", function: str, params: Dict[str, Any]):
+        self._client = client
+        self._function = function
+        self._json = params
+
+    async def execute(self) -> APIResponse:
+        # Функция может менять данные - повторяем только неотправленный запрос
+        return await self._client.request('POST', f'rpc/{self._function}', json=self._json, idempotent=False)
+
+
+class AsyncPostgrestClient:
+    """
+    Пул соединений к PostgREST с таймаутами и повторами
+
+    httpx.AsyncClient привязан к event loop, поэтому у каждого loop свой пул:
+    бот и webhook сервер ЮKassa (uvicorn в отдельном потоке) не делят соединения.
+    """
+
+    def __init__(self, url: str, key: str, timeout: float = 10.0, connect_timeout: float = 5.0,
+                 max_connections: int = 20, max_keepalive: int = 10, keepalive_expiry: float = 30.0,
+                 http2: bool = True, max_retries: int = 2, retry_backoff: float = 0.3):
+        self.base_url = f"{url.rstrip('/')}/rest/v1"
+        self.headers = {
+            'apikey': key,
+            'Authorization': f'Bearer {key}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = \
+            weakref.WeakKeyDictionary()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0}
+
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("⚠️ Пакет h2 не установлен - Supabase работает по HTTP/1.1 (pip install 'httpx[http2]')")
+
+    def table(self, name: str) -> QueryBuilder:
+        return QueryBuilder(self, name)
+
+    from_ = table
+
+    def rpc(self, function: str, params: Optional[Dict[str, Any]] = None) -> RPCBuilder:
+        return RPCBuilder(self, function, params or {})
+
+    def _http(self) -> "httpx.AsyncClient":
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                http2=self.http2,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+            self._clients[loop] = client
+        return client
+
+    @staticmethod
+    def _parse(response: "httpx.Response") -> APIResponse:
+        data = response.json() if response.content else []
+        count = None
+        # Content-Range: 0-24/3573 (или */0 для пустой выборки)
+        content_range = response.headers.get('content-range', '')
+        total = content_range.rsplit('/', 1)[-1] if '/' in content_range else ''
+        if total.isdigit():
+            count = int(total)
+        return APIResponse(data=data, count=count)
+
+    async def request(self, method: str, path: str, params: Optional[List[Tuple[str, str]]] = None,
+                      json: Any = None, headers: Optional[Dict[str, str]] = None,
+                      idempotent: bool = True) -> APIResponse:
+        """Выполнить запрос к PostgREST с повторами временных ошибок"""
+        http = self._http()
+        self.stats['requests'] += 1
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await http.request(method, f'/{path}', params=params, json=json, headers=headers)
+            except httpx.TransportError as e:
+                # Ошибка соединения - запрос точно не дошел до сервера, повтор безопасен
+                not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                if last_attempt or not (idempotent or not_sent):
+                    self.stats['failures'] += 1
+                    raise
+                logger.warning(f"🔁 Supabase {method} {path}: {type(e).__name__}, повтор {attempt + 1}/{self.max_retries}")
+            else:
+                if response.status_code < 400:
+                    return self._parse(response)
+                if last_attempt or not idempotent or response.status_code not in RETRYABLE_STATUSES:
+                    self.stats['failures'] += 1
+                    try:
+                        body = response.json()
+                    except ValueError:
+                        body = response.text
+                    raise PostgrestError(response.status_code, body)
+                logger.warning(f"🔁 Supabase {method} {path}: HTTP {response.status_code}, повтор {attempt + 1}/{self.max_retries}")
+
+            self.stats['retries'] += 1
+            delay = self.retry_backoff * (2 ** attempt)
+            await asyncio.sleep(delay * (0.5 + random.random()))
+
+    async def aclose(self):
+        """Закрыть пул соединений текущего event loop"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def get_stats(self) -> dict:
+        """Статистика для мониторинга"""
+        return {**self.stats, 'http2': self.http2, 'pools': len(self._clients)}
@@ -15,12 +15,16 @@ except ImportError as e:
     SUPABASE_AVAILABLE = False
     SupabaseClientType = Any
 
+from utils.async_postgrest import AsyncPostgrestClient, HTTPX_AVAILABLE
+
 logger = logging.getLogger(__name__)
 
 class SupabaseClient:
     """Supabase клиент с улучшенной обработкой ошибок"""
     _instance: Optional[Any] = None
     _failed_init = False
+    _async_instance: Optional[AsyncPostgrestClient] = None
+    _async_failed_init = False
     
     @classmethod
     def get_client(cls) -> Optional[Any]:
@@ -96,12 +100,61 @@ class SupabaseClient:
                 
         return cls._instance
     
+    @classmethod
+    def get_async_client(cls) -> Optional[AsyncPostgrestClient]:
+        """
+        Асинхронный клиент PostgREST (синглтон) - для всех запросов из корутин
+        
+        Синхронный get_client блокирует event loop и остается только для скриптов.
+        """
+        if cls._async_instance is None and not cls._async_failed_init:
+            from config import (
+                SUPABASE_URL, SUPABASE_SERVICE_KEY, ANALYTICS_ENABLED,
+                SUPABASE_HTTP_TIMEOUT, SUPABASE_CONNECT_TIMEOUT, SUPABASE_MAX_CONNECTIONS,
+                SUPABASE_MAX_KEEPALIVE, SUPABASE_KEEPALIVE_EXPIRY, SUPABASE_HTTP2,
+                SUPABASE_MAX_RETRIES, SUPABASE_RETRY_BACKOFF
+            )
+            if not HTTPX_AVAILABLE:
+                logger.warning("httpx not available - Supabase disabled")
+                cls._async_failed_init = True
+                return None
+            if not ANALYTICS_ENABLED:
+                logger.warning("⚠️ Analytics disabled by ANALYTICS_ENABLED=false")
+                cls._async_failed_init = True
+                return None
+            if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+                logger.error("❌ Supabase credentials missing!")
+                cls._async_failed_init = True
+                return None
+            
+            # 🔑 ИСПОЛЬЗУЕМ SERVICE KEY для записи в аналитику!
+            cls._async_instance = AsyncPostgrestClient(
+                url=SUPABASE_URL,
+                key=SUPABASE_SERVICE_KEY,
+                timeout=SUPABASE_HTTP_TIMEOUT,
+                connect_timeout=SUPABASE_CONNECT_TIMEOUT,
+                max_connections=SUPABASE_MAX_CONNECTIONS,
+                max_keepalive=SUPABASE_MAX_KEEPALIVE,
+                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+                http2=SUPABASE_HTTP2,
+                max_retries=SUPABASE_MAX_RETRIES,
+                retry_backoff=SUPABASE_RETRY_BACKOFF
+            )
+            logger.info(f"✅ Async Supabase client initialized (HTTP/2: {cls._async_instance.http2})")
+        return cls._async_instance
+    
+    @classmethod
+    async def close_async_client(cls):
+        """Закрыть пул соединений при остановке бота"""
+        if cls._async_instance is not None:
+            await cls._async_instance.aclose()
+    
     @classmethod
     def is_available(cls) -> bool:
         """Проверить доступность Supabase"""
         try:
             from config import ANALYTICS_ENABLED
-            client_available = cls.get_client() is not None
+            client_available = cls.get_async_client() is not None
             result = client_available and ANALYTICS_ENABLED
             print(f"🔍 Supabase availability check: client={client_available}, enabled={ANALYTICS_ENABLED}, result={result}")
             return result
@@ -131,12 +184,12 @@ async def get_user_consent_status(user_id: int) -> Optional[dict]:
         }
     """
     try:
-        client = SupabaseClient.get_client()
+        client = SupabaseClient.get_async_client()
         if not client:
             logger.warning("Supabase client not available for consent check")
             return None
             
-        result = client.table('users').select(
+        result = await client.table('users').select(
             'consent_given, consent_timestamp, consent_version, marketing_consent'
         ).eq('id', user_id).execute()
         
@@ -166,13 +219,13 @@ async def save_user_consent(user_id: int, consent_version: str = 'v1.0', marketi
         bool: True если согласие сохранено успешно
     """
     try:
-        client = SupabaseClient.get_client()
+        client = SupabaseClient.get_async_client()
         if not client:
             logger.warning("Supabase client not available for consent saving")
             return False
             
         # Обновляем или создаем запись согласия
-        result = client.table('users').update({
+        result = await client.table('users').update({
             'consent_given': True,
             'consent_timestamp': 'now()',
             'consent_version': consent_version,
@@ -202,13 +255,13 @@ async def revoke_user_consent(user_id: int) -> bool:
         bool: True если согласие отозвано успешно
     """
     try:
-        client = SupabaseClient.get_client()
+        client = SupabaseClient.get_async_client()
         if not client:
             logger.warning("Supabase client not available for consent revocation")
             return False
             
         # Помечаем согласие как отозванное (НЕ удаляем пользователя полностью)
-        result = client.table('users').update({
+        result = await client.table('users').update({
             'consent_given': False,
             'consent_timestamp': 'now()'  # Время отзыва
         }).eq('id', user_id).execute()
@@ -273,13 +326,13 @@ async def migrate_existing_users_consent() -> dict:
         dict: Статистика миграции
     """
     try:
-        client = SupabaseClient.get_client()
+        client = SupabaseClient.get_async_client()
         if not client:
             logger.warning("Supabase client not available for migration")
             return {'error': 'Database not available'}
             
         # Находим пользователей без согласия
-        users_without_consent = client.table('users').select(
+        users_without_consent = await client.table('users').select(
             'id'
         ).is_('consent_given', 'null').execute()
         
@@ -288,7 +341,7 @@ async def migrate_existing_users_consent() -> dict:
             return {'migrated': 0, 'already_migrated': 0}
             
         # Проставляем implied consent
-        migration_result = client.table('users').update({
+        migration_result = await client.table('users').update({
             'consent_given': True,
             'consent_timestamp': 'now()',
             'consent_version': 'v1.0',
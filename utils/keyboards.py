@@ -110,6 +110,28 @@ def get_post_generation_keyboard(session_id: str, iteration: int):
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def get_variant_choice_keyboard(session_id: str, count: int):
+    """Клавиатура выбора одного из вариантов письма"""
+    keyboard = [
+        [
+            InlineKeyboardButton(f"✅ Вариант {index + 1}", callback_data=f"pick_variant_{session_id}_{index}")
+            for index in range(count)
+        ],
+        [
+            InlineKeyboardButton("🔄 Еще варианты", callback_data=f"retry_generation_{session_id}")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_bulk_vacancies_keyboard():
+    """Клавиатура пакетного режима: вакансии собраны, переходим к резюме"""
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Готово, отправить резюме", callback_data="bulk_vacancies_done")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 def get_iteration_upsell_keyboard(session_id: str, remaining_iterations: int):
     """Клавиатура для повторных запросов - UPSELL touchpoint"""
     keyboard = []
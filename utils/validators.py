@@ -3,7 +3,7 @@
 Обработка corner-кейсов и пользовательских ошибок
 """
 import re
-from typing import Tuple
+from typing import List, Tuple
 from telegram import Update
 
 
@@ -15,6 +15,10 @@ class InputValidator:
     MAX_VACANCY_LENGTH = 10000
     MIN_RESUME_LENGTH = 300
     MAX_RESUME_LENGTH = 15000
+    MAX_BULK_FILE_SIZE = 200 * 1024  # .txt со списком вакансий для /bulk
+    
+    # Разделитель вакансий в пакетном режиме: строка из ---, === или ___
+    BULK_SEPARATOR_PATTERN = re.compile(r'^\s*(?:-{3,}|={3,}|_{3,})\s*$', re.MULTILINE)
     
     # Паттерны для обнаружения файловых ссылок (которые нужно блокировать)
     FILE_SHARING_PATTERNS = [
@@ -99,6 +103,14 @@ class InputValidator:
         
         return True, ""
     
+    @staticmethod
+    def split_vacancies(text: str) -> List[str]:
+        """Делит текст пакетного режима на вакансии по строкам-разделителям (---)"""
+        if not text:
+            return []
+        parts = InputValidator.BULK_SEPARATOR_PATTERN.split(text.replace('\r\n', '\n'))
+        return [part.strip() for part in parts if part.strip()]
+    
     @staticmethod
     def validate_resume_text(text: str) -> Tuple[bool, str]:
         """Валидация текста резюме"""